@@ -0,0 +1,187 @@
+"""
+Password hashing and verification off the request path.
+Passwords are stored as scrypt hashes ("scrypt$n$r$p$salt$hash", base64
+salt and hash). Hashing one costs tens of milliseconds of CPU, so the
+server never does it in a handler: `Authenticator` runs it on a small
+thread pool (hashlib releases the GIL inside the KDF, so the pool hashes
+in parallel while the handler threads and the event loop keep delivering
+messages).
+
+Admission control: at most `max_pending` hash jobs may be queued or running;
+beyond that `submit` raises `AuthBusy` at once and the client is told to
+retry, so a login storm after a restart waits in the clients, not in server
+memory.
+
+Verification cache: after a successful check the result is kept for
+`cache_ttl` seconds as an HMAC of (stored hash, password) under a random
+per-process key, so a reconnecting client is verified with one HMAC instead
+of the KDF. Plain passwords are never kept; a changed stored hash misses.
+
+Rows from before hashing hold the plain password; they still verify and
+`verify` returns a fresh hash for the caller to store.
+
+Session tokens let a client that lost its connection resume without the
+password: a random token is given out at login and only its SHA-256 is
+stored, so checking it is one hash and one lookup, and a leaked database
+does not hold usable tokens.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+SCHEME = "scrypt"
+# scrypt cost: 16 MB of memory and ~50-80 ms of CPU per hash
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+HASH_SIZE = 32
+# Hash jobs running at once and queued or running at most
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_MAX_PENDING = 64
+# Verification results kept for reconnecting clients
+DEFAULT_CACHE_TTL = 600.0
+DEFAULT_CACHE_SIZE = 10000
+
+
+class AuthBusy(RuntimeError):
+    """Raised when too many hash jobs are already queued."""
+
+
+def _b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def _scrypt(password, salt, n, r, p, size):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * r * n, dklen=size)
+
+
+def hash_password(password):
+    """Encoded scrypt hash of `password` with a random salt (slow)."""
+    salt = os.urandom(SALT_SIZE)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P, HASH_SIZE)
+    return f"{SCHEME}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+
+
+def is_hashed(stored):
+    return stored.startswith(SCHEME + "$")
+
+
+def check_password(password, stored):
+    """True if `password` matches the stored hash (slow) or legacy plain password."""
+    if not isinstance(password, str) or not isinstance(stored, str):
+        return False
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    try:
+        _, n, r, p, salt, digest = stored.split("$")
+        digest = base64.b64decode(digest)
+        computed = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p), len(digest))
+    except (ValueError, TypeError):
+        return False
+    return hmac.compare_digest(computed, digest)
+
+
+def new_session_token():
+    """(token for the client, digest to store)."""
+    token = secrets.token_urlsafe(32)
+    return token, session_digest(token)
+
+
+def session_digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def needs_rehash(stored):
+    """Stored value is a plain password or a hash with other parameters."""
+    return stored.split("$")[:4] != [SCHEME, str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P)]
+
+
+class Authenticator:
+    """Bounded pool for password hashing with a cache of verified logins."""
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING,
+                 cache_ttl=DEFAULT_CACHE_TTL, cache_size=DEFAULT_CACHE_SIZE):
+        self.max_pending = max(1, max_pending)
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="auth")
+        self._key = os.urandom(32)
+        self._cache = OrderedDict()  # username -> (mac of stored hash and password, expiry)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._counts = {"jobs": 0, "cache_hits": 0, "rejected": 0, "failed": 0}
+
+    def submit(self, function, *args):
+        """Run `function` on the pool; raises AuthBusy when the pool is full."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._counts["rejected"] += 1
+                raise AuthBusy("too many logins in progress")
+            self._pending += 1
+            self._counts["jobs"] += 1
+        future = self._pool.submit(function, *args)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def hash(self, password):
+        """Future of the encoded hash of a new password."""
+        return self.submit(hash_password, password)
+
+    def verify(self, username, password, stored):
+        """Future of (matches, new hash to store or None).
+
+        A login verified within `cache_ttl` completes at once without the KDF.
+        """
+        if not isinstance(password, str):
+            future = Future()
+            future.set_result((False, None))
+            return future
+        mac = self._mac(stored, password)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(username)
+            if entry is not None and entry[1] > now and hmac.compare_digest(entry[0], mac):
+                self._cache.move_to_end(username)
+                self._counts["cache_hits"] += 1
+                future = Future()
+                future.set_result((True, None))
+                return future
+        return self.submit(self._verify, username, password, stored, mac)
+
+    def _verify(self, username, password, stored, mac):
+        if not check_password(password, stored):
+            with self._lock:
+                self._counts["failed"] += 1
+            return False, None
+        new_hash = None
+        if needs_rehash(stored):
+            new_hash = hash_password(password)
+            mac = self._mac(new_hash, password)
+        with self._lock:
+            self._cache[username] = (mac, time.monotonic() + self.cache_ttl)
+            self._cache.move_to_end(username)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return True, new_hash
+
+    def _mac(self, stored, password):
+        return hmac.new(self._key, stored.encode() + b"\0" + password.encode(), hashlib.sha256).digest()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, in_flight=self._pending, cached=len(self._cache))
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,82 @@
+"""
+Benchmark of payload codecs on typical `chat_history` responses.
+Reports bytes on the wire (full frame) and encode/decode time per payload
+for every codec available locally, plus the pre-codec JSON encoding
+(`json.dumps(...).encode()`) as a baseline.
+
+    python bench_codec.py [--messages 200] [--rounds 200]
+"""
+import argparse
+import json
+import random
+import time
+
+import codec
+from protocol import HEADER, encode_frame, FrameDecoder
+
+WORDS_RU = ("привет как дела сегодня завтра встреча проект сервер клиент "
+            "сообщение история чат работа отлично спасибо хорошо").split()
+WORDS_EN = "hello ok see you tomorrow meeting build deploy done thanks".split()
+
+
+class LegacyJsonCodec:
+    """Encoding used before codec.py: ASCII-escaped JSON with spaces."""
+    name = 'json-legacy'
+
+    def encode(self, message):
+        return json.dumps(message).encode()
+
+    def decode(self, payload):
+        return json.loads(payload.decode())
+
+
+def make_history(count, seed=1):
+    rnd = random.Random(seed)
+    messages = []
+    for i in range(count):
+        words = WORDS_RU if rnd.random() < 0.8 else WORDS_EN
+        text = " ".join(rnd.choice(words) for _ in range(rnd.randint(2, 25)))
+        messages.append({
+            "sender": rnd.choice(["alice", "боб"]),
+            "text": text,
+            "timestamp": f"{rnd.randint(0, 23):02}:{rnd.randint(0, 59):02}:{rnd.randint(0, 59):02}",
+        })
+    return {"action": "chat_history", "other_user": "боб", "messages": messages}
+
+
+def bench(c, payload, rounds):
+    encoded = c.encode(payload)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        c.encode(payload)
+    enc = (time.perf_counter() - start) / rounds
+    start = time.perf_counter()
+    for _ in range(rounds):
+        c.decode(encoded)
+    dec = (time.perf_counter() - start) / rounds
+    return HEADER.size + len(encoded), enc, dec
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, nargs="+", default=[20, 200, 2000])
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    codecs = [LegacyJsonCodec()] + [codec.get_codec(n) for n in codec.available_codecs()]
+    if 'msgpack' not in codec.available_codecs():
+        print("msgpack is not installed; only JSON codecs are compared\n")
+
+    print(f"{'messages':>8} {'codec':<12} {'bytes':>10} {'encode us':>10} {'decode us':>10}")
+    for count in args.messages:
+        payload = make_history(count)
+        # sanity check: the real framing path round-trips every codec
+        for name in codec.available_codecs():
+            assert FrameDecoder().feed(encode_frame(payload, codec.get_codec(name))) == [payload]
+        for c in codecs:
+            size, enc, dec = bench(c, payload, args.rounds)
+            print(f"{count:>8} {c.name:<12} {size:>10} {enc * 1e6:>10.1f} {dec * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
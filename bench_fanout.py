@@ -0,0 +1,141 @@
+"""
+Fan-out latency of group messages for groups of 10, 100 and 1000 members.
+For every `--sizes` value a fresh server is started on a temporary
+database; `--procs` receiver processes log in the members (selectors, one
+socket per member) and an owner creates the group and sends `--messages`
+messages to it one at a time. Latency of a message is measured from its
+send to its arrival at the first, the median and the last member.
+
+    python bench_fanout.py [--sizes 10 100 1000] [--messages 50] [--workers 1]
+"""
+import argparse
+import multiprocessing
+import os
+import selectors
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from protocol import FrameDecoder, FramedReader, send_message
+from bench_throughput import HOST, request, wait_for_port
+
+
+def login(port, username):
+    sock = socket.create_connection((HOST, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = FramedReader(sock)
+    request(sock, reader, {"action": "register", "username": username, "password": "bench"})
+    if request(sock, reader, {"action": "login", "username": username, "password": "bench"})["status"] != "success":
+        raise RuntimeError(f"{username}: login failed")
+    return sock
+
+
+def run_members(port, usernames, messages, ready, results):
+    """Log the members in and record when every group message reaches each of them."""
+    selector = selectors.DefaultSelector()
+    for username in usernames:
+        sock = login(port, username)
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, FrameDecoder())
+    ready.put(len(usernames))
+    arrivals = {}  # {message index: [arrival time per member]}
+    expected = len(usernames) * messages
+    received = 0
+    while received < expected:
+        for key, _ in selector.select():
+            data = key.fileobj.recv(65536)
+            if not data:
+                raise RuntimeError("connection closed")
+            now = time.monotonic()
+            for frame in key.data.feed(data):
+                if frame.get("action") == "receive_message" and frame.get("group"):
+                    arrivals.setdefault(int(frame["text"]), []).append(now)
+                    received += 1
+    results.put(arrivals)
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+
+
+def bench(size, args, port):
+    with tempfile.TemporaryDirectory(prefix="neurochat-bench-") as directory:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+                   "--port", str(port), "--mode", args.mode, "--workers", str(args.workers),
+                   "--db", os.path.join(directory, "bench.db")]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            time.sleep(0.5 * args.workers)
+            members = [f"member{i}" for i in range(size)]
+            procs = max(1, min(args.procs, size))
+            context = multiprocessing.get_context("spawn")
+            ready, results = context.Queue(), context.Queue()
+            processes = [context.Process(target=run_members,
+                                         args=(port, members[i::procs], args.messages, ready, results))
+                         for i in range(procs)]
+            for process in processes:
+                process.start()
+            for _ in processes:
+                ready.get(timeout=args.timeout)
+
+            owner = login(port, "owner")
+            reader = FramedReader(owner)
+            group = request(owner, reader, {"action": "create_group", "name": "bench", "members": members})
+            key = group["group"]["key"]
+            sent = []
+            for i in range(args.messages):
+                sent.append(time.monotonic())
+                send_message(owner, {"action": "send_message", "recipient": key, "text": str(i)})
+                while reader.read_message().get("action") != "message_sent":
+                    pass
+                # let the previous message drain so latencies do not queue up
+                time.sleep(args.gap)
+            arrivals = {}
+            for _ in processes:
+                for index, times in results.get(timeout=args.timeout).items():
+                    arrivals.setdefault(index, []).extend(times)
+            for process in processes:
+                process.join()
+            owner.close()
+        finally:
+            server.terminate()
+            server.wait()
+    first, median, last = [], [], []
+    for index, times in arrivals.items():
+        times.sort()
+        first.append(times[0] - sent[index])
+        median.append(times[len(times) // 2] - sent[index])
+        last.append(times[-1] - sent[index])
+    return first, median, last
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=50, help="messages sent to every group")
+    parser.add_argument("--procs", type=int, default=4, help="receiver processes")
+    parser.add_argument("--gap", type=float, default=0.02, help="seconds between messages")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--port", type=int, default=5700)
+    parser.add_argument("--timeout", type=float, default=600.0)
+    args = parser.parse_args(argv)
+
+    print(f"{os.cpu_count()} CPUs, {args.messages} messages per group, "
+          f"{args.workers} worker(s), mode {args.mode}\n")
+    print(f"{'members':>7} {'first ms':>9} {'median ms':>10} {'last p50':>9} {'last p99':>9}")
+    for n, size in enumerate(args.sizes):
+        first, median, last = bench(size, args, args.port + n)
+        print(f"{size:>7} {statistics.median(first) * 1000:>9.2f} {statistics.median(median) * 1000:>10.2f} "
+              f"{percentile(last, 0.5) * 1000:>9.2f} {percentile(last, 0.99) * 1000:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
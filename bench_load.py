@@ -0,0 +1,413 @@
+"""
+Load test: many simulated users against a local server.
+Starts `server.py` on a temporary database with its admin port enabled and
+simulates `--users` registered users from `--procs` client processes
+(selectors, one socket per user):
+
+  1. login storm: all users connect, register and log in at once;
+  2. chats: with `--chat-size` above 2 users are split into groups of that
+     size, otherwise every user gets `--contacts` partners for direct chats;
+  3. steady load: for `--duration` seconds every user sends on average
+     `--rate` messages per second (Poisson arrivals) to one of its chats.
+
+Each message carries its send time, so the receiver measures delivery
+latency. Reported: login latency and rate, sent/delivered messages per
+second, delivery p50/p90/p99, lost messages, and the server's CPU time and
+peak memory over the steady phase, read from its metrics.
+
+Runs are comparable: `--seed` fixes who talks to whom and when, `--json`
+saves parameters and results, `--baseline` prints the change against a
+saved run.
+
+    python bench_load.py [--users 200] [--rate 1] [--duration 20] [--chat-size 2]
+    python bench_load.py --json after.json --baseline before.json
+"""
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from protocol import FrameDecoder, encode_frame
+from bench_throughput import HOST, wait_for_port
+
+# Latency samples kept per client process (reservoir), enough for p99
+MAX_SAMPLES = 200000
+# Results compared with --baseline: (key, label, larger is better)
+COMPARED = (
+    ("login_p99_ms", "login p99 ms", False),
+    ("sent_per_s", "sent msg/s", True),
+    ("delivered_per_s", "delivered msg/s", True),
+    ("delivery_p50_ms", "delivery p50 ms", False),
+    ("delivery_p99_ms", "delivery p99 ms", False),
+    ("server_cpu_percent", "server CPU %", False),
+    ("server_cpu_us_per_msg", "server CPU µs/msg", False),
+    ("server_max_rss_mb", "server max RSS MB", False),
+)
+# A change for the worse at least this large (percent) is marked with "!"
+REGRESSION_PERCENT = 10.0
+
+
+class SimUser:
+    """One simulated user: its socket, chats and login state."""
+
+    def __init__(self, name, sock, chats, login_started):
+        self.name = name
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.chats = chats  # recipients: partner names or a group key once known
+        self.login_started = login_started
+        self.logged_in = False  # None once the login has failed
+        self.retry_at = None    # the server was busy: log in again at this time
+
+
+class Client:
+    """The users of one client process and what they have seen."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.selector = selectors.DefaultSelector()
+        self.users = {}
+        self.login_latency = []
+        self.latency = []
+        self.seen = 0
+        self.stats = {"sent": 0, "acked": 0, "errors": 0, "delivered": 0, "login_errors": 0,
+                      "login_retries": 0}
+
+    def add(self, user):
+        self.users[user.name] = user
+        self.selector.register(user.sock, selectors.EVENT_READ, user)
+
+    def send(self, user, message):
+        user.sock.sendall(encode_frame(message))
+
+    def sample(self, seconds):
+        """Reservoir sampling keeps the latency list bounded on long runs."""
+        self.seen += 1
+        if len(self.latency) < MAX_SAMPLES:
+            self.latency.append(seconds)
+        else:
+            index = self.rng.randrange(self.seen)
+            if index < MAX_SAMPLES:
+                self.latency[index] = seconds
+
+    def delivered(self, message):
+        try:
+            self.sample(time.time() - float(message["text"]))
+        except (KeyError, TypeError, ValueError):
+            return
+        self.stats["delivered"] += 1
+
+    def handle(self, user, frame):
+        action = frame.get("action")
+        if action == "receive_message":
+            self.delivered(frame)
+        elif action == "message_sent":
+            self.stats["acked" if frame.get("status") == "success" else "errors"] += 1
+        elif action == "pending":
+            for message in frame.get("messages", []):
+                self.delivered(message)
+            self.send(user, {"action": "ack_pending", "cursor": frame.get("cursor")})
+        elif action == "group":
+            if frame.get("status") == "success":
+                user.chats = [frame["group"]["key"]]
+        elif action == "group_updated":
+            user.chats = [frame["group"]["key"]]
+        elif frame.get("req_id") == "register":
+            if "retry_after" in frame:
+                # the login behind it fails too ("not found" or busy): retry both
+                user.retry_at = time.monotonic() + frame["retry_after"]
+        elif frame.get("req_id") == "login":
+            if frame.get("status") == "success":
+                user.logged_in = True
+                self.login_latency.append(time.monotonic() - user.login_started)
+            elif "retry_after" in frame or user.retry_at is not None:
+                user.retry_at = user.retry_at or time.monotonic() + frame["retry_after"]
+                self.stats["login_retries"] += 1
+            else:
+                self.stats["login_errors"] += 1
+                user.logged_in = None
+
+    def pump(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            user = key.data
+            try:
+                data = user.sock.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                raise RuntimeError(f"{user.name}: connection closed")
+            for frame in user.decoder.feed(data):
+                self.handle(user, frame)
+
+    def pump_until(self, deadline, done=lambda: False):
+        while not done():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self.pump(remaining)
+
+    def log_in(self, user):
+        # register and login are pipelined; register of an existing user just fails
+        user.retry_at = None
+        user.sock.sendall(encode_frame({"action": "register", "username": user.name, "password": "bench",
+                                        "req_id": "register"})
+                          + encode_frame({"action": "login", "username": user.name, "password": "bench",
+                                          "req_id": "login"}))
+
+    def log_in_all(self, deadline):
+        """Wait for every login, repeating those the server turned away as busy."""
+        while any(user.logged_in is False for user in self.users.values()):
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            retries = [user.retry_at for user in self.users.values() if user.retry_at is not None]
+            for user in self.users.values():
+                if user.retry_at is not None and user.retry_at <= now:
+                    self.log_in(user)
+            self.pump(min([deadline] + retries) - now)
+
+
+def run_users(port, names, chats, groups, args, index, barrier, results):
+    """Client process: log the users in, set up their chats and send messages."""
+    client = Client(random.Random(f"{args.seed}-{index}"))
+
+    # 1. login storm: every process starts at the same moment
+    barrier.wait()
+    for name in names:
+        started = time.monotonic()
+        sock = socket.create_connection((HOST, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        user = SimUser(name, sock, list(chats.get(name, ())), started)
+        client.add(user)
+        client.log_in(user)
+    client.log_in_all(time.monotonic() + args.timeout)
+    barrier.wait()
+
+    # 2. groups: the first member creates the group, the others learn its key
+    for owner, members in groups:
+        if owner in client.users:
+            client.send(client.users[owner], {"action": "create_group", "name": f"load {owner}",
+                                              "members": members})
+    client.pump_until(time.monotonic() + args.timeout,
+                      lambda: all(user.chats for user in client.users.values() if user.logged_in))
+    barrier.wait()
+
+    # 3. steady load: Poisson arrivals per user, sends in time order
+    start = time.monotonic()
+    wall_offset = time.time() - start
+    end = start + args.duration
+    active = [user for user in client.users.values() if user.logged_in and user.chats]
+    schedule = [(start + client.rng.expovariate(args.rate), n) for n in range(len(active))]
+    heapq.heapify(schedule)
+    while True:
+        now = time.monotonic()
+        while schedule and schedule[0][0] <= now:
+            due, n = heapq.heappop(schedule)
+            user = active[n]
+            # the text is the planned send time as wall-clock time: if this
+            # process falls behind, the delay counts as latency, not as a pause
+            client.send(user, {"action": "send_message", "recipient": client.rng.choice(user.chats),
+                               "text": repr(due + wall_offset)})
+            client.stats["sent"] += 1
+            due += client.rng.expovariate(args.rate)
+            if due < end:
+                heapq.heappush(schedule, (due, n))
+        if now >= end:
+            break
+        client.pump(min(end, schedule[0][0] if schedule else end) - now)
+    barrier.wait()
+
+    # 4. drain what is still in flight
+    client.pump_until(time.monotonic() + args.drain)
+    results.put({"stats": client.stats, "login_latency": client.login_latency,
+                 "latency": client.latency, "seen": client.seen})
+    for user in client.users.values():
+        user.sock.close()
+
+
+def plan_chats(names, args, rng):
+    """Who talks to whom: ({user: [partners]}, [(group owner, members)])."""
+    if args.chat_size > 2:
+        groups = [names[start:start + args.chat_size] for start in range(0, len(names), args.chat_size)]
+        if len(groups) > 1 and len(groups[-1]) == 1:
+            groups[-2].extend(groups.pop())
+        return {}, [(members[0], members[1:]) for members in groups]
+    contacts = min(args.contacts, len(names) - 1)
+    chats = {}
+    for name in names:
+        others = [other for other in names if other != name]
+        chats[name] = rng.sample(others, contacts)
+    return chats, []
+
+
+def read_stats(admin_port, workers):
+    """Server CPU seconds and peak RSS in MB, summed over the workers."""
+    cpu, rss = 0.0, 0.0
+    for index in range(workers):
+        with urllib.request.urlopen(f"http://127.0.0.1:{admin_port + index}/", timeout=10) as response:
+            process = json.load(response)["process"]
+        cpu += process["cpu_user"] + process["cpu_system"]
+        # ru_maxrss: kilobytes on Linux, bytes on macOS
+        rss += process.get("max_rss", 0) / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return cpu, rss
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    names = [f"load{i}" for i in range(args.users)]
+    chats, groups = plan_chats(names, args, rng)
+    procs = max(1, min(args.procs, args.users))
+    with tempfile.TemporaryDirectory(prefix="neurochat-bench-") as directory:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+                   "--port", str(args.port), "--mode", args.mode, "--workers", str(args.workers),
+                   "--admin-port", str(args.admin_port), "--log-level", "WARNING",
+                   "--db", os.path.join(directory, "bench.db")]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes = []
+        try:
+            wait_for_port(args.port)
+            time.sleep(0.5 * args.workers)
+            context = multiprocessing.get_context("spawn")
+            barrier, results = context.Barrier(procs + 1, timeout=args.timeout), context.Queue()
+            processes = [context.Process(target=run_users,
+                                         args=(args.port, names[i::procs], chats, groups, args, i, barrier, results))
+                         for i in range(procs)]
+            for process in processes:
+                process.start()
+
+            barrier.wait()
+            storm_start = time.monotonic()
+            barrier.wait()
+            storm = time.monotonic() - storm_start
+            barrier.wait()
+            cpu_start, _ = read_stats(args.admin_port, args.workers)
+            steady_start = time.monotonic()
+            barrier.wait()
+            steady = time.monotonic() - steady_start
+            cpu_end, rss = read_stats(args.admin_port, args.workers)
+            parts = [results.get(timeout=args.timeout + args.drain) for _ in processes]
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            server.terminate()
+            server.wait()
+
+    stats = {key: sum(part["stats"][key] for part in parts) for key in parts[0]["stats"]}
+    login_latency = [value for part in parts for value in part["login_latency"]]
+    latency = [value for part in parts for value in part["latency"]]
+    recipients = args.chat_size - 1 if args.chat_size > 2 else 1
+    expected = stats["acked"] * recipients
+    delivered = stats["delivered"]
+    return {
+        "logins": len(login_latency),
+        "login_errors": stats["login_errors"],
+        "login_retries": stats["login_retries"],
+        "login_storm_s": round(storm, 3),
+        "logins_per_s": round(len(login_latency) / storm, 1) if storm else 0.0,
+        "login_p50_ms": round(percentile(login_latency, 0.5) * 1000, 2),
+        "login_p99_ms": round(percentile(login_latency, 0.99) * 1000, 2),
+        "steady_s": round(steady, 3),
+        "sent": stats["sent"],
+        "acked": stats["acked"],
+        "send_errors": stats["errors"],
+        "delivered": delivered,
+        "lost": max(0, expected - delivered),
+        "sent_per_s": round(stats["sent"] / steady, 1),
+        "delivered_per_s": round(delivered / steady, 1),
+        "delivery_p50_ms": round(percentile(latency, 0.5) * 1000, 2),
+        "delivery_p90_ms": round(percentile(latency, 0.9) * 1000, 2),
+        "delivery_p99_ms": round(percentile(latency, 0.99) * 1000, 2),
+        "delivery_max_ms": round(max(latency, default=0.0) * 1000, 2),
+        "server_cpu_s": round(cpu_end - cpu_start, 3),
+        "server_cpu_percent": round((cpu_end - cpu_start) / steady * 100, 1),
+        "server_cpu_us_per_msg": round((cpu_end - cpu_start) / delivered * 1e6, 1) if delivered else 0.0,
+        "server_max_rss_mb": round(rss, 1),
+    }
+
+
+def report(params, results, baseline=None):
+    print(f"{params['cpus']} CPUs, {params['users']} users in {params['procs']} processes, "
+          f"{params['rate']} msg/s each for {params['duration']}s, chat size {params['chat_size']}, "
+          f"{params['workers']} worker(s), mode {params['mode']}\n")
+    print(f"login storm   {results['logins']} logins in {results['login_storm_s']:.2f}s "
+          f"({results['logins_per_s']:.0f}/s), p50 {results['login_p50_ms']:.1f} ms, "
+          f"p99 {results['login_p99_ms']:.1f} ms, {results['login_retries']} retried (server busy), "
+          f"{results['login_errors']} failed")
+    print(f"throughput    sent {results['sent_per_s']:.0f} msg/s, delivered {results['delivered_per_s']:.0f} msg/s "
+          f"({results['delivered']} delivered, {results['lost']} lost, {results['send_errors']} send errors)")
+    print(f"delivery      p50 {results['delivery_p50_ms']:.2f} ms, p90 {results['delivery_p90_ms']:.2f} ms, "
+          f"p99 {results['delivery_p99_ms']:.2f} ms, max {results['delivery_max_ms']:.2f} ms")
+    print(f"server        CPU {results['server_cpu_percent']:.0f}% "
+          f"({results['server_cpu_us_per_msg']:.0f} µs per delivered message), "
+          f"max RSS {results['server_max_rss_mb']:.1f} MB")
+    if baseline is None:
+        return
+    if baseline["params"] != params:
+        changed = sorted(key for key in params if baseline["params"].get(key) != params[key])
+        print(f"\nwarning: baseline was run with different parameters: {', '.join(changed)}")
+    print(f"\n{'':<20} {'baseline':>10} {'this run':>10} {'change':>8}")
+    for key, label, higher_better in COMPARED:
+        old, new = baseline["results"].get(key, 0.0), results[key]
+        change = (new - old) / old * 100 if old else 0.0
+        worse = change < 0 if higher_better else change > 0
+        mark = " !" if worse and abs(change) >= REGRESSION_PERCENT else ""
+        print(f"{label:<20} {old:>10.1f} {new:>10.1f} {change:>+7.1f}%{mark}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--procs", type=int, default=4, help="client processes")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per user")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of steady load")
+    parser.add_argument("--chat-size", type=int, default=2, help="2: direct chats, more: groups of this size")
+    parser.add_argument("--contacts", type=int, default=5, help="partners per user in direct chats")
+    parser.add_argument("--drain", type=float, default=3.0, help="seconds to wait for messages in flight")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--port", type=int, default=5800)
+    parser.add_argument("--admin-port", type=int, default=5900)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", metavar="FILE", help="save parameters and results")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with results saved by --json")
+    args = parser.parse_args(argv)
+    if args.users < 2 or args.rate <= 0:
+        parser.error("need at least 2 users and a positive rate")
+
+    params = {"cpus": os.cpu_count(), "users": args.users, "procs": max(1, min(args.procs, args.users)),
+              "rate": args.rate, "duration": args.duration, "chat_size": args.chat_size,
+              "contacts": args.contacts if args.chat_size <= 2 else None,
+              "workers": args.workers, "mode": args.mode, "seed": args.seed}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    results = run(args)
+    report(params, results, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"params": params, "results": results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Search latency on a generated message history, index vs. LIKE scan.
+Fills a temporary database through `SqliteStore.append_message` with
+`--messages` random Russian messages between `--users` users, then times
+`search_messages` for one user (word, prefix, two words, one chat) and the
+same word found with a `LIKE` scan of all messages.
+
+    python bench_search.py [--messages 200000] [--users 200] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from storage import SqliteStore
+
+WORDS = ("привет как дела что нового завтра встреча в офисе отчёт готов проверь пожалуйста "
+         "спасибо увидимся вечером ёлка праздник подарок купить молоко хлеб сервер упал "
+         "перезапусти логи посмотри ошибка исправлена релиз выкатили тесты зелёные кофе "
+         "обед позвоню напиши документ таблица презентация клиент доволен задача срок").split()
+
+
+def fill(store, messages, users, rng):
+    names = [f"user{i}" for i in range(users)]
+    for name in names:
+        store.add_user(name, "bench")
+    for n in range(messages):
+        a, b = rng.sample(names, 2)
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        store.append_message(tuple(sorted([a, b])), {"sender": a, "text": text, "timestamp": "00:00:00"})
+    store.flush()
+
+
+def timed(repeat, function):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(prefix="neurochat-bench-") as directory:
+        store = SqliteStore(os.path.join(directory, "bench.db"))
+        start = time.perf_counter()
+        fill(store, args.messages, args.users, rng)
+        elapsed = time.perf_counter() - start
+        print(f"{args.messages} messages, {args.users} users: filled in {elapsed:.1f}s "
+              f"({args.messages / elapsed:.0f} msg/s with indexing)\n")
+        partner = store.chat_summaries("user0")[0]["user"]
+        chat_key = tuple(sorted(["user0", partner]))
+        cases = [
+            ("word", lambda: store.search_messages("user0", "релиз")),
+            ("prefix", lambda: store.search_messages("user0", "пре")),
+            ("two words", lambda: store.search_messages("user0", "сервер логи")),
+            ("ё as е", lambda: store.search_messages("user0", "елка")),
+            ("one chat", lambda: store.search_messages("user0", "релиз", chat_key=chat_key)),
+            ("LIKE scan", lambda: store._query(
+                "SELECT chat, seq FROM messages WHERE text LIKE ? ORDER BY seq DESC LIMIT 20", ("%релиз%",))),
+        ]
+        print(f"{'query':>10} {'ms':>8} {'results':>8}")
+        for name, function in cases:
+            ms, result = timed(args.repeat, function)
+            count = len(result[0]) if isinstance(result, tuple) else len(result)
+            print(f"{name:>10} {ms:>8.2f} {count:>8}")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Messages-per-second benchmark of the server with 1..N worker processes.
+For every `--workers` value a fresh server is started on a temporary
+database; `--clients` client processes log in one user each and send
+`--messages` messages to the next user in the ring, keeping `--window`
+unacknowledged sends in flight. Throughput is the number of messages
+delivered to their recipients divided by the wall time of the run.
+
+    python bench_throughput.py [--workers 1 2 4] [--clients 8] [--messages 2000]
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from protocol import FramedReader, send_message
+
+HOST = '127.0.0.1'
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def request(sock, reader, message):
+    send_message(sock, message)
+    return reader.read_message()
+
+
+def run_client(index, clients, port, messages, window, barrier, results):
+    username, partner = f"bench{index}", f"bench{(index + 1) % clients}"
+    sock = socket.create_connection((HOST, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = FramedReader(sock)
+    request(sock, reader, {"action": "register", "username": username, "password": "bench"})
+    if request(sock, reader, {"action": "login", "username": username, "password": "bench"})["status"] != "success":
+        raise RuntimeError(f"{username}: login failed")
+    barrier.wait()
+    start = time.perf_counter()
+    sent = acked = received = 0
+    while sent < min(window, messages):
+        send_message(sock, {"action": "send_message", "recipient": partner, "text": f"message {sent}"})
+        sent += 1
+    while acked < messages or received < messages:
+        frame = reader.read_message()
+        if frame is None:
+            raise RuntimeError(f"{username}: connection closed")
+        action = frame.get("action")
+        if action == "message_sent":
+            acked += 1
+            if sent < messages:
+                send_message(sock, {"action": "send_message", "recipient": partner, "text": f"message {sent}"})
+                sent += 1
+        elif action == "receive_message":
+            received += 1
+        elif action == "pending":
+            # the recipient's queue overflowed into offline delivery
+            received += len(frame["messages"])
+            send_message(sock, {"action": "ack_pending", "cursor": frame["cursor"]})
+    results.put((start, time.perf_counter(), received))
+    sock.close()
+
+
+def bench(workers, args, port):
+    with tempfile.TemporaryDirectory(prefix="neurochat-bench-") as directory:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+                   "--port", str(port), "--mode", args.mode, "--workers", str(workers),
+                   "--db", os.path.join(directory, "bench.db")]
+        # The server logs every frame; keep that out of the measurement's way
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            # give every worker time to bind and link up with its peers
+            time.sleep(0.5 * workers)
+            context = multiprocessing.get_context("spawn")
+            barrier = context.Barrier(args.clients)
+            results = context.Queue()
+            processes = [context.Process(target=run_client,
+                                         args=(i, args.clients, port, args.messages, args.window, barrier, results))
+                         for i in range(args.clients)]
+            for process in processes:
+                process.start()
+            runs = [results.get(timeout=args.timeout) for _ in processes]
+            for process in processes:
+                process.join()
+        finally:
+            server.terminate()
+            server.wait()
+    start = min(run[0] for run in runs)
+    end = max(run[1] for run in runs)
+    delivered = sum(run[2] for run in runs)
+    return delivered, end - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=2000, help="messages sent by every client")
+    parser.add_argument("--window", type=int, default=32, help="unacknowledged sends per client")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--port", type=int, default=5600)
+    parser.add_argument("--timeout", type=float, default=600.0)
+    args = parser.parse_args(argv)
+
+    print(f"{os.cpu_count()} CPUs, {args.clients} clients x {args.messages} messages, mode {args.mode}\n")
+    print(f"{'workers':>7} {'messages':>9} {'seconds':>8} {'msg/s':>9} {'speedup':>8}")
+    baseline = None
+    for n, workers in enumerate(args.workers):
+        delivered, elapsed = bench(workers, args, args.port + n)
+        rate = delivered / elapsed
+        baseline = baseline or rate
+        print(f"{workers:>7} {delivered:>9} {elapsed:>8.2f} {rate:>9.0f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -26,8 +26,17 @@ else:
 import socket
 import threading
 import json
+import time
+import uuid
 from datetime import datetime
 from queue import Queue, Empty
+from protocol import FramedReader, send_message, encode_frame, read_response, PendingRequests
+from client_model import (HISTORY_PAGE_SIZE, BOOTSTRAP_HISTORY, merge_history, append_unique, known_seqs,
+                          merge_receipt, last_seq, ReceiptBatcher)
+from client_cache import open_cache
+from client_dispatcher import UIDispatcher
+from client_chat_list import ChatList
+from codec import JSON, available_codecs, get_codec, CodecError
 import tkinter.font as tkfont
 import sys
 try:
@@ -35,6 +44,11 @@ try:
 except Exception:
     plyer_notify = None
 
+# Сколько сообщений одновременно держим в окне чата
+MAX_RENDERED_MESSAGES = 300
+# Сколько сообщений дорисовываем при прокрутке к краю окна
+RENDER_CHUNK = 100
+
 class ChatClient:
     def __init__(self, root):
         self.root = root
@@ -46,6 +60,9 @@ class ChatClient:
         self.external_login_handler = None
         
         self.server_socket = None
+        self.reader = None
+        # Кодек исходящих кадров, согласуется при входе
+        self.codec = JSON
         self.username = None
         self.server_host = None
         self.server_port = None
@@ -55,18 +72,49 @@ class ChatClient:
         self.chats_lock = threading.Lock()
         self.all_users = []
         self.users_lock = threading.Lock()
+        # Версия списка пользователей: при совпадении сервер его не присылает
+        self.users_version = None
+        # Локальный кеш сообщений, открывается при входе
+        self.cache = None
+        # История подгружается страницами при прокрутке вверх
+        self.history_more = {}
+        self.history_loading = set()
+        # Докуда собеседники получили и прочитали наши сообщения: {собеседник: {delivered, read}}
+        self.receipts = {}
+        # Группы, в которых состоим: {"group:<id>": {key, id, name, owner, members}}
+        self.groups = {}
+        # Наши отметки доставки и прочтения уходят пачками
+        self.acks = ReceiptBatcher(lambda message: self.send_to_server(message))
+        # Что сейчас нарисовано в окне чата
+        self.reset_render()
         
-        self.event_queue = Queue()
+        # События для UI разбираются в потоке Tk, одинаковые за кадр склеиваются
+        self.event_queue = UIDispatcher(self.root)
+        self.event_queue.register("update_chats_list", lambda data: self.update_chats_listbox(), coalesce=True)
+        # Число подгруженных сверху сообщений складывается, чтобы не сбить прокрутку
+        self.event_queue.register("display_chat", lambda data: self.display_current_chat(keep_top=data or 0),
+                                  merge=lambda old, new: (old or 0) + (new or 0))
+        self.event_queue.register("refresh_receipts", lambda data: self.refresh_receipts(), coalesce=True)
+        self.event_queue.register("close_chat", lambda data: self.close_current_chat(), coalesce=True)
+        # Новые сообщения за кадр обрабатываются одним вызовом
+        self.event_queue.register("incoming_messages", lambda data: self.show_incoming_messages(data),
+                                  merge=lambda old, new: old + new)
+        self.event_queue.register("search_results", lambda data: self.show_search_results(*data))
+        self.event_queue.register("connection", lambda state: self.show_connection_state(state), coalesce=True)
         
         self.receive_thread = None
         self.send_thread = None
-        self.ui_update_thread = None
         self.running = True
         
         self.send_queue = Queue()
+        # Запросы, ждущие ответа: сопоставляются по req_id
+        self.requests = PendingRequests()
 
         # Unread chats set
         self.unread_chats = set()
+        # Время последней активности чатов (epoch) — порядок в списке чатов
+        self.chat_activity = {}
+        self.chat_list = None
         # Theme tracking
         self.current_theme = None
         # Fonts
@@ -79,22 +127,7 @@ class ChatClient:
         self.start_theme_monitor()
         
         self.create_login_screen()
-        self.start_ui_update_thread()
-    
-    def start_ui_update_thread(self):
-        self.ui_update_thread = threading.Thread(target=self.process_events, daemon=True)
-        self.ui_update_thread.start()
-    
-    def process_events(self):
-        while self.running:
-            try:
-                event_type, data = self.event_queue.get(timeout=0.1)
-                if event_type == "update_chats_list":
-                    self.update_chats_listbox()
-                elif event_type == "display_chat":
-                    self.display_current_chat()
-            except Empty:
-                pass
+        self.event_queue.start()
 
     def get_theme_colors(self):
         # Returns (bg, fg, selectbg) for listbox/chat depending on theme
@@ -144,8 +177,6 @@ class ChatClient:
         # Apply to listbox
         try:
             self.chats_listbox.config(bg=bg, fg=fg, selectbackground=selbg)
-            # Re-render list to apply styling markers
-            self.update_chats_listbox()
         except Exception:
             pass
         # Apply menu/theme options
@@ -222,12 +253,14 @@ class ChatClient:
                     return False
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.connect((self.server_host, self.server_port))
+            self.reader = FramedReader(self.server_socket)
             return True
         except Exception as e:
             messagebox.showerror("Ошибка подключения", str(e))
             return False
     
     def send_to_server(self, message):
+        self.requests.tag(message)
         print(f"[SEND_TO_QUEUE] Добавляю в очередь: {message}")
         self.send_queue.put(message)
         print(f"[SEND_TO_QUEUE] Размер очереди: {self.send_queue.qsize()}")
@@ -239,12 +272,13 @@ class ChatClient:
                 message = self.send_queue.get(timeout=1)
                 print(f"[SENDER_THREAD] Получил из очереди: {message}")
                 try:
-                    self.server_socket.send(json.dumps(message).encode())
+                    send_message(self.server_socket, message, self.codec)
                     print(f"[SENDER_THREAD] Успешно отправлено: {message}")
                 except Exception as e:
                     print(f"[SENDER_THREAD] Ошибка отправки: {e}")
             except Empty:
-                pass
+                # Простой: снимаем запросы, так и не получившие ответа
+                self.requests.expire()
         print("[SENDER_THREAD] Поток отправки завершен")
     
     def create_login_screen(self):
@@ -284,55 +318,62 @@ class ChatClient:
                 return
             if not self.connect_to_server():
                 return
+            # Кеш с прошлого запуска: показываем его сразу, с сервера берём только новое
+            cache = open_cache(username, self.server_host, self.server_port)
+            cached_chats, cached_users, cached_version = {}, [], None
+            if cache:
+                try:
+                    cached_chats, cached_users, cached_version = cache.load(per_chat=HISTORY_PAGE_SIZE)
+                except Exception:
+                    pass
             try:
-                print(f"[LOGIN] Отправляю login для {username}")
-                self.server_socket.send(json.dumps({
+                print(f"[LOGIN] Отправляю login и bootstrap для {username}")
+                login_request = {
                     "action": "login",
                     "username": username,
-                    "password": password
-                }).encode())
-                response = self.server_socket.recv(1024).decode()
-                print(f"[LOGIN] Получен response: {response}")
-                data = json.loads(response)
+                    "password": password,
+                    "codecs": available_codecs()
+                }
+                bootstrap_request = {
+                    "action": "bootstrap",
+                    "users_version": cached_version if cached_users else self.users_version,
+                    "history_limit": BOOTSTRAP_HISTORY,
+                    "known": known_seqs(cached_chats)
+                }
+                self.requests.tag(login_request)
+                self.requests.tag(bootstrap_request)
+                # Вход и начальная загрузка уходят вместе: один обмен с сервером
+                self.server_socket.sendall(encode_frame(login_request) + encode_frame(bootstrap_request))
+                # Ответ на вход находим по req_id; кадры до него обработаем после
+                early = []
+                data = read_response(self.reader, login_request["req_id"], early) or {}
+                print(f"[LOGIN] Получен response: {data}")
                 if data.get("status") == "success":
                     self.username = username
-                    print(f"[LOGIN] Логин успешен, запрашиваю список пользователей")
-                    
-                    self.server_socket.send(json.dumps({"action": "get_users"}).encode())
-                    print(f"[LOGIN] Отправлен get_users запрос, жду ответ...")
-                    users_resp = self.server_socket.recv(1024).decode()
-                    print(f"[LOGIN] Получен users response: {users_resp}")
-                    
-                    with self.users_lock:
-                        self.all_users = json.loads(users_resp).get("users", [])
-                    
-                    # Запросить список чатов, где есть переписка, и загрузить их историю
                     try:
-                        self.server_socket.send(json.dumps({"action": "get_my_chats"}).encode())
-                        mych_resp = self.server_socket.recv(4096).decode()
-                        mych_data = json.loads(mych_resp)
-                        chats = mych_data.get('chats', [])
-                        for other in chats:
-                            try:
-                                self.server_socket.send(json.dumps({"action": "get_chat_history", "other_user": other}).encode())
-                                hist_resp = self.server_socket.recv(8192).decode()
-                                hist_data = json.loads(hist_resp)
-                                hist = hist_data.get('messages', [])
-                                with self.chats_lock:
-                                    self.chats[other] = hist
-                                if self.current_chat == other:
-                                    self.event_queue.put(("display_chat", None))
-                            except Exception:
-                                continue
-                    except Exception:
-                        pass
+                        self.codec = get_codec(data.get("codec", "json"))
+                    except CodecError:
+                        self.codec = JSON
+                    self.cache = cache
+                    if cached_users:
+                        with self.users_lock:
+                            self.all_users = cached_users
+                        self.users_version = cached_version
+                    for other, messages in cached_chats.items():
+                        self.history_updated(other, messages, bool(messages) and messages[0].get("seq", 1) > 1)
 
-                    print(f"[LOGIN] Загруженные пользователи: {self.all_users}")
                     self.create_chat_screen()
+                    self.update_chats_listbox()
+                    for msg in early:
+                        self.handle_server_message(msg)
+                    # Пользователи, чаты и последние сообщения приходят потоком кадров
+                    # и обрабатываются потоком приёма
                     self.start_receive_thread()
                     self.start_sender_thread()
                 else:
                     messagebox.showerror("Ошибка", data.get("message", ""))
+                    if cache:
+                        cache.close()
                     self.server_socket.close()
                     self.server_socket = None
             except Exception as e:
@@ -353,13 +394,10 @@ class ChatClient:
             if not self.connect_to_server():
                 return
             try:
-                self.server_socket.send(json.dumps({
-                    "action": "register",
-                    "username": username,
-                    "password": password
-                }).encode())
-                response = self.server_socket.recv(1024).decode()
-                data = json.loads(response)
+                request = {"action": "register", "username": username, "password": password}
+                self.requests.tag(request)
+                send_message(self.server_socket, request)
+                data = read_response(self.reader, request["req_id"], []) or {}
                 if data.get("status") == "success":
                     messagebox.showinfo("Успех", "Регистрация успешна!")
                     self.server_socket.close()
@@ -386,7 +424,15 @@ class ChatClient:
         
         file_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Файл", menu=file_menu)
+        file_menu.add_command(label="Поиск", command=self.search_dialog)
         file_menu.add_command(label="Выход", command=self.logout)
+
+        group_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Группа", menu=group_menu)
+        group_menu.add_command(label="Создать группу", command=self.create_group_dialog)
+        group_menu.add_command(label="Добавить участников", command=self.add_group_members_dialog)
+        group_menu.add_command(label="Участники", command=self.show_group_members)
+        group_menu.add_command(label="Покинуть группу", command=self.leave_group)
         
         main_frame = FrameWidget(self.root)
         main_frame.pack(fill=tk.BOTH, expand=True)
@@ -397,10 +443,12 @@ class ChatClient:
 
         LabelWidget(left_frame, text="Чаты", font=("Arial", 14, "bold")).pack(pady=10)
         ButtonWidget(left_frame, text="+ Новый", command=self.add_new_chat, width=150).pack(pady=6)
+        ButtonWidget(left_frame, text="+ Группа", command=self.create_group_dialog, width=150).pack(pady=6)
 
         self.chats_listbox = tk.Listbox(left_frame, height=30, width=30, font=self.font_list)
         self.chats_listbox.pack(pady=5, padx=5, fill=tk.BOTH, expand=True)
         self.chats_listbox.bind('<<ListboxSelect>>', self.on_chat_selected)
+        self.chat_list = ChatList(self.chats_listbox, title=self.chat_title)
         # Style listbox according to theme
         bg, fg, selbg = self.get_theme_colors()
         try:
@@ -427,6 +475,8 @@ class ChatClient:
             self.chat_display.configure(state=tk.DISABLED)
         except Exception:
             pass
+        self.chat_display.configure(yscrollcommand=self.on_chat_scroll)
+        self.reset_render()
         self.chat_display.pack(padx=5, pady=5, fill=tk.BOTH, expand=True)
 
         input_frame = FrameWidget(right_frame)
@@ -500,12 +550,13 @@ class ChatClient:
                 if recipient not in self.chats:
                     self.chats[recipient] = []
                 self.current_chat = recipient
+            self.chat_header.config(text=self.chat_header_text(recipient))
             # clear unread for this chat
             if recipient in self.unread_chats:
                 self.unread_chats.discard(recipient)
             self.update_chats_listbox()
             self.display_current_chat()
-            self.send_to_server({"action": "get_chat_history", "other_user": recipient})
+            self.send_to_server({"action": "get_chat_history", "other_user": recipient, "limit": HISTORY_PAGE_SIZE})
 
         users_listbox.bind('<Double-Button-1>', add_chat_from_selection)
 
@@ -529,37 +580,571 @@ class ChatClient:
         populate_listbox()
         dialog.after(150, refresh_until_found)
     
+    def chat_title(self, chat):
+        """Подпись чата в списке: название группы или имя собеседника"""
+        group = self.groups.get(chat)
+        if group:
+            return f"👥 {group.get('name')}"
+        return chat
+
+    def chat_header_text(self, chat):
+        group = self.groups.get(chat)
+        if group:
+            return f"Группа {group.get('name')}"
+        return f"Чат с {chat}"
+
+    def pick_users_dialog(self, title, exclude=(), with_name=False, on_done=None):
+        """Диалог выбора нескольких пользователей (и названия группы)"""
+        self.send_to_server({"action": "get_users"})
+        dialog = tk.Toplevel(self.root)
+        dialog.title(title)
+        dialog.geometry("320x420")
+        dialog.transient(self.root)
+
+        name_entry = None
+        if with_name:
+            tk.Label(dialog, text="Название группы:").pack(pady=(8, 2))
+            name_entry = tk.Entry(dialog)
+            name_entry.pack(fill=tk.X, padx=8)
+
+        tk.Label(dialog, text="Участники:").pack(pady=6)
+        list_frame = tk.Frame(dialog)
+        list_frame.pack(fill=tk.BOTH, expand=True, padx=8, pady=4)
+        list_scroll = tk.Scrollbar(list_frame)
+        list_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        users_listbox = tk.Listbox(list_frame, yscrollcommand=list_scroll.set, selectmode=tk.MULTIPLE)
+        users_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        list_scroll.config(command=users_listbox.yview)
+
+        def populate_listbox(retries=20):
+            with self.users_lock:
+                candidates = sorted(u for u in self.all_users if u != self.username and u not in exclude)
+            if candidates or retries == 0:
+                chosen = {users_listbox.get(i) for i in users_listbox.curselection()}
+                users_listbox.delete(0, tk.END)
+                for i, u in enumerate(candidates):
+                    users_listbox.insert(tk.END, u)
+                    if u in chosen:
+                        users_listbox.selection_set(i)
+            if not candidates and retries > 0:
+                # список пользователей ещё не пришёл
+                dialog.after(200, lambda: populate_listbox(retries - 1))
+
+        def done():
+            members = [users_listbox.get(i) for i in users_listbox.curselection()]
+            name = name_entry.get().strip() if name_entry is not None else None
+            if with_name and not name:
+                messagebox.showwarning("Внимание", "Укажите название группы", parent=dialog)
+                return
+            dialog.destroy()
+            on_done(name, members)
+
+        tk.Button(dialog, text="Готово", command=done, width=15).pack(pady=8)
+        populate_listbox()
+
+    def create_group_dialog(self):
+        def create(name, members):
+            self.send_to_server({"action": "create_group", "name": name, "members": members})
+        self.pick_users_dialog("Новая группа", with_name=True, on_done=create)
+
+    def add_group_members_dialog(self):
+        group = self.groups.get(self.current_chat)
+        if not group:
+            messagebox.showwarning("Внимание", "Откройте чат группы!")
+            return
+        def add(name, members):
+            if members:
+                self.send_to_server({"action": "add_group_members", "group": group["key"], "members": members})
+        self.pick_users_dialog(f"Добавить в {group.get('name')}", exclude=group.get("members", ()), on_done=add)
+
+    def show_group_members(self):
+        group = self.groups.get(self.current_chat)
+        if not group:
+            messagebox.showwarning("Внимание", "Откройте чат группы!")
+            return
+        if "members" not in group:
+            # из сводок чатов известно только название; состав придёт ответом
+            self.send_to_server({"action": "get_group", "group": group["key"]})
+            messagebox.showinfo("Участники", "Загружаю состав группы, повторите через секунду")
+            return
+        members = "\n".join(f"{m} (владелец)" if m == group.get("owner") else m for m in group["members"])
+        messagebox.showinfo(f"Группа {group.get('name')}", members)
+
+    def leave_group(self):
+        group = self.groups.get(self.current_chat)
+        if not group:
+            messagebox.showwarning("Внимание", "Откройте чат группы!")
+            return
+        if group.get("owner") == self.username:
+            messagebox.showwarning("Внимание", "Владелец не может выйти из группы")
+            return
+        if messagebox.askyesno("Группа", f"Покинуть группу {group.get('name')}?"):
+            self.send_to_server({"action": "remove_group_member", "group": group["key"]})
+
+    def apply_group(self, group):
+        """Ответ на действие с группой или push group_updated: новый состав группы"""
+        key = group.get("key")
+        if not key:
+            return
+        if self.username not in group.get("members", [self.username]):
+            # ответ на выход из группы
+            self.drop_group(key)
+            return
+        created = key not in self.groups
+        self.groups[key] = group
+        with self.chats_lock:
+            self.chats.setdefault(key, [])
+        if created:
+            self.touch_chat(key)
+        self.event_queue.put(("update_chats_list", None))
+
+    def drop_group(self, key):
+        """Нас удалили из группы (или мы вышли): чат пропадает из списка"""
+        self.groups.pop(key, None)
+        with self.chats_lock:
+            self.chats.pop(key, None)
+        self.unread_chats.discard(key)
+        self.chat_activity.pop(key, None)
+        self.event_queue.put(("update_chats_list", None))
+        if self.current_chat == key:
+            self.event_queue.put(("close_chat", None))
+
+    def note_group(self, summary):
+        """Название группы из сводки чата; состав запрашивается через get_group"""
+        group = summary.get("group")
+        key = summary.get("user")
+        if group and key not in self.groups:
+            self.groups[key] = {"key": key, "id": group.get("id"), "name": group.get("name")}
+
+    def close_current_chat(self):
+        if self.current_chat is None or self.current_chat in self.chats:
+            return
+        self.current_chat = None
+        self.chat_header.config(text="Выберите чат")
+        self.display_current_chat()
+
+    def show_connection_state(self, state):
+        """Обрыв связи: модель переподключается сама; если сессия истекла — снова вход"""
+        if state == "reconnecting":
+            self.root.title("NeuroChat - Мессенджер (переподключение...)")
+            return
+        self.root.title("NeuroChat - Мессенджер")
+        if state == "expired":
+            messagebox.showwarning("Соединение", "Сессия истекла, войдите снова")
+            self.logout()
+
+    def search_dialog(self):
+        """Поиск по своим сообщениям: во всех чатах или только в открытом"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Поиск")
+        dialog.geometry("520x420")
+        dialog.transient(self.root)
+
+        query_entry = tk.Entry(dialog)
+        query_entry.pack(fill=tk.X, padx=8, pady=(8, 4))
+        only_current = tk.BooleanVar(value=False)
+        if self.current_chat:
+            tk.Checkbutton(dialog, text=f"Только в чате {self.chat_title(self.current_chat)}",
+                           variable=only_current).pack(anchor=tk.W, padx=8)
+
+        list_frame = tk.Frame(dialog)
+        list_frame.pack(fill=tk.BOTH, expand=True, padx=8, pady=4)
+        list_scroll = tk.Scrollbar(list_frame)
+        list_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        results_listbox = tk.Listbox(list_frame, yscrollcommand=list_scroll.set)
+        results_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        list_scroll.config(command=results_listbox.yview)
+        more_button = tk.Button(dialog, text="Ещё", state=tk.DISABLED, width=15)
+        more_button.pack(pady=6)
+
+        # Состояние диалога: ответы сверяются с ним, устаревшие отбрасываются
+        search = {"dialog": dialog, "listbox": results_listbox, "more": more_button,
+                  "results": [], "query": None, "chat": None, "next": None}
+        chat = self.current_chat
+
+        def run(before=None):
+            if before is None:
+                query = query_entry.get().strip()
+                if not query:
+                    return
+                search.update(query=query, chat=chat if only_current.get() else None, results=[])
+                results_listbox.delete(0, tk.END)
+            request = {"action": "search_messages", "query": search["query"]}
+            if search["chat"]:
+                request["chat"] = search["chat"]
+            if before is not None:
+                request["before"] = before
+            more_button.config(state=tk.DISABLED)
+            self.requests.add(request).add_done_callback(
+                lambda f: None if f.exception() else self.event_queue.put(("search_results", (search, f.result()))))
+            self.send_to_server(request)
+
+        def open_result(event=None):
+            selection = results_listbox.curselection()
+            if selection and selection[0] < len(search["results"]):
+                self.open_chat(search["results"][selection[0]]["chat"])
+
+        query_entry.bind("<Return>", lambda event: run())
+        results_listbox.bind("<Double-Button-1>", open_result)
+        more_button.config(command=lambda: run(search["next"]))
+        query_entry.focus_set()
+
+    def show_search_results(self, search, reply):
+        if not search["dialog"].winfo_exists() or reply.get("query") != search["query"]:
+            return
+        if reply.get("status") != "success":
+            search["listbox"].insert(tk.END, reply.get("message", "Ошибка поиска"))
+            return
+        for result in reply.get("results", []):
+            text = str(result.get("text")).replace("\n", " ")[:80]
+            search["listbox"].insert(
+                tk.END, f"[{self.chat_title(result['chat'])}] {result.get('sender')}: {text}")
+            search["results"].append(result)
+        if not search["results"]:
+            search["listbox"].insert(tk.END, "Ничего не найдено")
+        search["next"] = reply.get("next_cursor")
+        search["more"].config(state=tk.NORMAL if reply.get("has_more") else tk.DISABLED)
+
+    def open_chat(self, chat):
+        """Открывает чат (например, из результатов поиска)"""
+        with self.chats_lock:
+            self.chats.setdefault(chat, [])
+        self.current_chat = chat
+        self.chat_header.config(text=self.chat_header_text(chat))
+        self.unread_chats.discard(chat)
+        self.note_read(chat)
+        self.update_chats_listbox()
+        self.display_current_chat()
+        self.send_to_server({"action": "get_chat_history", "other_user": chat, "limit": HISTORY_PAGE_SIZE})
+
     def on_chat_selected(self, event):
         selection = self.chats_listbox.curselection()
         if selection:
-            sel_text = self.chats_listbox.get(selection[0])
-            # remove unread marker if present
-            if sel_text.startswith("🔴 "):
-                sel_text = sel_text[2:]
-            self.current_chat = sel_text
-            self.chat_header.config(text=f"Чат с {self.current_chat}")
-            # clear unread
-            if self.current_chat in self.unread_chats:
-                self.unread_chats.discard(self.current_chat)
-            self.update_chats_listbox()
-            self.display_current_chat()
-            self.send_to_server({"action": "get_chat_history", "other_user": self.current_chat})
+            user = self.chat_list.user_at(selection[0])
+            if user is None:
+                return
+            self.open_chat(user)
     
-    def display_current_chat(self):
-        if not self.current_chat:
+    @staticmethod
+    def message_key(msg):
+        """Идентичность сообщения в окне: его id (свои сообщения получают id
+        ещё до отправки), иначе seq, иначе сам объект"""
+        if msg.get("id"):
+            return msg["id"]
+        seq = msg.get("seq")
+        return seq if seq is not None else ("local", id(msg))
+
+    @staticmethod
+    def message_lines(msg):
+        return str(msg.get("text")).count("\n") + 1
+
+    def format_message(self, msg):
+        sender = msg.get("sender")
+        prefix = "Вы" if sender == self.username else sender
+        return f"[{msg.get('timestamp')}] {prefix}: {msg.get('text')}{self.receipt_mark(msg)}\n"
+
+    def receipt_mark(self, msg):
+        """Отметка в конце своего сообщения: ✓ доставлено, ✓✓ прочитано, ✗ не отправлено"""
+        if msg.get("sender") != self.username:
+            return ""
+        if msg.get("failed"):
+            return " ✗"
+        seq = msg.get("seq")
+        receipt = self.receipts.get(self.current_chat)
+        if seq is None or not receipt:
+            return ""
+        if receipt["read"] >= seq:
+            return " ✓✓"
+        if receipt["delivered"] >= seq:
+            return " ✓"
+        return ""
+
+    def reset_render(self):
+        # Окно чата показывает messages[_render_start:_render_start + len(_render_keys)]
+        self._render_chat = None
+        self._render_start = 0
+        self._render_keys = []
+        self._render_lines = []
+        self._render_marks = []
+        self._render_total = 0
+
+    def display_current_chat(self, keep_top=0):
+        """Показывает текущий чат, перерисовывая только изменившееся.
+
+        В окне не больше MAX_RENDERED_MESSAGES сообщений подряд. Новые
+        сообщения дописываются в конец, keep_top сообщений, добавленных в
+        начало истории, вставляются сверху. Полностью окно перерисовывается
+        только при смене чата или замене истории."""
+        chat = self.current_chat
+        if not chat:
+            return
+        with self.chats_lock:
+            messages = list(self.chats.get(chat, []))
+        start = self._render_start + keep_top
+        end = start + len(self._render_keys)
+        if (chat != self._render_chat or end > len(messages)
+                or [self.message_key(m) for m in messages[start:end]] != self._render_keys):
+            self.render_window(chat, messages)
             return
+
+        self._render_start = start
+        self.chat_display.config(state=tk.NORMAL)
+        if keep_top:
+            added = self._insert_top(messages[start - keep_top:start])
+            self.chat_display.yview(f"{added + 1}.0")
+            self._trim(messages, keep_bottom=False)
+            end = self._render_start + len(self._render_keys)
+        if end == self._render_total and len(messages) > end:
+            at_bottom = self.chat_display.yview()[1] >= 1.0
+            self._insert_bottom(messages[end:])
+            self._trim(messages, keep_bottom=at_bottom)
+            if at_bottom:
+                self.chat_display.see(tk.END)
+        self._render_total = len(messages)
+        self.chat_display.config(state=tk.DISABLED)
+
+    def render_window(self, chat, messages):
+        """Полная перерисовка: последние MAX_RENDERED_MESSAGES сообщений чата"""
         self.chat_display.config(state=tk.NORMAL)
         self.chat_display.delete("1.0", tk.END)
-        with self.chats_lock:
-            messages = self.chats.get(self.current_chat, [])
-            for msg in messages:
-                sender = msg.get("sender")
-                text = msg.get("text")
-                ts = msg.get("timestamp")
-                prefix = "Вы" if sender == self.username else sender
-                self.chat_display.insert(tk.END, f"[{ts}] {prefix}: {text}\n")
+        self._render_chat = chat
+        self._render_start = max(0, len(messages) - MAX_RENDERED_MESSAGES)
+        self._render_keys = []
+        self._render_lines = []
+        self._render_marks = []
+        self._insert_bottom(messages[self._render_start:])
+        self._render_total = len(messages)
         self.chat_display.see(tk.END)
         self.chat_display.config(state=tk.DISABLED)
+
+    def _insert_top(self, chunk):
+        """Вставляет сообщения над окном; возвращает число добавленных строк"""
+        self.chat_display.insert("1.0", "".join(self.format_message(m) for m in chunk))
+        self._render_start -= len(chunk)
+        self._render_keys[:0] = [self.message_key(m) for m in chunk]
+        lines = [self.message_lines(m) for m in chunk]
+        self._render_lines[:0] = lines
+        self._render_marks[:0] = [self.receipt_mark(m) for m in chunk]
+        return sum(lines)
+
+    def _insert_bottom(self, chunk):
+        self.chat_display.insert(tk.END, "".join(self.format_message(m) for m in chunk))
+        self._render_keys.extend(self.message_key(m) for m in chunk)
+        self._render_lines.extend(self.message_lines(m) for m in chunk)
+        self._render_marks.extend(self.receipt_mark(m) for m in chunk)
+
+    def _trim(self, messages, keep_bottom):
+        """Убирает из окна сообщения сверх MAX_RENDERED_MESSAGES с дальнего от
+        пользователя края, не сдвигая видимую часть"""
+        excess = len(self._render_keys) - MAX_RENDERED_MESSAGES
+        if excess <= 0:
+            return
+        if keep_bottom:
+            top_line = int(self.chat_display.index("@0,0").split(".")[0])
+            removed = sum(self._render_lines[:excess])
+            self.chat_display.delete("1.0", f"{removed + 1}.0")
+            del self._render_keys[:excess]
+            del self._render_lines[:excess]
+            del self._render_marks[:excess]
+            self._render_start += excess
+            self.chat_display.yview(f"{max(1, top_line - removed)}.0")
+        else:
+            kept = sum(self._render_lines[:-excess])
+            self.chat_display.delete(f"{kept + 1}.0", tk.END)
+            del self._render_keys[-excess:]
+            del self._render_lines[-excess:]
+            del self._render_marks[-excess:]
+
+    def refresh_receipts(self):
+        """Обновляет отметки доставки у уже нарисованных сообщений на месте"""
+        chat = self.current_chat
+        if not chat or chat != self._render_chat:
+            return
+        with self.chats_lock:
+            messages = list(self.chats.get(chat, []))
+        start = self._render_start
+        window = messages[start:start + len(self._render_keys)]
+        if [self.message_key(m) for m in window] != self._render_keys:
+            # Окно устарело; display_chat перерисует его с новыми отметками
+            return
+        self.chat_display.config(state=tk.NORMAL)
+        line = 1
+        for i, msg in enumerate(window):
+            mark = self.receipt_mark(msg)
+            old = self._render_marks[i]
+            if mark != old:
+                # Отметка стоит в конце последней строки сообщения
+                last = line + self._render_lines[i] - 1
+                if old:
+                    self.chat_display.delete(f"{last}.end - {len(old)}c", f"{last}.end")
+                if mark:
+                    self.chat_display.insert(f"{last}.end", mark)
+                self._render_marks[i] = mark
+            line += self._render_lines[i]
+        self.chat_display.config(state=tk.DISABLED)
+
+    def render_adjacent(self, older):
+        """Дорисовывает RENDER_CHUNK уже загруженных сообщений у края окна.
+        Возвращает False, если с этой стороны локальная история кончилась."""
+        chat = self.current_chat
+        if not chat or chat != self._render_chat:
+            return False
+        with self.chats_lock:
+            messages = list(self.chats.get(chat, []))
+        start = self._render_start
+        end = start + len(self._render_keys)
+        if older and start > 0:
+            self.chat_display.config(state=tk.NORMAL)
+            added = self._insert_top(messages[max(0, start - RENDER_CHUNK):start])
+            self.chat_display.yview(f"{added + 1}.0")
+            self._trim(messages, keep_bottom=False)
+        elif not older and end < len(messages):
+            self.chat_display.config(state=tk.NORMAL)
+            self._insert_bottom(messages[end:end + RENDER_CHUNK])
+            self._trim(messages, keep_bottom=True)
+        else:
+            return False
+        self._render_total = len(messages)
+        self.chat_display.config(state=tk.DISABLED)
+        return True
+
+    def on_chat_scroll(self, first, last):
+        """yscrollcommand окна чата: у краёв дорисовываем сообщения, а у
+        верхнего края, когда локальная история кончилась, просим старую у сервера"""
+        self.chat_display.vbar.set(first, last)
+        if float(first) <= 0.0:
+            if not self.render_adjacent(older=True):
+                self.request_older_history()
+        elif float(last) >= 1.0:
+            self.render_adjacent(older=False)
+
+    def request_older_history(self):
+        chat = self.current_chat
+        if not chat or chat in self.history_loading or not self.history_more.get(chat):
+            return
+        with self.chats_lock:
+            seqs = [m["seq"] for m in self.chats.get(chat, []) if m.get("seq") is not None]
+        if not seqs:
+            return
+        self.history_loading.add(chat)
+        request = {"action": "get_chat_history", "other_user": chat,
+                   "before": min(seqs), "limit": HISTORY_PAGE_SIZE}
+        # Без ответа (таймаут, обрыв) страницу можно будет запросить снова
+        self.requests.add(request).add_done_callback(lambda f: self.history_loading.discard(chat))
+        self.send_to_server(request)
+
+    def apply_history_page(self, msg):
+        """Вливает страницу chat_history в локальную историю"""
+        other = msg.get("other_user")
+        with self.chats_lock:
+            merged = merge_history(self.chats.get(other, []), msg.get("messages", []),
+                                   older=msg.get("before") is not None)
+        self.cache_messages(other, msg.get("messages", []))
+        self.acks.note(other, delivered=last_seq(msg.get("messages", []), sender=other))
+        merge_receipt(self.receipts, other, msg.get("receipt"))
+        more = self.history_more.get(other, False)
+        if msg.get("after") is None:
+            more = bool(msg.get("has_more"))
+        elif msg.get("has_more") and msg.get("next_cursor") is not None:
+            # Догоняем чат после известного seq: следующая страница вперёд
+            self.send_to_server({"action": "get_chat_history", "other_user": other,
+                                 "after": msg["next_cursor"], "limit": HISTORY_PAGE_SIZE})
+        self.history_updated(other, merged, more)
+
+    def apply_pending(self, msg):
+        """Добавляет сообщения, пришедшие пока клиент был офлайн, и подтверждает их"""
+        by_sender = {}
+        for m in msg.get("messages", []):
+            by_sender.setdefault(m.get("sender"), []).append(m)
+        for sender, messages in by_sender.items():
+            with self.chats_lock:
+                chat = self.chats.setdefault(sender, [])
+                fresh = [m for m in messages if append_unique(chat, m)]
+            if not fresh:
+                continue
+            self.cache_messages(sender, fresh)
+            self.touch_chat(sender)
+            self.acks.note(sender, delivered=last_seq(fresh))
+            if sender != self.current_chat:
+                self.unread_chats.add(sender)
+        self.event_queue.put(("update_chats_list", None))
+        if self.current_chat in by_sender:
+            self.event_queue.put(("display_chat", None))
+        # Сервер удаляет подтверждённое из очереди и присылает следующую порцию
+        self.send_to_server({"action": "ack_pending", "cursor": msg.get("cursor")})
+
+    def apply_chat_summaries(self, summaries):
+        """Заполняет список чатов по сводкам get_my_chats (последнее сообщение и непрочитанные)"""
+        for summary in summaries:
+            other = summary.get("user")
+            last = summary.get("last_message")
+            self.note_group(summary)
+            if not other or not last:
+                continue
+            with self.chats_lock:
+                merged = merge_history(self.chats.get(other, []), [last])
+            if summary.get("unread"):
+                self.unread_chats.add(other)
+            self.touch_chat(other, summary.get("last_activity"))
+            merge_receipt(self.receipts, other, summary.get("receipt"))
+            self.history_updated(other, merged, last.get("seq", 1) > 1)
+
+    def cache_messages(self, other, messages):
+        if not self.cache:
+            return
+        try:
+            self.cache.store_messages(other, messages)
+        except Exception:
+            # Кеш — только ускорение, ошибки не должны мешать переписке
+            pass
+
+    def history_updated(self, other, messages, has_more):
+        """Сохраняет новую историю чата и обновляет окно, если чат открыт"""
+        with self.chats_lock:
+            known = [m["seq"] for m in self.chats.get(other, []) if m.get("seq") is not None]
+            oldest = min(known) if known else None
+            prepended = 0
+            if oldest is not None:
+                prepended = sum(1 for m in messages if m.get("seq") is not None and m["seq"] < oldest)
+            self.chats[other] = messages
+        self.history_more[other] = has_more
+        self.history_loading.discard(other)
+        # Новый чат или сдвиг по активности; список меняется точечно
+        self.event_queue.put(("update_chats_list", None))
+        if self.current_chat == other:
+            self.note_read(other)
+            self.event_queue.put(("display_chat", prepended))
+            self.event_queue.put(("refresh_receipts", None))
+
+    def note_read(self, other):
+        """Открытый чат прочитан до последнего сообщения"""
+        with self.chats_lock:
+            seq = last_seq(self.chats.get(other, []))
+        if seq:
+            self.acks.note(other, read=seq)
+
+    def apply_sent(self, msg):
+        """Ответ на send_message: своё сообщение получает seq или помечается неотправленным"""
+        other = msg.get("recipient")
+        with self.chats_lock:
+            echo = next((m for m in reversed(self.chats.get(other, [])) if m.get("id") == msg.get("id")), None)
+            if echo is None:
+                return
+            if msg.get("status") == "success":
+                echo["seq"] = msg.get("seq")
+                echo["timestamp"] = msg.get("timestamp", echo["timestamp"])
+            else:
+                echo["failed"] = True
+        if echo.get("seq") is not None:
+            self.cache_messages(other, [echo])
+        if other == self.current_chat:
+            self.event_queue.put(("refresh_receipts", None))
+
+    def apply_receipts(self, receipts):
+        """Отметки собеседников: до какого seq наши сообщения доставлены и прочитаны"""
+        for receipt in receipts:
+            if merge_receipt(self.receipts, receipt.get("user"), receipt) and receipt.get("user") == self.current_chat:
+                self.event_queue.put(("refresh_receipts", None))
     
     def send_message(self):
         if not self.current_chat:
@@ -568,35 +1153,33 @@ class ChatClient:
         text = self.message_entry.get("1.0", tk.END).strip()
         if not text:
             return
-        self.send_to_server({"action": "send_message", "recipient": self.current_chat, "text": text})
-        msg = {"sender": self.username, "text": text, "timestamp": datetime.now().strftime("%H:%M:%S")}
+        # id выбираем сами: по нему ответ сервера находит это сообщение
+        message_id = uuid.uuid4().hex
+        self.send_to_server({"action": "send_message", "recipient": self.current_chat, "text": text, "id": message_id})
+        msg = {"sender": self.username, "text": text, "timestamp": datetime.now().strftime("%H:%M:%S"),
+               "id": message_id}
         with self.chats_lock:
             if self.current_chat not in self.chats:
                 self.chats[self.current_chat] = []
             self.chats[self.current_chat].append(msg)
+        self.touch_chat(self.current_chat)
+        self.update_chats_listbox()
         self.display_current_chat()
         self.message_entry.delete("1.0", tk.END)
     
+    def touch_chat(self, user, when=None):
+        """Отмечает активность в чате; список чатов упорядочен по ней"""
+        when = when if when is not None else time.time()
+        if when > self.chat_activity.get(user, 0):
+            self.chat_activity[user] = when
+
     def update_chats_listbox(self):
-        self.chats_listbox.delete(0, tk.END)
+        """Приводит список чатов к текущему состоянию точечными изменениями строк"""
+        if self.chat_list is None:
+            return
         with self.chats_lock:
-            for user in sorted(self.chats.keys()):
-                label = user
-                if user in self.unread_chats:
-                    # prepend red dot indicator
-                    label = "🔴 " + label
-                self.chats_listbox.insert(tk.END, label)
-        # Try to color unread items red if supported
-        try:
-            for idx in range(self.chats_listbox.size()):
-                text = self.chats_listbox.get(idx)
-                if text.startswith("🔴 "):
-                    try:
-                        self.chats_listbox.itemconfig(idx, fg="#ff4d4d")
-                    except Exception:
-                        pass
-        except Exception:
-            pass
+            users = list(self.chats)
+        self.chat_list.update(users, self.chat_activity, self.unread_chats, selected=self.current_chat)
     
     def start_receive_thread(self):
         self.receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
@@ -609,65 +1192,112 @@ class ChatClient:
     def receive_messages(self):
         while self.running and self.server_socket:
             try:
-                # БЕЗ блокировки - recv() сам по себе атомарный на уровне ОС
-                data = self.server_socket.recv(1024).decode()
-                if not data:
+                # Читатель собирает кадры из потока байт и хранит лишние между вызовами
+                msg = self.reader.read_message()
+                if msg is None:
                     break
-                msg = json.loads(data)
-                
-                if msg.get("action") == "receive_message":
-                    sender = msg.get("sender")
-                    text = msg.get("text")
-                    ts = msg.get("timestamp")
-                    msg_data = {"sender": sender, "text": text, "timestamp": ts}
-                    with self.chats_lock:
-                        if sender not in self.chats:
-                            self.chats[sender] = []
-                        # dedupe: avoid inserting exact duplicate of last message
-                        last = self.chats[sender][-1] if self.chats[sender] else None
-                        if not last or not (last.get('sender') == msg_data.get('sender') and last.get('text') == msg_data.get('text') and last.get('timestamp') == msg_data.get('timestamp')):
-                            self.chats[sender].append(msg_data)
-                    # Mark unread if not viewing this chat or app not focused
-                    focused = (self.root.focus_displayof() is not None)
-                    minimized = False
-                    try:
-                        minimized = (str(self.root.state()) == 'iconic')
-                    except Exception:
-                        minimized = False
-                    if self.current_chat != sender or (not focused) or minimized:
-                        self.unread_chats.add(sender)
-                        # send desktop notification if possible
-                        try:
-                            if plyer_notify:
-                                plyer_notify.notify(title=f"New message from {sender}", message=text, timeout=5)
-                        except Exception:
-                            pass
-                    # Update UI
-                    self.event_queue.put(("update_chats_list", None))
-                    if self.current_chat == sender:
-                        # If currently viewing, clear unread mark
-                        if sender in self.unread_chats:
-                            self.unread_chats.discard(sender)
-                        self.event_queue.put(("display_chat", None))
-                
-                elif msg.get("action") == "chat_history":
-                    other = msg.get("other_user")
-                    hist = msg.get("messages", [])
-                    with self.chats_lock:
-                        self.chats[other] = hist
-                        if self.current_chat == other:
-                            self.event_queue.put(("display_chat", None))
-                elif msg.get("action") == "users_list":
-                    users = msg.get("users", [])
-                    with self.users_lock:
-                        self.all_users = users
-                    print(f"[RECEIVE] Обновлён список пользователей: {self.all_users}")
-                    # UI dialogs check the cache periodically; also signal update if needed
-                    self.event_queue.put(("update_chats_list", None))
+                self.requests.resolve(msg)
+                self.handle_server_message(msg)
             except Exception as e:
                 if self.running:
                     print(f"[RECEIVE] {e}")
                 break
+        self.requests.fail_all(ConnectionError("соединение закрыто"))
+
+    def show_incoming_messages(self, incoming):
+        """Отмечает непрочитанные чаты и показывает уведомления; вызывается в потоке Tk"""
+        # Mark unread if not viewing this chat or app not focused
+        focused = (self.root.focus_displayof() is not None)
+        try:
+            minimized = (str(self.root.state()) == 'iconic')
+        except Exception:
+            minimized = False
+        for chat, msg_data in incoming:
+            if self.current_chat != chat or (not focused) or minimized:
+                self.unread_chats.add(chat)
+                # send desktop notification if possible
+                try:
+                    if plyer_notify:
+                        title = f"New message from {msg_data['sender']}"
+                        if chat != msg_data["sender"]:
+                            title += f" in {self.chat_title(chat)}"
+                        plyer_notify.notify(title=title, message=msg_data["text"], timeout=5)
+                except Exception:
+                    pass
+            if self.current_chat == chat:
+                # If currently viewing, clear unread mark
+                if chat in self.unread_chats:
+                    self.unread_chats.discard(chat)
+                else:
+                    self.acks.note(chat, read=msg_data["seq"])
+                self.event_queue.put(("display_chat", None))
+        # Update UI
+        self.event_queue.put(("update_chats_list", None))
+
+    def handle_server_message(self, msg):
+        """Обрабатывает один кадр от сервера (ответ или push)"""
+        if msg.get("action") == "receive_message":
+            sender = msg.get("sender")
+            text = msg.get("text")
+            ts = msg.get("timestamp")
+            msg_data = {"sender": sender, "text": text, "timestamp": ts,
+                        "seq": msg.get("seq"), "id": msg.get("id")}
+            # Сообщение в группу попадает в чат группы, а не отправителя
+            chat = msg.get("group") or sender
+            with self.chats_lock:
+                if chat not in self.chats:
+                    self.chats[chat] = []
+                # повтор уже известного сообщения (по seq) пропускаем
+                if not append_unique(self.chats[chat], msg_data):
+                    return
+            self.cache_messages(chat, [msg_data])
+            self.touch_chat(chat)
+            self.acks.note(chat, delivered=msg_data["seq"])
+            # Фокус окна и открытый чат проверяются в потоке Tk
+            self.event_queue.put(("incoming_messages", [(chat, msg_data)]))
+
+        elif msg.get("action") == "chat_history":
+            self.apply_history_page(msg)
+        elif msg.get("action") == "users_list":
+            users = msg.get("users", [])
+            with self.users_lock:
+                self.all_users = users
+            print(f"[RECEIVE] Обновлён список пользователей: {self.all_users}")
+            # UI dialogs check the cache periodically; also signal update if needed
+            self.event_queue.put(("update_chats_list", None))
+        elif msg.get("action") == "pending":
+            self.apply_pending(msg)
+        elif msg.get("action") == "message_sent":
+            self.apply_sent(msg)
+        elif msg.get("action") == "receipts":
+            self.apply_receipts(msg.get("receipts", []))
+        elif msg.get("action") in ("group", "group_updated"):
+            if msg.get("group"):
+                self.apply_group(msg["group"])
+            elif msg.get("status") == "error":
+                print(f"[GROUP] {msg.get('message')}")
+        elif msg.get("action") == "group_removed":
+            self.drop_group(msg.get("group"))
+        elif msg.get("action") == "my_chats":
+            self.apply_chat_summaries(msg.get("summaries", []))
+        elif msg.get("action") == "bootstrap":
+            if "users" in msg:
+                with self.users_lock:
+                    self.all_users = msg["users"]
+            self.users_version = msg.get("users_version")
+            if "users" in msg and self.cache:
+                try:
+                    self.cache.store_users(msg["users"], self.users_version)
+                except Exception:
+                    pass
+            # Последние сообщения идут следом кадрами chat_history
+            for summary in msg.get("summaries", []):
+                self.note_group(summary)
+                if summary.get("unread"):
+                    self.unread_chats.add(summary.get("user"))
+                self.touch_chat(summary.get("user"), summary.get("last_activity"))
+                merge_receipt(self.receipts, summary.get("user"), summary.get("receipt"))
+            self.event_queue.put(("update_chats_list", None))
     
     def logout(self):
         self.running = False
@@ -676,11 +1306,24 @@ class ChatClient:
                 self.server_socket.close()
             except:
                 pass
+        if self.cache:
+            try:
+                self.cache.close()
+            except Exception:
+                pass
+            self.cache = None
         self.username = None
         self.server_socket = None
+        self.reader = None
+        self.codec = JSON
         self.current_chat = None
         self.chats = {}
         self.all_users = []
+        self.chat_activity.clear()
+        self.chat_list = None
+        self.acks.cancel()
+        self.receipts.clear()
+        self.groups.clear()
         self.create_login_screen()
     
     def clear_window(self):
@@ -0,0 +1,307 @@
+"""
+Headless asyncio client for bots, bridges and load tools.
+One `AsyncChatClient` is one connection: a reader task and a write buffer,
+no threads, so thousands of sessions can share one event loop.
+
+Requests get a `req_id` of their own ("a1", "a2", ... so they never clash
+with ids chosen by a wrapper such as `ChatModel`) and are awaited directly:
+
+    client = AsyncChatClient(host, port)
+    await client.connect()
+    reply = await client.login("bot", "secret")
+    await client.send("alice", "hello")
+    page = await client.history("alice")
+    async for event in client:
+        ...
+
+A frame that answers one of the client's own requests completes that
+request; every other frame (pushes, intermediate frames of a streamed
+response, responses to ids chosen by the caller) is an event. Events go to
+the `on_event` callback when one is given, otherwise into a bounded queue
+read by `async for`; when the queue is full the client stops reading the
+socket, so a slow consumer slows the server down instead of growing memory.
+Offline messages (`pending`) are acknowledged once handed over, unless
+`auto_ack` is off.
+
+Login returns a session token (`client.session`). After the connection
+drops, `reconnect()` comes back with it instead of the password, retrying
+with exponential backoff and random jitter so clients cut off together do
+not return together:
+
+    await client.wait_closed()
+    reply = await client.reconnect(then=lambda: [{"action": "sync", "known": seqs}])
+"""
+import asyncio
+import itertools
+import random
+
+from protocol import FrameDecoder, encode_frame, RECV_SIZE, REQUEST_TIMEOUT
+from codec import JSON, available_codecs, get_codec, CodecError
+
+# Events held for a consumer that is not keeping up
+EVENT_QUEUE_SIZE = 10000
+# Messages per chat_history page
+HISTORY_PAGE_SIZE = 50
+# Reconnect backoff: the first attempt within this many seconds, then the
+# window doubles up to the maximum
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
+
+class AsyncChatClient:
+    """One connection to the server for use inside an asyncio event loop."""
+
+    def __init__(self, host, port, on_event=None, on_close=None,
+                 max_events=EVENT_QUEUE_SIZE, timeout=REQUEST_TIMEOUT, auto_ack=True):
+        self.host = host
+        self.port = port
+        self.on_event = on_event  # called with every event frame, in the loop
+        self.on_close = on_close  # called once when the connection is gone
+        self.timeout = timeout
+        self.auto_ack = auto_ack
+        self.username = None
+        self.session = None  # token from login, for resume after a dropped connection
+        self.codec = JSON  # codec for outgoing frames, negotiated at login
+        self.events = asyncio.Queue(max_events)
+        self._ids = itertools.count(1)
+        self._pending = {}  # req_id -> (future, final)
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._closed = None
+
+    # --- Connection ---
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._closed = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._read_loop())
+        return self
+
+    @property
+    def connected(self):
+        return self._closed is not None and not self._closed.done()
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # --- Sending ---
+    def send_frame(self, message):
+        """Queue a frame for writing without waiting (fire and forget)."""
+        if not self.connected:
+            raise ConnectionError("not connected")
+        self._writer.write(encode_frame(message, self.codec))
+
+    async def drain(self):
+        """Wait until the write buffer is below its limit."""
+        await self._writer.drain()
+
+    async def request(self, message, final=None, timeout=None):
+        """Send a request and return its response frame.
+
+        A streamed response (several frames with the same id) completes on
+        the first frame for which `final(frame)` is true; the frames before
+        it are events. Raises TimeoutError or ConnectionError.
+        """
+        future = self._expect(message, final)
+        self.send_frame(message)
+        return await self._wait(message["req_id"], future, timeout)
+
+    def _expect(self, message, final=None):
+        if "req_id" not in message:
+            message["req_id"] = f"a{next(self._ids)}"
+        future = asyncio.get_running_loop().create_future()
+        self._pending[message["req_id"]] = (future, final)
+        return future
+
+    async def _wait(self, req_id, future, timeout=None):
+        try:
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"request {req_id} timed out") from None
+        finally:
+            self._pending.pop(req_id, None)
+
+    # --- Actions ---
+    async def register(self, username, password):
+        return await self.request({"action": "register", "username": username, "password": password})
+
+    async def login(self, username, password, then=()):
+        """Log in and return the server's reply; frames in `then` (e.g. a
+        bootstrap request) go out in the same write, right after the login.
+        A busy server answers with `retry_after` seconds."""
+        reply = await self._authenticate({"action": "login", "username": username, "password": password}, then)
+        if reply.get("status") == "success":
+            self.username = username
+            self.session = reply.get("session")
+        return reply
+
+    async def resume(self, session=None, then=()):
+        """Log in again with a session token instead of the password."""
+        reply = await self._authenticate({"action": "resume", "session": session or self.session}, then)
+        if reply.get("status") == "success":
+            self.username = reply.get("username")
+        return reply
+
+    async def _authenticate(self, message, then):
+        message["codecs"] = available_codecs()
+        future = self._expect(message)
+        self._writer.write(b"".join([encode_frame(message)] + [encode_frame(m) for m in then]))
+        reply = await self._wait(message["req_id"], future)
+        if reply.get("status") == "success":
+            try:
+                self.codec = get_codec(reply.get("codec", "json"))
+            except CodecError:
+                self.codec = JSON
+        return reply
+
+    async def reconnect(self, then=None, max_attempts=None):
+        """Connect again and resume the session after the connection dropped.
+
+        Attempts are spread with full jitter: each waits a random time up to
+        a window that starts at RECONNECT_DELAY and doubles, up to
+        RECONNECT_MAX_DELAY. `then()` is called before every attempt for
+        frames to send right after the resume, e.g. a sync with the seqs
+        known by then. Returns the resume reply; an error status means the
+        session expired and a password login is needed. Raises
+        ConnectionError after `max_attempts` failed attempts.
+        """
+        if not self.session:
+            raise ConnectionError("no session to resume")
+        window = RECONNECT_DELAY
+        attempt = 0
+        while True:
+            await asyncio.sleep(random.uniform(0, window))
+            try:
+                await self.connect()
+                reply = await self.resume(then=then() if then else ())
+                if "retry_after" not in reply:
+                    return reply
+                await self.close()
+            except (OSError, TimeoutError):
+                # ConnectionError is an OSError
+                if self.connected:
+                    await self.close()
+            attempt += 1
+            if max_attempts is not None and attempt >= max_attempts:
+                raise ConnectionError(f"could not reconnect after {attempt} attempts")
+            window = min(window * 2, RECONNECT_MAX_DELAY)
+
+    async def send(self, recipient, text, message_id=None):
+        """Send a message to a user or a group key; returns `message_sent`."""
+        message = {"action": "send_message", "recipient": recipient, "text": text}
+        if message_id is not None:
+            message["id"] = message_id
+        future = self._expect(message)
+        self.send_frame(message)
+        # a bot sending in a loop waits here when the server reads slower
+        await self.drain()
+        return await self._wait(message["req_id"], future)
+
+    async def history(self, other, before=None, after=None, limit=HISTORY_PAGE_SIZE):
+        """One `chat_history` page: the newest, or older than `before`, or newer than `after`."""
+        message = {"action": "get_chat_history", "other_user": other, "limit": limit}
+        if before is not None:
+            message["before"] = before
+        if after is not None:
+            message["after"] = after
+        return await self.request(message)
+
+    async def history_pages(self, other, limit=HISTORY_PAGE_SIZE):
+        """Pages of a chat from the newest back to the first message."""
+        before = None
+        while True:
+            page = await self.history(other, before=before, limit=limit)
+            yield page
+            if not page.get("has_more") or page.get("next_cursor") is None:
+                return
+            before = page["next_cursor"]
+
+    async def search(self, query, chat=None, before=None):
+        message = {"action": "search_messages", "query": query}
+        if chat:
+            message["chat"] = chat
+        if before is not None:
+            message["before"] = before
+        return await self.request(message)
+
+    # --- Receiving ---
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            event = await self.events.get()
+            if event is not None:
+                return event
+            if self.connected:
+                # end mark of a connection that has since been resumed
+                continue
+            # put the end mark back for other readers
+            self.events.put_nowait(None)
+            raise StopAsyncIteration
+
+    async def _read_loop(self):
+        decoder = FrameDecoder()
+        error = ConnectionError("connection closed")
+        try:
+            while True:
+                data = await self._reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    if not self._resolve(frame):
+                        await self._event(frame)
+        except (OSError, ValueError) as e:
+            error = ConnectionError(str(e) or "connection closed")
+        finally:
+            self._finish(error)
+
+    def _resolve(self, frame):
+        """Complete the request `frame` answers; False if it is an event."""
+        entry = self._pending.get(frame.get("req_id"))
+        if entry is None:
+            return False
+        future, final = entry
+        if final is not None and not final(frame):
+            return False
+        del self._pending[frame["req_id"]]
+        if not future.done():
+            future.set_result(frame)
+        return True
+
+    async def _event(self, frame):
+        if self.on_event is not None:
+            self.on_event(frame)
+        else:
+            await self.events.put(frame)
+        if self.auto_ack and frame.get("action") == "pending" and frame.get("cursor") is not None:
+            self.send_frame({"action": "ack_pending", "cursor": frame["cursor"]})
+
+    def _finish(self, error):
+        for future, _ in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+        if self._writer is not None:
+            self._writer.close()
+        if not self._closed.done():
+            self._closed.set_result(None)
+        if self.on_event is None:
+            # end mark for `async for`; drop the oldest event if the queue is full
+            if self.events.full():
+                self.events.get_nowait()
+            self.events.put_nowait(None)
+        if self.on_close is not None:
+            self.on_close()
@@ -0,0 +1,130 @@
+"""
+Client-side message cache — one SQLite file per (user, server).
+Lets the GUI show the chat list and recent messages right after login and
+reconcile with the server in the background: the highest cached seq per
+chat goes into bootstrap's `known` map, so only newer messages are sent.
+The cache is size-bounded: each chat keeps its newest `max_per_chat`
+messages and the whole file at most `max_messages`.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+
+CACHE_DIR_ENV = 'NEUROCHAT_CACHE_DIR'
+DEFAULT_MAX_PER_CHAT = 1000
+DEFAULT_MAX_MESSAGES = 100000
+
+
+def default_cache_dir():
+    return os.environ.get(CACHE_DIR_ENV) or os.path.join(os.path.expanduser('~'), '.neurochat')
+
+
+def cache_path(username, host, port, directory=None):
+    key = f"{username}@{host}:{port}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+    readable = re.sub(r'[^\w.-]', '_', f"{host}_{port}_{username}")[:64]
+    return os.path.join(directory or default_cache_dir(), f"{readable}_{digest}.db")
+
+
+def open_cache(username, host, port, directory=None):
+    """Open (and trim) the cache for this user and server, or None if the
+    cache directory is unusable — the cache is only an optimisation."""
+    try:
+        cache = MessageCache(username, host, port, directory)
+        cache.evict()
+        return cache
+    except (OSError, sqlite3.Error):
+        return None
+
+
+class MessageCache:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            chat TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            id TEXT,
+            sender TEXT,
+            text TEXT,
+            timestamp TEXT,
+            PRIMARY KEY (chat, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, username, host, port, directory=None,
+                 max_per_chat=DEFAULT_MAX_PER_CHAT, max_messages=DEFAULT_MAX_MESSAGES):
+        self.path = cache_path(username, host, port, directory)
+        self.max_per_chat = max_per_chat
+        self.max_messages = max_messages
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        # receiver and UI threads both write
+        self._lock = threading.Lock()
+
+    def load(self, per_chat=None):
+        """Return (chats, users, users_version) with the newest messages per chat."""
+        limit = per_chat or self.max_per_chat
+        chats = {}
+        with self._lock:
+            chat_names = [row[0] for row in self._db.execute("SELECT DISTINCT chat FROM messages")]
+            for chat in chat_names:
+                rows = self._db.execute(
+                    "SELECT seq, id, sender, text, timestamp FROM messages"
+                    " WHERE chat = ? ORDER BY seq DESC LIMIT ?", (chat, limit)).fetchall()
+                chats[chat] = [{"seq": q, "id": i, "sender": s, "text": t, "timestamp": ts}
+                               for q, i, s, t, ts in reversed(rows)]
+            meta = dict(self._db.execute("SELECT key, value FROM meta"))
+        users = json.loads(meta["users"]) if "users" in meta else []
+        version = json.loads(meta["users_version"]) if "users_version" in meta else None
+        return chats, users, version
+
+    def store_messages(self, chat, messages):
+        """Upsert messages that carry a seq; local echoes without one are skipped."""
+        rows = [(chat, m["seq"], m.get("id"), m.get("sender"), m.get("text"), m.get("timestamp"))
+                for m in messages if m.get("seq") is not None]
+        if not rows:
+            return
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)", rows)
+            (count,) = self._db.execute("SELECT COUNT(*) FROM messages WHERE chat = ?", (chat,)).fetchone()
+            if count > self.max_per_chat:
+                self._db.execute(
+                    "DELETE FROM messages WHERE chat = ? AND seq <"
+                    " (SELECT seq FROM messages WHERE chat = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                    (chat, chat, self.max_per_chat - 1))
+
+    def store_users(self, users, version):
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [
+                ("users", json.dumps(users, ensure_ascii=False)),
+                ("users_version", json.dumps(version)),
+            ])
+
+    def evict(self):
+        """Trim the whole cache to `max_messages`, dropping the oldest seqs of
+        every chat proportionally to its size."""
+        with self._lock, self._db:
+            (total,) = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()
+            if total <= self.max_messages:
+                return
+            keep_ratio = self.max_messages / total
+            for chat, count in self._db.execute(
+                    "SELECT chat, COUNT(*) FROM messages GROUP BY chat").fetchall():
+                keep = max(1, int(count * keep_ratio))
+                self._db.execute(
+                    "DELETE FROM messages WHERE chat = ? AND seq <"
+                    " (SELECT seq FROM messages WHERE chat = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                    (chat, chat, keep - 1))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,92 @@
+"""
+Chat list of the Tk client.
+`ChatList` keeps the rows currently shown in a Listbox (user and unread
+flag per row) and brings them to a new state with the minimal
+insert/move/update/delete operations instead of rebuilding the widget.
+Chats are ordered by last activity, most recent first; `title` turns a
+chat key into its label (group chats are keyed "group:<id>").
+"""
+import tkinter as tk
+
+UNREAD_MARK = "🔴 "
+UNREAD_COLOR = "#ff4d4d"
+
+
+def order_chats(users, activity):
+    """Most recently active first; chats without known activity go last by name."""
+    return sorted(users, key=lambda user: (-activity.get(user, 0), user))
+
+
+class ChatList:
+    def __init__(self, listbox, unread_color=UNREAD_COLOR, title=None):
+        self.listbox = listbox
+        self.unread_color = unread_color
+        self.title = title or (lambda user: user)
+        # [user, unread] for every row, in display order
+        self.rows = []
+
+    def user_at(self, index):
+        if 0 <= index < len(self.rows):
+            return self.rows[index][0]
+        return None
+
+    def index_of(self, user):
+        for i, (row_user, _) in enumerate(self.rows):
+            if row_user == user:
+                return i
+        return None
+
+    def _label(self, user, unread):
+        label = self.title(user)
+        return UNREAD_MARK + label if unread else label
+
+    def _insert(self, index, user, unread):
+        self.listbox.insert(index, self._label(user, unread))
+        if unread:
+            try:
+                self.listbox.itemconfig(index, fg=self.unread_color)
+            except tk.TclError:
+                pass
+        self.rows.insert(index, [user, unread])
+
+    def _delete(self, index):
+        self.listbox.delete(index)
+        del self.rows[index]
+
+    def update(self, users, activity, unread, selected=None):
+        """Show `users` ordered by `activity` with `unread` rows marked.
+
+        Returns the number of widget operations performed.
+        """
+        target = order_chats(users, activity)
+        wanted = set(target)
+        ops = 0
+        for i in range(len(self.rows) - 1, -1, -1):
+            if self.rows[i][0] not in wanted:
+                self._delete(i)
+                ops += 1
+        for i, user in enumerate(target):
+            is_unread = user in unread
+            if i < len(self.rows) and self.rows[i][0] == user:
+                if self.rows[i][1] != is_unread:
+                    # a Listbox item cannot be edited in place
+                    self._delete(i)
+                    self._insert(i, user, is_unread)
+                    ops += 1
+                continue
+            j = self.index_of(user)
+            if j is not None:
+                self._delete(j)
+            self._insert(i, user, is_unread)
+            ops += 1
+        if selected is not None:
+            self.select(selected)
+        return ops
+
+    def select(self, user):
+        """Keep the open chat highlighted after rows moved around it."""
+        index = self.index_of(user)
+        if index is None or self.listbox.curselection() == (index,):
+            return
+        self.listbox.selection_clear(0, tk.END)
+        self.listbox.selection_set(index)
@@ -0,0 +1,125 @@
+"""
+UI event dispatcher for the Tk client.
+Background threads (receiver, model callbacks) only `put` events; the queue
+is drained on the Tk thread from `root.after`, so widgets are never touched
+from other threads. Events of a coalescing type are merged within a frame:
+a burst of 500 messages becomes one chat list update and one redraw.
+"""
+import time
+from queue import Queue, Empty
+
+# Drain period in milliseconds (about 60 frames per second)
+FRAME_MS = 16
+
+
+class UIDispatcher:
+    def __init__(self, root, interval_ms=FRAME_MS):
+        self.root = root
+        self.interval_ms = interval_ms
+        self._queue = Queue()
+        self._handlers = {}
+        self._merge = {}
+        self._after_id = None
+        # metrics
+        self.frames = 0
+        self.events = 0
+        self.coalesced = 0
+        self.last_drain_time = 0.0
+        self.max_drain_time = 0.0
+        self.total_drain_time = 0.0
+
+    def register(self, event_type, handler, coalesce=False, merge=None):
+        """Call `handler(data)` on the Tk thread for every event of this type.
+
+        With `coalesce` the events of one frame are delivered once; `merge(a, b)`
+        combines their data (by default the latest data wins).
+        """
+        self._handlers[event_type] = handler
+        if coalesce or merge is not None:
+            self._merge[event_type] = merge or (lambda old, new: new)
+
+    def put(self, event):
+        """Queue an (event_type, data) pair; safe to call from any thread."""
+        self._queue.put(event)
+
+    def post(self, event_type, data=None):
+        self._queue.put((event_type, data))
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "frames": self.frames,
+            "events": self.events,
+            "coalesced": self.coalesced,
+            "last_drain_ms": self.last_drain_time * 1000,
+            "max_drain_ms": self.max_drain_time * 1000,
+            "avg_drain_ms": self.total_drain_time * 1000 / self.frames if self.frames else 0.0,
+        }
+
+    def start(self):
+        if self._after_id is None:
+            self._after_id = self.root.after(self.interval_ms, self._tick)
+
+    def stop(self):
+        if self._after_id is not None:
+            try:
+                self.root.after_cancel(self._after_id)
+            except Exception:
+                pass
+            self._after_id = None
+
+    def _tick(self):
+        self._after_id = None
+        try:
+            self.drain()
+        finally:
+            try:
+                self._after_id = self.root.after(self.interval_ms, self._tick)
+            except Exception:
+                # the root window is gone
+                pass
+
+    def drain(self):
+        """Run every queued event once; returns the number of handler calls."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        if not batch:
+            return 0
+        start = time.perf_counter()
+        # Coalesced events keep the position of their first occurrence
+        pending = []
+        merged = {}
+        for event_type, data in batch:
+            merge = self._merge.get(event_type)
+            if merge is None:
+                pending.append([event_type, data])
+            elif event_type in merged:
+                entry = merged[event_type]
+                entry[1] = merge(entry[1], data)
+                self.coalesced += 1
+            else:
+                entry = merged[event_type] = [event_type, data]
+                pending.append(entry)
+        for event_type, data in pending:
+            handler = self._handlers.get(event_type)
+            if handler is None:
+                continue
+            try:
+                handler(data)
+            except Exception as e:
+                # widgets of a closed screen may already be destroyed
+                print(f"[UI] {event_type}: {e}")
+        elapsed = time.perf_counter() - start
+        self.frames += 1
+        self.events += len(batch)
+        self.last_drain_time = elapsed
+        self.max_drain_time = max(self.max_drain_time, elapsed)
+        self.total_drain_time += elapsed
+        return len(pending)
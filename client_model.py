@@ -2,12 +2,153 @@
 Client model (MVC) — stores app state and handles networking.
 This is a lightweight scaffold extracted from the monolithic client.
 Extend `ChatModel` with networking and persistence as needed.
+
+The connection itself is an `AsyncChatClient` (client_async.py) running on
+an event loop in one background thread; the GUI talks to the model from
+its own thread, and callbacks fire in the loop thread. When the connection
+drops the model reconnects by itself and resumes the session with its
+token; a bootstrap with the seqs already held brings only what was missed.
 """
+import asyncio
 import threading
 import socket
 import json
-from queue import Queue, Empty
-from datetime import datetime
+import time
+
+from protocol import PendingRequests
+from client_async import AsyncChatClient
+from client_cache import open_cache
+
+# Messages requested per chat_history page
+HISTORY_PAGE_SIZE = 50
+# Recent messages per chat fetched by bootstrap right after login
+BOOTSTRAP_HISTORY = 20
+# Delivered/read receipts noted within this many seconds go out in one frame
+RECEIPT_DELAY = 0.5
+# Seconds between checks for requests that outlived their timeout
+EXPIRE_INTERVAL = 1.0
+
+
+def merge_history(existing, page, older=False):
+    """Merge a `chat_history` page into a locally cached message list.
+
+    An older page (requested with `before`) goes in front of the oldest
+    known message. A newest page replaces everything from its first seq on,
+    including local echoes of sent messages that have no seq yet.
+    """
+    if older:
+        known = [m['seq'] for m in existing if m.get('seq') is not None]
+        oldest = min(known) if known else None
+        return [m for m in page if oldest is None or m['seq'] < oldest] + list(existing)
+    if not page:
+        return list(existing)
+    first, last = page[0]['seq'], page[-1]['seq']
+    head = [m for m in existing if m.get('seq') is not None and m['seq'] < first]
+    tail = [m for m in existing if m.get('seq') is not None and m['seq'] > last]
+    return head + list(page) + tail
+
+
+def append_unique(messages, message):
+    """Append a pushed message unless its seq is already in the list.
+
+    Lists are ordered by seq, so the scan stops at the first older message.
+    Returns True if the message was appended.
+    """
+    seq = message.get('seq')
+    if seq is not None:
+        for m in reversed(messages):
+            known = m.get('seq')
+            if known is None:
+                continue
+            if known == seq:
+                return False
+            if known < seq:
+                break
+    messages.append(message)
+    return True
+
+
+def known_seqs(chats):
+    """{user: highest seq held locally} for the sync/bootstrap `known` field."""
+    known = {}
+    for user, messages in chats.items():
+        seqs = [m['seq'] for m in messages if m.get('seq') is not None]
+        if seqs:
+            known[user] = max(seqs)
+    return known
+
+def merge_receipt(receipts, user, receipt):
+    """Raise the stored delivered/read seqs of `user` to `receipt`'s.
+
+    Returns True if anything moved (the view then refreshes its marks).
+    """
+    if not user or not isinstance(receipt, dict):
+        return False
+    old = receipts.get(user, {'delivered': 0, 'read': 0})
+    new = {key: max(old[key], receipt.get(key) or 0) for key in ('delivered', 'read')}
+    if new == old:
+        return False
+    receipts[user] = new
+    return True
+
+
+class ReceiptBatcher:
+    """Collects delivered/read watermarks per chat and sends them together.
+
+    Every `note` only raises a watermark; `RECEIPT_DELAY` after the first
+    one a single `ack_receipts` frame carries the latest seqs of every chat
+    that moved, however many messages arrived in between.
+    """
+
+    def __init__(self, send, delay=RECEIPT_DELAY):
+        self.send = send
+        self.delay = delay
+        self._marks = {}  # {user: [delivered, read]} noted so far
+        self._sent = {}   # {user: (delivered, read)} already sent
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def note(self, user, delivered=0, read=0):
+        if not user:
+            return
+        delivered = max(delivered or 0, read or 0)
+        with self._lock:
+            mark = self._marks.setdefault(user, [0, 0])
+            if delivered <= mark[0] and (read or 0) <= mark[1]:
+                return
+            mark[0] = max(mark[0], delivered)
+            mark[1] = max(mark[1], read or 0)
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            receipts = []
+            for user, (delivered, read) in self._marks.items():
+                if self._sent.get(user) != (delivered, read):
+                    self._sent[user] = (delivered, read)
+                    receipts.append({'user': user, 'delivered': delivered, 'read': read})
+        if receipts:
+            self.send({'action': 'ack_receipts', 'receipts': receipts})
+
+    def cancel(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._marks.clear()
+            self._sent.clear()
+
+
+def last_seq(messages, sender=None):
+    """Highest seq in a message list, optionally only among `sender`'s messages."""
+    seqs = [m['seq'] for m in messages
+            if m.get('seq') is not None and (sender is None or m.get('sender') == sender)]
+    return max(seqs) if seqs else 0
+
 
 class ChatModel:
     def __init__(self):
@@ -18,91 +159,353 @@ class ChatModel:
         self.chats = {}  # {user: [messages]}
         self.all_users = []
         self.unread = set()
+        self.activity = {}  # {user: epoch of the last message}, orders the chat list
+        self.history_more = {}  # {user: True if older history pages exist}
+        self.receipts = {}  # {user: {'delivered': seq, 'read': seq}} of our messages
+        self.users_version = None  # directory version the server last sent
+        self.groups = {}  # {'group:<id>': group info} of the groups we are in
+
+        # On-disk cache of messages per (user, server); opened at login
+        self.use_cache = True
+        self.cache = None
 
         # Networking
-        self.server_socket = None
-        self.send_queue = Queue()
+        self.loop = None    # event loop of the network thread, started on first login
+        self.client = None  # AsyncChatClient of the current connection
         self.running = False
+        self._unsent = []   # frames queued before the connection was up
+        self._unsent_lock = threading.Lock()
+        self._early = None  # frames that arrived before the login reply
+        self._expiring = False
+        self.session = None  # token from login for resuming after a dropped connection
+        self._closing = False  # stop() was called: a closed connection is not resumed
+        self._reconnect_task = None
+        # requests in flight, matched to responses by req_id
+        self.requests = PendingRequests()
+        self.bootstrapped = None  # future of the login bootstrap (bootstrap_done)
+        # our own delivered/read receipts, batched per chat
+        self.acks = ReceiptBatcher(self.send_to_server)
 
         # Callbacks (set by controller)
         self.on_receive = None    # called with message dict
         self.on_users = None      # called with users list
         self.on_history = None    # called with (other_user, messages)
+        self.on_sent = None       # called with the server's message_sent reply
+        self.on_receipts = None   # called with the users whose receipts moved
+        self.on_group = None      # called with (key, info or None when we left it)
+        self.on_connection = None  # called with 'reconnecting', 'connected' or 'expired'
 
-    # --- Networking helpers (simple scaffolding) ---
+    # --- Networking helpers ---
     def send_to_server(self, message):
-        """Place message into outgoing queue. Sender thread should send."""
-        self.send_queue.put(message)
+        """Hand a frame to the network thread; safe to call from any thread."""
+        self.requests.tag(message)
+        with self._unsent_lock:
+            if not self.running:
+                # sent once logged in
+                self._unsent.append(message)
+                return
+        self.loop.call_soon_threadsafe(self._write, message)
+
+    def request(self, message, final=None, timeout=None):
+        """Send a request and return a Future of its response.
+
+        Any number of requests can be in flight; `final` marks the last
+        frame of a streamed response (see PendingRequests.add).
+        """
+        future = self.requests.add(message, final=final, timeout=timeout)
+        self.send_to_server(message)
+        if self.running:
+            self.loop.call_soon_threadsafe(self._watch_requests)
+        return future
+
+    def _ensure_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, name='chat-network', daemon=True).start()
+        return self.loop
 
     def start(self):
-        self.running = True
-        # start sender and receiver threads
-        self._sender_thread = threading.Thread(target=self._sender_worker, daemon=True)
-        self._sender_thread.start()
-        self._receiver_thread = threading.Thread(target=self._receiver_worker, daemon=True)
-        self._receiver_thread.start()
+        """Mark the connection as up and send what was queued before it."""
+        with self._unsent_lock:
+            self.running = True
+            unsent, self._unsent = self._unsent, []
+        for message in unsent:
+            self._write(message)
+        self._watch_requests()
 
     def stop(self):
         self.running = False
+        self._closing = True
+        self.session = None
+        self.acks.cancel()
+        if self._reconnect_task is not None:
+            self.loop.call_soon_threadsafe(self._reconnect_task.cancel)
+        if self.client is not None and self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.client.close(), self.loop)
+        if self.cache:
+            try:
+                self.cache.close()
+            except Exception:
+                pass
+            self.cache = None
+
+    def _write(self, message):
         try:
-            if self.server_socket:
-                self.server_socket.close()
+            self.client.send_frame(message)
         except Exception:
+            # the connection is gone; on_close fails the waiting requests
             pass
 
-    def _sender_worker(self):
-        while self.running:
-            try:
-                msg = self.send_queue.get(timeout=1)
-                if self.server_socket:
-                    try:
-                        self.server_socket.sendall(json.dumps(msg).encode())
-                    except Exception:
-                        # ignore send errors for now
-                        pass
-            except Empty:
-                continue
+    def _watch_requests(self):
+        """Time out requests that never got an answer. Runs in the loop and
+        only while requests are in flight: an idle client does not wake up."""
+        if self._expiring:
+            return
+        self._expiring = True
+
+        def check():
+            self.requests.expire()
+            self._expiring = False
+            if len(self.requests) and self.running:
+                self._watch_requests()
+        self.loop.call_later(EXPIRE_INTERVAL, check)
+
+    def _on_frame(self, msg):
+        """Every frame from the server, in the loop thread."""
+        if self._early is not None:
+            self._early.append(msg)
+            return
+        # a response completes its future and is handled like any frame
+        self.requests.resolve(msg)
+        try:
+            self._handle_message(msg)
+        except Exception:
+            pass
+
+    def _on_close(self):
+        self.running = False
+        self.requests.fail_all(ConnectionError('connection closed'))
+        if self.session and not self._closing and self._reconnect_task is None:
+            # the connection dropped (not stop()): come back with the session token
+            self._reconnect_task = self.loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        """Resume the session; the bootstrap sent right behind the resume
+        carries the seqs held by then, so only missed messages come back."""
+        self._notify_connection('reconnecting')
+
+        def resume_frames():
+            bootstrap = {'action': 'bootstrap', 'users_version': self.users_version,
+                         'history_limit': BOOTSTRAP_HISTORY, 'known': known_seqs(self.chats)}
+            self.bootstrapped = self.requests.add(
+                bootstrap, final=lambda r: r.get('action') == 'bootstrap_done' or r.get('status') == 'error')
+            return [bootstrap]
+        try:
+            reply = await self.client.reconnect(then=resume_frames)
+        except asyncio.CancelledError:
+            # stop() during the backoff
+            return
+        finally:
+            self._reconnect_task = None
+        if reply.get('status') == 'success':
+            self.start()
+            self._notify_connection('connected')
+        else:
+            # the session expired: the user has to log in with the password
+            self.session = None
+            self.requests.fail_all(ConnectionError(reply.get('message') or 'session expired'))
+            await self.client.close()
+            self._notify_connection('expired')
 
-    def _receiver_worker(self):
-        import time
-        while self.running:
+    def _notify_connection(self, state):
+        if self.on_connection:
             try:
-                if not self.server_socket:
-                    time.sleep(0.2)
-                    continue
-                data = self.server_socket.recv(4096).decode()
-                if not data:
-                    # connection closed
-                    self.running = False
-                    break
-                msg = json.loads(data)
-                action = msg.get('action')
-                if action == 'receive_message':
-                    sender = msg.get('sender')
-                    text = msg.get('text')
-                    ts = msg.get('timestamp')
-                    m = {'sender': sender, 'text': text, 'timestamp': ts}
-                    if sender not in self.chats:
-                        self.chats[sender] = []
-                    self.chats[sender].append(m)
-                    if self.on_receive:
-                        self.on_receive(m)
-                elif action == 'chat_history':
-                    other = msg.get('other_user')
-                    hist = msg.get('messages', [])
-                    self.chats[other] = hist
-                    if self.on_history:
-                        self.on_history(other, hist)
-                elif action == 'users_list' or action == 'users':
-                    users = msg.get('users', [])
-                    self.all_users = users
-                    if self.on_users:
-                        self.on_users(users)
+                self.on_connection(state)
             except Exception:
-                time.sleep(0.2)
+                pass
+
+    def _handle_message(self, msg):
+        action = msg.get('action')
+        if action == 'receive_message':
+            sender = msg.get('sender')
+            text = msg.get('text')
+            ts = msg.get('timestamp')
+            m = {'sender': sender, 'text': text, 'timestamp': ts,
+                 'seq': msg.get('seq'), 'id': msg.get('id')}
+            # group messages belong to the group's chat, not the sender's
+            self._receive(m, msg.get('group'))
+        elif action == 'pending':
+            # messages that arrived while we were offline, oldest first
+            for m in msg.get('messages', []):
+                self._receive(m)
+            self.send_to_server({'action': 'ack_pending', 'cursor': msg.get('cursor')})
+        elif action == 'chat_history':
+            self._apply_history(msg)
+        elif action == 'message_sent':
+            if self.on_sent:
+                self.on_sent(msg)
+        elif action == 'receipts':
+            moved = [r.get('user') for r in msg.get('receipts', [])
+                     if merge_receipt(self.receipts, r.get('user'), r)]
+            if moved and self.on_receipts:
+                self.on_receipts(moved)
+        elif action == 'users_list' or action == 'users':
+            users = msg.get('users', [])
+            self.all_users = users
+            if self.on_users:
+                self.on_users(users)
+        elif action in ('group', 'group_updated'):
+            if msg.get('group'):
+                self._set_group(msg['group'])
+        elif action == 'group_removed':
+            self._drop_group(msg.get('group'))
+        elif action == 'my_chats':
+            self._apply_chat_summaries(msg.get('summaries', []))
+        elif action == 'bootstrap':
+            self._apply_bootstrap(msg)
+
+    def _receive(self, m, chat=None):
+        chat = chat or m.get('sender')
+        if chat not in self.chats:
+            self.chats[chat] = []
+        if append_unique(self.chats[chat], m):
+            self._cache_messages(chat, [m])
+            self.acks.note(chat, delivered=m.get('seq'))
+            self.activity[chat] = time.time()
+            if self.on_receive:
+                self.on_receive(dict(m, chat=chat))
+
+    def _set_group(self, info):
+        key = info.get('key')
+        if not key:
+            return
+        if self.username and self.username not in info.get('members', [self.username]):
+            # the reply to leaving a group
+            self._drop_group(key)
+            return
+        self.groups[key] = info
+        if key not in self.chats:
+            self.chats[key] = []
+            self.activity.setdefault(key, time.time())
+        if self.on_group:
+            self.on_group(key, info)
+
+    def _drop_group(self, key):
+        if key not in self.groups:
+            return
+        del self.groups[key]
+        self.chats.pop(key, None)
+        self.unread.discard(key)
+        self.activity.pop(key, None)
+        if self.on_group:
+            self.on_group(key, None)
+
+    def _note_group(self, summary):
+        """Remember a group's name from a chat summary (members come with get_group)."""
+        group = summary.get('group')
+        key = summary.get('user')
+        if group and key not in self.groups:
+            self.groups[key] = {'key': key, 'id': group.get('id'), 'name': group.get('name')}
+
+    def _cache_messages(self, other, messages):
+        if not self.cache:
+            return
+        try:
+            self.cache.store_messages(other, messages)
+        except Exception:
+            # the cache is an optimisation; never let it break messaging
+            pass
+
+    def _apply_history(self, msg):
+        other = msg.get('other_user')
+        hist = merge_history(self.chats.get(other, []), msg.get('messages', []),
+                             older=msg.get('before') is not None)
+        self.chats[other] = hist
+        self._cache_messages(other, msg.get('messages', []))
+        self.acks.note(other, delivered=last_seq(msg.get('messages', []), sender=other))
+        merge_receipt(self.receipts, other, msg.get('receipt'))
+        if msg.get('after') is None:
+            self.history_more[other] = bool(msg.get('has_more'))
+        elif msg.get('has_more') and msg.get('next_cursor') is not None:
+            # catching up after a known seq: keep paging forward
+            self.send_to_server({'action': 'get_chat_history', 'other_user': other,
+                                 'after': msg['next_cursor'], 'limit': HISTORY_PAGE_SIZE})
+        if self.on_history:
+            self.on_history(other, hist)
+
+    def _apply_chat_summaries(self, summaries):
+        """Seed chats from get_my_chats summaries: the last message is shown
+        right away, the rest of the history is paged in when a chat is opened."""
+        for summary in summaries:
+            other = summary.get('user')
+            last = summary.get('last_message')
+            self._note_group(summary)
+            if not other or not last:
                 continue
+            self.chats[other] = merge_history(self.chats.get(other, []), [last])
+            self.history_more[other] = last.get('seq', 1) > 1
+            if summary.get('unread'):
+                self.unread.add(other)
+            self._touch(other, summary.get('last_activity'))
+            merge_receipt(self.receipts, other, summary.get('receipt'))
+            if self.on_history:
+                self.on_history(other, self.chats[other])
+
+    def _touch(self, other, when):
+        if other and when and when > self.activity.get(other, 0):
+            self.activity[other] = when
+
+    def _apply_bootstrap(self, msg):
+        self.users_version = msg.get('users_version')
+        if 'users' in msg:
+            self.all_users = msg['users']
+            if self.cache:
+                try:
+                    self.cache.store_users(self.all_users, self.users_version)
+                except Exception:
+                    pass
+            if self.on_users:
+                self.on_users(self.all_users)
+        # recent messages follow as chat_history frames; only unread is needed here
+        for summary in msg.get('summaries', []):
+            self._note_group(summary)
+            if summary.get('unread'):
+                self.unread.add(summary.get('user'))
+            self._touch(summary.get('user'), summary.get('last_activity'))
+            merge_receipt(self.receipts, summary.get('user'), summary.get('receipt'))
 
     # --- High level actions ---
+    def sync(self):
+        """Ask only for messages newer than what is already held locally.
+
+        Returns a Future completed by `sync_done`."""
+        return self.request({'action': 'sync', 'known': known_seqs(self.chats)},
+                            final=lambda r: r.get('action') == 'sync_done')
+
+    def create_group(self, name, members):
+        """Create a group with us as its owner; the Future gets the `group` reply."""
+        return self.request({'action': 'create_group', 'name': name, 'members': list(members)})
+
+    def add_group_members(self, key, members):
+        return self.request({'action': 'add_group_members', 'group': key, 'members': list(members)})
+
+    def remove_group_member(self, key, username=None):
+        """Remove a member (owner only), or leave the group when `username` is None."""
+        message = {'action': 'remove_group_member', 'group': key}
+        if username:
+            message['username'] = username
+        return self.request(message)
+
+    def search(self, query, chat=None, before=None):
+        """Search our messages (only in `chat` if given); the Future gets the
+        `search_results` page, whose `next_cursor` is the next `before`."""
+        message = {'action': 'search_messages', 'query': query}
+        if chat:
+            message['chat'] = chat
+        if before is not None:
+            message['before'] = before
+        return self.request(message)
+
     def find_server(self):
         try:
             discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -118,58 +521,77 @@ class ChatModel:
         except Exception:
             return False
 
-    def connect_to_server(self):
+    async def connect_to_server(self):
         try:
             if not self.server_host or not self.server_port:
-                if not self.find_server():
+                found = await asyncio.get_running_loop().run_in_executor(None, self.find_server)
+                if not found:
                     return False
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.connect((self.server_host, self.server_port))
+            # the library acks nothing: pending frames are acked by _handle_message
+            client = AsyncChatClient(self.server_host, self.server_port, on_event=self._on_frame,
+                                     on_close=self._on_close, auto_ack=False)
+            await client.connect()
+            self.client = client
             return True
         except Exception:
             return False
 
     def login(self, username, password):
-        # Connect and perform login; returns response dict
-        if not self.connect_to_server():
+        """Connect and log in; blocks the calling thread (not the network
+        thread) and returns the server's reply dict."""
+        future = asyncio.run_coroutine_threadsafe(self.login_async(username, password), self._ensure_loop())
+        return future.result()
+
+    async def login_async(self, username, password):
+        self._closing = False
+        if not await self.connect_to_server():
             return {'status': 'error', 'message': 'server not found'}
+        cache = open_cache(username, self.server_host, self.server_port) if self.use_cache else None
+        chats, users, users_version = self.chats, self.all_users, self.users_version
+        if cache:
+            try:
+                cached_chats, cached_users, cached_version = cache.load(per_chat=HISTORY_PAGE_SIZE)
+                chats = cached_chats or chats
+                if cached_users:
+                    users, users_version = cached_users, cached_version
+            except Exception:
+                pass
         try:
-            self.server_socket.sendall(json.dumps({
-                'action': 'login', 'username': username, 'password': password
-            }).encode())
-            resp = self.server_socket.recv(4096).decode()
-            data = json.loads(resp)
+            # login and bootstrap are pipelined: one round trip for both; with a
+            # warm cache bootstrap only carries what changed since last time
+            bootstrap = {'action': 'bootstrap', 'users_version': users_version,
+                         'history_limit': BOOTSTRAP_HISTORY, 'known': known_seqs(chats)}
+            self.bootstrapped = self.requests.add(
+                bootstrap, final=lambda r: r.get('action') == 'bootstrap_done' or r.get('status') == 'error')
+            # anything arriving before the login reply is handled after it
+            self._early = early = []
+            try:
+                data = await self.client.login(username, password, then=[bootstrap])
+            finally:
+                self._early = None
             if data.get('status') == 'success':
                 self.username = username
-                # request users
-                self.server_socket.sendall(json.dumps({'action': 'get_users'}).encode())
-                users_resp = self.server_socket.recv(4096).decode()
-                users_data = json.loads(users_resp)
-                self.all_users = users_data.get('users', [])
-                # request list of chats (users with whom we have history)
-                try:
-                    self.server_socket.sendall(json.dumps({'action': 'get_my_chats'}).encode())
-                    mych_resp = self.server_socket.recv(4096).decode()
-                    mych_data = json.loads(mych_resp)
-                    chats = mych_data.get('chats', [])
-                    # initialize chat buckets and request history for each partner
-                    for other in chats:
-                        try:
-                            self.server_socket.sendall(json.dumps({'action': 'get_chat_history', 'other_user': other}).encode())
-                            hist_resp = self.server_socket.recv(8192).decode()
-                            hist_data = json.loads(hist_resp)
-                            hist = hist_data.get('messages', [])
-                            self.chats[other] = hist
-                            if self.on_history:
-                                self.on_history(other, hist)
-                        except Exception:
-                            # continue with next partner if any error
-                            continue
-                except Exception:
-                    pass
+                self.session = data.get('session')
+                self.cache = cache
+                # show cached state right away
+                self.chats, self.all_users, self.users_version = chats, users, users_version
+                if users and self.on_users:
+                    self.on_users(users)
+                for other, messages in list(chats.items()):
+                    self.history_more[other] = bool(messages) and messages[0].get('seq', 1) > 1
+                    if self.on_history:
+                        self.on_history(other, messages)
 
-                # start sender/receiver threads
+                for msg in early:
+                    self._on_frame(msg)
+                # the streamed bootstrap response is reconciled as it arrives
                 self.start()
+            else:
+                if cache:
+                    cache.close()
+                # the server rejects the pipelined bootstrap as well
+                self.requests.fail_all(ConnectionError(data.get('message') or 'login failed'))
+                await self.client.close()
             return data
         except Exception as e:
             return {'status': 'error', 'message': str(e)}
@@ -4,6 +4,7 @@ This file provides a `ChatView` class that instantiates the UI from `client.py`
 and exposes a small API to the controller.
 """
 from client import ChatClient as _RawChatClient
+from client_model import append_unique
 import tkinter as tk
 
 class ChatView:
@@ -35,6 +36,15 @@ class ChatView:
         This replaces the UI's send method to use model.send_to_server
         and registers model callbacks to update the UI state."""
         self.model = model
+        # One unread set shared by model and UI
+        self.model.unread = self.ui.unread_chats
+        self.model.activity = self.ui.chat_activity
+        # ...and one receipts map and one ack batcher, so receipts go out in one frame
+        self.model.receipts = self.ui.receipts
+        self.model.groups = self.ui.groups
+        self.ui.acks = self.model.acks
+        # requests go out through the model, so their futures live in its table
+        self.ui.requests = self.model.requests
 
         # Replace UI send_to_server with model's implementation
         try:
@@ -44,17 +54,15 @@ class ChatView:
 
         # Register callbacks
         def on_receive(m):
-            # m: {sender,text,timestamp}
-            sender = m.get('sender')
+            # m: {sender,text,timestamp,chat}; chat is the group key for group messages
+            sender = m.get('chat') or m.get('sender')
             # append to ui.chats
             try:
                 with self.ui.chats_lock:
                     if sender not in self.ui.chats:
                         self.ui.chats[sender] = []
-                    # simple dedupe: skip if identical to last message
-                    last = self.ui.chats[sender][-1] if self.ui.chats[sender] else None
-                    if not last or not (last.get('sender') == m.get('sender') and last.get('text') == m.get('text') and last.get('timestamp') == m.get('timestamp')):
-                        self.ui.chats[sender].append(m)
+                    # dedupe by seq: the model may deliver a message twice
+                    append_unique(self.ui.chats[sender], m)
             except Exception:
                 pass
             # mark unread unless current chat
@@ -68,6 +76,7 @@ class ChatView:
                 # trigger UI update
                 self.ui.event_queue.put(("update_chats_list", None))
                 if self.ui.current_chat == sender:
+                    self.ui.note_read(sender)
                     self.ui.event_queue.put(("display_chat", None))
             except Exception:
                 pass
@@ -81,15 +90,47 @@ class ChatView:
 
         def on_history(other, messages):
             try:
-                with self.ui.chats_lock:
-                    self.ui.chats[other] = messages
-                if self.ui.current_chat == other:
-                    self.ui.event_queue.put(("display_chat", None))
+                self.ui.history_updated(other, list(messages), self.model.history_more.get(other, False))
+            except Exception:
+                pass
+
+        def on_sent(reply):
+            try:
+                self.ui.apply_sent(reply)
             except Exception:
                 pass
 
+        def on_receipts(users):
+            if self.ui.current_chat in users:
+                self.ui.event_queue.put(("refresh_receipts", None))
+
+        def on_group(key, info):
+            with self.ui.chats_lock:
+                if info is None:
+                    self.ui.chats.pop(key, None)
+                else:
+                    self.ui.chats.setdefault(key, [])
+            self.ui.event_queue.put(("update_chats_list", None))
+            if info is None and self.ui.current_chat == key:
+                self.ui.event_queue.put(("close_chat", None))
+
+        def on_connection(state):
+            self.ui.event_queue.put(("connection", state))
+
+        # logging out of the UI closes the model too, or it would keep reconnecting
+        ui_logout = self.ui.logout
+
+        def logout():
+            self.model.stop()
+            ui_logout()
+        self.ui.logout = logout
+
         self.model.on_receive = on_receive
         self.model.on_users = on_users
         self.model.on_history = on_history
+        self.model.on_sent = on_sent
+        self.model.on_receipts = on_receipts
+        self.model.on_group = on_group
+        self.model.on_connection = on_connection
 
 # End of client_view.py
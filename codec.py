@@ -0,0 +1,77 @@
+"""
+Payload codecs shared by the server and both clients.
+Every frame carries the id of the codec its payload was encoded with, so a
+receiver can always decode it; negotiation at login only decides which codec
+each side uses for what it sends. JSON is always available and is the
+fallback; msgpack is used when the optional `msgpack` package is installed.
+"""
+import json
+
+try:
+    import msgpack
+except Exception:
+    msgpack = None
+
+
+class CodecError(ValueError):
+    """Raised for unknown codec ids/names or undecodable payloads."""
+
+
+class JsonCodec:
+    name = 'json'
+    codec_id = 0
+
+    def encode(self, message):
+        # Compact separators and raw UTF-8: Cyrillic text is 2 bytes per
+        # character instead of a 6-byte \uXXXX escape
+        return json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode()
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    codec_id = 1
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+
+JSON = JsonCodec()
+
+# Most preferred first
+_CODECS = [MsgpackCodec()] if msgpack is not None else []
+_CODECS.append(JSON)
+_BY_NAME = {c.name: c for c in _CODECS}
+_BY_ID = {c.codec_id: c for c in _CODECS}
+
+
+def available_codecs():
+    """Names of codecs supported locally, most preferred first."""
+    return [c.name for c in _CODECS]
+
+
+def get_codec(name):
+    try:
+        return _BY_NAME[name]
+    except KeyError:
+        raise CodecError(f"unknown codec: {name}") from None
+
+
+def codec_by_id(codec_id):
+    try:
+        return _BY_ID[codec_id]
+    except KeyError:
+        raise CodecError(f"unknown codec id: {codec_id}") from None
+
+
+def negotiate(offered):
+    """Pick the first codec from the peer's preference list that we support."""
+    for name in offered or ():
+        if name in _BY_NAME:
+            return _BY_NAME[name]
+    return JSON
@@ -0,0 +1,99 @@
+"""
+In-process metrics of the server: counters, gauges and latency histograms.
+Recording is a dict update under one lock, cheap enough for every frame;
+`snapshot()` turns the current values into a JSON-ready dict that the
+server serves on its admin port (`server.py --admin-port`).
+
+Histograms keep counts in fixed buckets whose bounds double from 10 µs to
+~10 s, so memory does not grow with traffic and percentiles are accurate
+to a factor of two (the upper bound of the bucket is reported, capped at
+the largest value seen).
+"""
+import bisect
+import threading
+
+# Upper bounds of histogram buckets in seconds: 10 µs, 20 µs, ... ~10.5 s
+BUCKETS = tuple(0.00001 * 2 ** i for i in range(21))
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+    """Latency distribution in fixed exponential buckets."""
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        # the last bucket takes everything above the largest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th value (0 < p <= 1)."""
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                bound = self.bounds[index] if index < len(self.bounds) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        """Count and latencies in milliseconds."""
+        with self._lock:
+            result = {"count": self.count,
+                      "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+                      "max_ms": round(self.max * 1000, 3)}
+            for p in PERCENTILES:
+                result[f"p{round(p * 100)}_ms"] = round(self.percentile(p) * 1000, 3)
+        return result
+
+
+class Metrics:
+    """Named counters, gauges and histograms of one process."""
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, delta):
+        """Move a gauge (e.g. open connections) up or down."""
+        with self._lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = dict(self.histograms)
+        return {"counters": counters, "gauges": gauges,
+                "latency": {name: histogram.snapshot() for name, histogram in sorted(histograms.items())}}
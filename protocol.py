@@ -0,0 +1,194 @@
+"""
+Wire protocol shared by the server and both clients.
+Every message is sent as one frame: a 4-byte big-endian payload length and
+a 1-byte codec id (see codec.py), followed by the encoded payload.
+`FrameDecoder` reassembles frames from arbitrary TCP reads, so several
+messages may share one read and a large message may span many.
+
+Requests may carry a client-chosen `req_id`; the server copies it into
+every frame it sends in response, so a client can keep many requests in
+flight on one connection and tell responses apart from pushes
+(`PendingRequests`).
+"""
+import itertools
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from codec import JSON, codec_by_id, CodecError
+
+HEADER = struct.Struct('!IB')
+# Upper bound for one payload; protects against garbage length prefixes
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_SIZE = 65536
+# Seconds a request may wait for its response
+REQUEST_TIMEOUT = 30.0
+
+
+class FrameError(ValueError):
+    """Raised when the peer sends a malformed or oversized frame."""
+
+
+def encode_frame(message, codec=JSON):
+    """Serialize a message dict into a complete frame (header + payload)."""
+    payload = codec.encode(message)
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"frame too large: {len(payload)} bytes")
+    return HEADER.pack(len(payload), codec.codec_id) + payload
+
+
+class FrameDecoder:
+    """Incremental decoder: feed raw bytes, get back complete messages."""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Append received bytes and return the list of decoded messages."""
+        self._buffer += data
+        messages = []
+        offset = 0
+        buf = self._buffer
+        while len(buf) - offset >= HEADER.size:
+            length, codec_id = HEADER.unpack_from(buf, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"frame too large: {length} bytes")
+            end = offset + HEADER.size + length
+            if len(buf) < end:
+                break
+            try:
+                codec = codec_by_id(codec_id)
+            except CodecError as e:
+                raise FrameError(str(e)) from None
+            messages.append(codec.decode(bytes(buf[offset + HEADER.size:end])))
+            offset = end
+        if offset:
+            del buf[:offset]
+        return messages
+
+    def pending_bytes(self):
+        return len(self._buffer)
+
+
+def send_message(sock, message, codec=JSON):
+    """Send one framed message over a blocking socket."""
+    sock.sendall(encode_frame(message, codec))
+
+
+class FramedReader:
+    """Blocking reader over a socket that yields one message at a time.
+
+    Messages that arrive together with the requested one are kept for the
+    following calls, so the same reader must be used for the whole lifetime
+    of the connection (e.g. handed from the login code to the receiver thread).
+    """
+
+    def __init__(self, sock, recv_size=RECV_SIZE):
+        self.sock = sock
+        self.recv_size = recv_size
+        self.decoder = FrameDecoder()
+        self._ready = deque()
+
+    def read_message(self):
+        """Return the next message, or None when the peer closed the connection."""
+        while not self._ready:
+            data = self.sock.recv(self.recv_size)
+            if not data:
+                return None
+            self._ready.extend(self.decoder.feed(data))
+        return self._ready.popleft()
+
+
+def read_response(reader, req_id, stash):
+    """Read until the response to `req_id`; other frames are appended to
+    `stash` in arrival order. Returns None when the connection closed."""
+    while True:
+        message = reader.read_message()
+        if message is None or message.get("req_id") == req_id:
+            return message
+        stash.append(message)
+
+
+class PendingRequests:
+    """Requests in flight on one connection, matched to responses by `req_id`.
+
+    `add` tags a request and returns a `concurrent.futures.Future` that the
+    receiver completes through `resolve`. A future fails with TimeoutError
+    once `expire` finds it past its deadline, or with the given error when
+    the connection is lost (`fail_all`).
+    """
+
+    def __init__(self, timeout=REQUEST_TIMEOUT):
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._pending = {}  # req_id -> (future, final, deadline)
+
+    def tag(self, message):
+        """Give an outgoing request an id unless it has one; returns the id."""
+        with self._lock:
+            if "req_id" not in message:
+                message["req_id"] = next(self._ids)
+        return message["req_id"]
+
+    def add(self, message, final=None, timeout=None):
+        """Tag `message` and return the future of its response.
+
+        A streamed response (several frames with the same id) completes on
+        the first frame for which `final(frame)` is true; by default on the
+        first frame.
+        """
+        req_id = self.tag(message)
+        future = Future()
+        deadline = time.monotonic() + (timeout or self.timeout)
+        with self._lock:
+            self._pending[req_id] = (future, final, deadline)
+        return future
+
+    def resolve(self, response):
+        """Complete the future waiting for `response`; True if one was waiting."""
+        req_id = response.get("req_id")
+        if req_id is None:
+            return False
+        with self._lock:
+            entry = self._pending.get(req_id)
+            if entry is None:
+                return False
+            future, final, _ = entry
+            if final is not None and not final(response):
+                return True
+            del self._pending[req_id]
+        # outside the lock: done callbacks run right here
+        if not future.done():
+            future.set_result(response)
+        return True
+
+    def discard(self, req_id):
+        with self._lock:
+            self._pending.pop(req_id, None)
+
+    def expire(self):
+        """Fail the requests whose deadline has passed; returns how many."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [(req_id, entry[0]) for req_id, entry in self._pending.items() if entry[2] <= now]
+            for req_id, _ in expired:
+                del self._pending[req_id]
+        for req_id, future in expired:
+            if not future.done():
+                future.set_exception(TimeoutError(f"request {req_id} timed out"))
+        return len(expired)
+
+    def fail_all(self, error):
+        with self._lock:
+            futures = [entry[0] for entry in self._pending.values()]
+            self._pending.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def __len__(self):
+        return len(self._pending)
@@ -0,0 +1,409 @@
+"""
+Routing bus between server nodes.
+A node is one process holding client connections: a worker of a
+multi-process server (`server.py --workers`) or a server of a cluster
+(`--cluster-port`). Every node listens on its own address and keeps one
+outbound link to every peer. Nodes announce which users are connected to
+them, so `Router.forward` can hand a push for a user connected elsewhere to
+the node that holds the user's socket instead of looking it up in the local
+`user_connections`. Cluster members are learned from the hello frames, so a
+new node only needs the address of one member to join. Bus messages use the
+normal framing of protocol.py:
+
+    {"type": "hello", "node": id, "address": bus address, "client": [host, port],
+     "users": [...], "members": [[id, bus address], ...]}   first frame of a link
+    {"type": "presence", "node": id, "user": u, "online": bool}
+    {"type": "deliver", "user": u, "message": {...}}   push for a client
+    {"type": "deliver", "users": [...], "message": {...}}   same push for many
+    {"type": "pending", "user": u}                     offline queue grew
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter, deque
+
+from protocol import FramedReader, FrameError, encode_frame
+
+log = logging.getLogger("neurochat.bus")
+
+# Seconds between attempts to reach a peer that is not up (yet)
+RECONNECT_DELAY = 0.5
+# Frames a link may hold while its peer is slow or unreachable
+PEER_QUEUE = 65536
+
+
+def listen_socket(address, backlog=128):
+    """Listening socket for a bus address: a path (Unix socket) or (host, port)."""
+    if isinstance(address, str):
+        try:
+            os.unlink(address)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+def node_address(address):
+    """Bus address from a hello frame: JSON turns (host, port) into a list."""
+    return address if isinstance(address, str) else tuple(address)
+
+
+def connect_socket(address):
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    else:
+        sock = socket.create_connection(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class Peer:
+    """Outbound link to one node.
+
+    Frames are queued by `send` and written in batches by the link's own
+    thread, which (re)connects whenever the peer is down and starts every
+    connection with the `hello()` frame.
+    """
+
+    def __init__(self, node_id, address, hello, max_queue=PEER_QUEUE):
+        self.node_id = node_id
+        self.address = address
+        self.max_queue = max_queue
+        self._hello = hello
+        self._outbox = deque()
+        self._cond = threading.Condition()
+        self._sock = None
+        self.closed = False
+        self.connected = False
+        self.sent = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name=f"peer-{node_id}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def depth(self):
+        return len(self._outbox)
+
+    def send(self, message):
+        """Queue a bus message; False if it was dropped."""
+        try:
+            frame = encode_frame(message)
+        except FrameError:
+            return False
+        with self._cond:
+            if self.closed or len(self._outbox) >= self.max_queue:
+                self.dropped += 1
+                return False
+            self._outbox.append(frame)
+            self._cond.notify()
+        return True
+
+    def _connect(self):
+        try:
+            sock = connect_socket(self.address)
+            sock.sendall(encode_frame(self._hello()))
+        except OSError:
+            return None
+        return sock
+
+    def _run(self):
+        warned = False
+        while not self.closed:
+            sock = self._connect()
+            if sock is None:
+                if not warned:
+                    log.warning(f"[BUS] Узел {self.node_id} недоступен, повторяю подключение")
+                    warned = True
+                time.sleep(RECONNECT_DELAY)
+                continue
+            warned = False
+            self._sock = sock
+            self.connected = True
+            log.info(f"[BUS] Связь с узлом {self.node_id} установлена")
+            try:
+                self._write_loop(sock)
+            except OSError:
+                log.warning(f"[BUS] Связь с узлом {self.node_id} потеряна")
+            finally:
+                self.connected = False
+                sock.close()
+
+    def _write_loop(self, sock):
+        while True:
+            with self._cond:
+                while not self._outbox and not self.closed:
+                    self._cond.wait()
+                if self.closed:
+                    return
+                frames = list(self._outbox)
+                self._outbox.clear()
+            sock.sendall(b"".join(frames))
+            self.sent += len(frames)
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class Router:
+    """Presence table of the cluster and links to every peer node.
+
+    `locations` maps users connected to other nodes to those nodes; it is
+    filled from the peers' hello and presence frames and forgotten when a
+    peer's link closes. Bus messages other than presence bookkeeping go to
+    the `on_message` callback given to `start`, through `call` (e.g.
+    `loop.call_soon_threadsafe`) if the server must handle them on its own
+    thread.
+
+    `address` is where the node listens and `advertise` how peers reach it
+    (they differ when listening on 0.0.0.0); `client` is the address
+    clients connect to, used by `least_loaded`.
+    """
+
+    def __init__(self, node_id, address, peers, advertise=None, client=None):
+        self.node_id = node_id
+        self.address = address
+        self.advertise = advertise or address
+        self.client = client
+        self.locations = {}
+        # Client addresses of the nodes that have said hello
+        self.clients = {}
+        self._local = set()
+        self._links = Counter()
+        self._lock = threading.Lock()
+        self.peers = {}
+        self._started = False
+        for peer_id, peer_address in peers.items():
+            self.add_peer(peer_id, peer_address)
+        self._on_message = None
+        self._call = None
+        self._listener = None
+
+    def start(self, on_message, call=None):
+        self._on_message = on_message
+        self._call = call
+        self._listener = listen_socket(self.address)
+        threading.Thread(target=self._accept_loop, name="bus-accept", daemon=True).start()
+        with self._lock:
+            self._started = True
+            peers = list(self.peers.values())
+        for peer in peers:
+            peer.start()
+        log.info(f"[BUS] Узел {self.node_id} слушает {self.address}")
+
+    def add_peer(self, node_id, address):
+        """Start a link to a newly learned node; False if it is already known."""
+        with self._lock:
+            if node_id == self.node_id or node_id in self.peers:
+                return False
+            peer = self.peers[node_id] = Peer(node_id, address, self._hello)
+            started = self._started
+        if started:
+            log.info(f"[BUS] Новый узел {node_id} ({address})")
+            peer.start()
+        return True
+
+    def _hello(self):
+        with self._lock:
+            users = list(self._local)
+            members = [[peer_id, peer.address] for peer_id, peer in self.peers.items()]
+        return {"type": "hello", "node": self.node_id, "address": self.advertise,
+                "client": self.client, "users": users, "members": members}
+
+    def _broadcast(self, message):
+        with self._lock:
+            peers = list(self.peers.values())
+        for peer in peers:
+            peer.send(message)
+
+    # --- presence of local users ---
+    def user_online(self, username):
+        with self._lock:
+            self._local.add(username)
+            if self.locations.get(username) is not None:
+                del self.locations[username]
+        self._broadcast({"type": "presence", "node": self.node_id, "user": username, "online": True})
+
+    def user_offline(self, username):
+        with self._lock:
+            self._local.discard(username)
+        self._broadcast({"type": "presence", "node": self.node_id, "user": username, "online": False})
+
+    def location(self, username):
+        """Node holding the user's connection, or None if it is not on a peer."""
+        return self.locations.get(username)
+
+    # --- sending ---
+    def forward(self, username, message):
+        """Hand a push to the node the user is connected to; False if the
+        user is not online on any peer (or that peer's link is full)."""
+        node = self.locations.get(username)
+        peer = self.peers.get(node)
+        if peer is None:
+            return False
+        return peer.send({"type": "deliver", "user": username, "message": message})
+
+    def forward_many(self, usernames, message):
+        """Hand one push for many users to their nodes, one bus frame per node.
+
+        Returns the users that are not online on any peer, or whose peer's
+        link dropped the frame.
+        """
+        per_node = {}
+        missing = []
+        for username in usernames:
+            node = self.locations.get(username)
+            if node in self.peers:
+                per_node.setdefault(node, []).append(username)
+            else:
+                missing.append(username)
+        for node, users in per_node.items():
+            if not self.peers[node].send({"type": "deliver", "users": users, "message": message}):
+                missing.extend(users)
+        return missing
+
+    def notify_pending(self, username):
+        """Tell the user's node that their offline queue has new entries."""
+        peer = self.peers.get(self.locations.get(username))
+        if peer is not None:
+            peer.send({"type": "pending", "user": username})
+
+    def loads(self):
+        """Online users per client address of every live node, this one included.
+
+        Workers of one server share a client address and add up.
+        """
+        with self._lock:
+            per_node = Counter(self.locations.values())
+            per_node[self.node_id] = len(self._local)
+            clients = dict(self.clients)
+        if self.client is not None:
+            clients[self.node_id] = self.client
+        loads = Counter()
+        for node, client in clients.items():
+            loads[client] += per_node[node]
+        return loads
+
+    def least_loaded(self):
+        """Client address of the node with the fewest online users.
+
+        Ties go to the lowest address, so every node gives the same answer.
+        """
+        loads = self.loads()
+        if not loads:
+            return None
+        return min(loads, key=lambda client: (loads[client], client))
+
+    def stats(self):
+        with self._lock:
+            peers = dict(self.peers)
+        return {
+            "node": self.node_id,
+            "remote_users": len(self.locations),
+            "peers": {peer_id: {"connected": peer.connected, "queued": peer.depth(),
+                                "sent": peer.sent, "dropped": peer.dropped}
+                      for peer_id, peer in peers.items()},
+        }
+
+    # --- receiving ---
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._read_loop, args=(conn,), daemon=True).start()
+
+    def _read_loop(self, conn):
+        reader = FramedReader(conn)
+        node = None
+        try:
+            while True:
+                message = reader.read_message()
+                if message is None:
+                    break
+                kind = message.get("type")
+                if kind == "hello":
+                    node = message.get("node")
+                    self._peer_up(node, message)
+                    continue
+                if kind == "presence":
+                    self._presence(message)
+                self._dispatch(message)
+        except (OSError, FrameError) as e:
+            log.warning(f"[BUS] Ошибка связи с узлом {node}: {e}")
+        finally:
+            conn.close()
+            if node is not None:
+                self._peer_down(node)
+
+    def _peer_up(self, node, hello):
+        with self._lock:
+            self._links[node] += 1
+            if hello.get("client"):
+                self.clients[node] = tuple(hello["client"])
+        # A node that joined through us needs a link back, and we need
+        # links to the members it knows about
+        if hello.get("address") is not None:
+            self.add_peer(node, node_address(hello["address"]))
+        for member, address in hello.get("members") or []:
+            self.add_peer(member, node_address(address))
+        for username in hello.get("users") or []:
+            message = {"type": "presence", "node": node, "user": username, "online": True}
+            self._presence(message)
+            self._dispatch(message)
+
+    def _peer_down(self, node):
+        with self._lock:
+            self._links[node] -= 1
+            if self._links[node] > 0:
+                # the node has already reconnected
+                return
+            del self._links[node]
+            self.clients.pop(node, None)
+            gone = [username for username, where in self.locations.items() if where == node]
+            for username in gone:
+                del self.locations[username]
+        log.info(f"[BUS] Узел {node} отключился, его пользователей: {len(gone)}")
+
+    def _presence(self, message):
+        username, node = message.get("user"), message.get("node")
+        with self._lock:
+            if message.get("online"):
+                self.locations[username] = node
+                # The newest login wins, as with a second login on one node
+                self._local.discard(username)
+            elif self.locations.get(username) == node:
+                del self.locations[username]
+
+    def _dispatch(self, message):
+        if self._on_message is None:
+            return
+        if self._call is not None:
+            self._call(self._on_message, message)
+        else:
+            self._on_message(message)
+
+    def close(self):
+        self._on_message = None
+        if self._listener is not None:
+            self._listener.close()
+        with self._lock:
+            peers = list(self.peers.values())
+        for peer in peers:
+            peer.close()
@@ -0,0 +1,43 @@
+"""
+Tokenization for full-text message search.
+Messages are split into words of letters and digits in any script, so
+Russian and English text are indexed alike. Words are case-folded and ё is
+folded into е (most people do not type ё), so "Ёлка", "ёлка" and "елка"
+are the same term. Every query word matches as a prefix: "прив" finds
+"привет" and "привезу". There is no stemming; prefix matching covers the
+usual Russian endings.
+
+The inverted index itself lives in `SqliteStore` (`search_index`), one
+row per (chat, term, message), updated as messages are appended.
+"""
+import re
+
+# Words longer than this are cut; nobody searches for 100-letter tokens
+MAX_TERM_LENGTH = 40
+# Query words beyond this are ignored
+MAX_QUERY_TERMS = 8
+
+_WORD = re.compile(r"[^\W_]+")
+# Greater than any character a term can contain, closes a prefix range
+_PREFIX_END = "\U0010ffff"
+
+
+def normalize(word):
+    return word.casefold().replace("ё", "е")[:MAX_TERM_LENGTH]
+
+
+def tokenize(text):
+    """Distinct terms of a message, in order of first appearance."""
+    return list(dict.fromkeys(normalize(word) for word in _WORD.findall(text or "")))
+
+
+def query_terms(query):
+    """Terms of a search query, longest first: the longest prefix usually
+    matches the fewest messages, so it is looked up first."""
+    terms = tokenize(query)[:MAX_QUERY_TERMS]
+    return sorted(terms, key=len, reverse=True)
+
+
+def prefix_range(term):
+    """Bounds [low, high) of all terms starting with `term`."""
+    return term, term + _PREFIX_END
@@ -1,199 +1,1508 @@
+import abc
 import socket
 import threading
 import json
+import asyncio
+import argparse
+import contextvars
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent import futures
 from datetime import datetime
 
+from protocol import FrameDecoder, FrameError, encode_frame, RECV_SIZE
+from codec import JSON, negotiate
+from storage import SqliteStore, DEFAULT_DB_PATH, GROUP_PREFIX, group_chat, group_id, group_key
+from routing import Router
+from metrics import Metrics
+from auth import (Authenticator, AuthBusy, DEFAULT_WORKERS as DEFAULT_AUTH_WORKERS, DEFAULT_MAX_PENDING,
+                  new_session_token, session_digest)
+try:
+    import resource
+except ImportError:
+    # Windows: память процесса в метриках не показываем
+    resource = None
+
 # Глобальные переменные
-users = {}  # {username: password}
-user_connections = {}  # {username: (socket, address)}
-chat_history = {}  # {(user1, user2): [messages]} где user1 < user2 (отсортированы)
+store = None  # MessageStore: пользователи и история чатов, создаётся в start_server
+user_connections = {}  # {username: ClientSession}
+# Шина между процессами сервера (--workers) и узлами кластера (--cluster-port):
+# где подключены остальные пользователи; None, если процесс один
+router = None
+# Хеширование и проверка паролей в пуле потоков, создаётся в configure
+authenticator = None
+
+# Размер очереди входящих подключений (аргумент listen)
+DEFAULT_BACKLOG = 128
+# Адрес узла кластера для других узлов и клиентов
+DEFAULT_ADVERTISE = "127.0.0.1"
+# Размер страницы истории по умолчанию и предельный
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 500
+# Начальная загрузка: сколько последних чатов и сообщений в каждом отдавать
+BOOTSTRAP_CHATS = 50
+BOOTSTRAP_HISTORY = 20
+# Сколько новых сообщений чата отдаёт sync одной страницей
+SYNC_PAGE_SIZE = 200
+# Поиск: результатов на странице по умолчанию и предельно, длина запроса
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+MAX_SEARCH_QUERY = 200
+# Очередь исходящих кадров подключения и что делать при её переполнении:
+# drop — отбросить кадр, disconnect — отключить медленного клиента,
+# spill — перенести сообщения в очередь офлайн-доставки и дослать их,
+# когда очередь подключения разгрузится
+DEFAULT_OUTBOUND_QUEUE = 1024
+OVERFLOW_POLICIES = ("drop", "disconnect", "spill")
+DEFAULT_OVERFLOW_POLICY = "spill"
+
+# Группы: длина названия и число участников
+MAX_GROUP_NAME = 100
+MAX_GROUP_MEMBERS = 5000
+# Офлайн-доставка: сообщений в одном кадре pending и сколько кадров
+# может ждать подтверждения клиента одновременно
+PENDING_BATCH = 200
+PENDING_WINDOW = 4
+# Через сколько секунд повторить вход, если пул проверки паролей переполнен
+AUTH_RETRY_AFTER = 1
+# Сколько секунд действует токен сессии, выданный при входе (см. resume)
+SESSION_TTL = 7 * 24 * 3600
+
+outbound_queue_size = DEFAULT_OUTBOUND_QUEUE
+overflow_policy = DEFAULT_OVERFLOW_POLICY
+# Запрос, который сейчас обрабатывается: (сессия, req_id или None). Его req_id
+# копируется во все кадры ответа этой сессии, но не в push другим клиентам
+current_request = contextvars.ContextVar("current_request", default=None)
+# Счётчики переполнений очередей по всем подключениям
+outbound_stats = {"dropped": 0, "spilled": 0, "disconnected": 0}
+outbound_stats_lock = threading.Lock()
+
+# Метрики процесса: запросы по действиям, подключения, байты; см. --admin-port
+metrics = Metrics()
+started_at = time.time()
+# Журнал: события горячего пути (кадры, сообщения) пишутся только на уровне
+# DEBUG и в среднем одно из log_sample
+log = logging.getLogger("neurochat")
+DEFAULT_LOG_LEVEL = "INFO"
+debug_logging = False
+log_sample = 1
 
 def broadcast_discovery(port):
     """Отвечает на поиск сервера в сети"""
     discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     discovery_socket.bind(('', 12345))
-    
-    print(f"[DISCOVERY] Слушаю на порту 12345...")
-    
+
+    log.info("[DISCOVERY] Слушаю на порту 12345...")
+
     while True:
         try:
             data, addr = discovery_socket.recvfrom(1024)
             if data.decode() == "DISCOVER_SERVER":
-                print(f"[DISCOVERY] Получен запрос поиска от {addr}")
-                # Получаем локальный IP адрес на основе сетевого интерфейса
-                try:
-                    # Пытаемся получить реальный IP адрес
-                    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    s.connect((addr[0], addr[1]))
-                    server_ip = s.getsockname()[0]
-                    s.close()
-                except:
-                    server_ip = "127.0.0.1"
-                
+                log.debug(f"[DISCOVERY] Получен запрос поиска от {addr}")
+                # В кластере клиента направляем на узел, где меньше всего пользователей
+                target = router.least_loaded() if router else None
+                if target is not None and target != router.client:
+                    server_ip, server_port = target
+                else:
+                    server_port = port
+                    # Получаем локальный IP адрес на основе сетевого интерфейса
+                    try:
+                        # Пытаемся получить реальный IP адрес
+                        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        s.connect((addr[0], addr[1]))
+                        server_ip = s.getsockname()[0]
+                        s.close()
+                    except:
+                        server_ip = "127.0.0.1"
+
                 response = json.dumps({
                     "server_ip": server_ip,
-                    "server_port": port
+                    "server_port": server_port
                 })
-                print(f"[DISCOVERY] Отправляю ответ: {response} на {addr}")
+                log.debug(f"[DISCOVERY] Отправляю ответ: {response} на {addr}")
                 discovery_socket.sendto(response.encode(), addr)
         except Exception as e:
-            print(f"[DISCOVERY] Ошибка: {e}")
+            log.error(f"[DISCOVERY] Ошибка: {e}")
+
+def clamp(value, default, upper):
+    """Приводит числовой параметр запроса к диапазону 1..upper"""
+    try:
+        return max(1, min(int(value or default), upper))
+    except (TypeError, ValueError):
+        return default
+
+class ClientSession(abc.ABC):
+    """Подключение клиента, не зависящее от режима работы сервера.
+
+    Кадры для клиента кодируются в потоке отправителя и складываются в
+    ограниченную очередь; в сокет их пишет только писатель подключения,
+    поэтому медленный получатель не задерживает отправителя, а кадры от
+    разных отправителей не перемешиваются.
+    """
+
+    def __init__(self, addr, max_queue=None, policy=None):
+        self.addr = addr
+        self.username = None
+        # Кодек исходящих кадров; выбирается при входе
+        self.codec = JSON
+        self.max_queue = max_queue or outbound_queue_size
+        self.policy = policy or overflow_policy
+        self.closed = False
+        # Очередь готовых кадров; RLock — abort вызывается и под ней
+        self._outbox = deque()
+        self._cond = threading.Condition()
+        self._overflowing = False
+        # Часть сообщений ушла в очередь офлайн-доставки: дослать, когда разгрузимся
+        self.needs_pending = False
+        # Офлайн-доставка: позиция последнего отправленного кадра pending
+        # и позиции кадров, ещё не подтверждённых клиентом
+        self.pending_cursor = 0
+        self.pending_inflight = deque()
+        self.pending_lock = threading.Lock()
+        self.dropped = 0
+        self.spilled = 0
+        self.max_depth = 0
+
+    def depth(self):
+        return len(self._outbox)
+
+    def send(self, message):
+        """Ставит сообщение в очередь отправки; False, если оно не будет доставлено"""
+        if self.closed:
+            return False
+        request = current_request.get()
+        if request is not None and request[0] is self and request[1] is not None and "req_id" not in message:
+            message = dict(message, req_id=request[1])
+        try:
+            frame = encode_frame(message, self.codec)
+        except FrameError as e:
+            log.error(f"[ERROR] Кадр для {self.addr} не отправлен: {e}")
+            return False
+        return self.send_frame(frame, message)
+
+    def send_frame(self, frame, message):
+        """Ставит в очередь уже закодированный кадр: при рассылке многим
+        получателям одни и те же байты; message нужен политике переполнения"""
+        if self.closed:
+            return False
+        with self._cond:
+            if len(self._outbox) >= self.max_queue:
+                request = current_request.get()
+                # Ответы на запросы этого клиента не теряем: им можно превысить
+                # предел вдвое, а клиента, который и тогда их не читает, отключаем
+                reply = request is not None and request[0] is self
+                if not reply or len(self._outbox) >= 2 * self.max_queue:
+                    return self._overflow(message, reply)
+            self._outbox.append(frame)
+            if len(self._outbox) > self.max_depth:
+                self.max_depth = len(self._outbox)
+            self._cond.notify()
+        self._wakeup()
+        return True
+
+    def _overflow(self, message, reply=False):
+        """Очередь полна: применяет политику подключения (под блокировкой очереди)"""
+        if not self._overflowing:
+            self._overflowing = True
+            log.warning(f"[BACKPRESSURE] Очередь {self.username or self.addr} заполнена "
+                        f"({self.max_queue} кадров), политика {self.policy}")
+        if self.policy == "disconnect" or reply:
+            count_outbound("disconnected")
+            self.abort()
+        elif message.get("action") == "pending":
+            # Кадр офлайн-доставки не потерян: его сообщения остаются в очереди
+            # доставки, и deliver_pending повторит его, когда очередь разгрузится
+            self.needs_pending = True
+        elif (self.policy == "spill" and message.get("action") == "receive_message"
+              and "group" not in message and self.username):
+            # Сообщение уже в истории: доставим его через очередь офлайн-доставки
+            chat_key = tuple(sorted([self.username, message["sender"]]))
+            store.enqueue_pending(self.username, chat_key, message["seq"])
+            self.spilled += 1
+            self.needs_pending = True
+            count_outbound("spilled")
+        elif self.policy == "spill":
+            # Остальное (сообщения групп, отметки, списки) тоже есть в базе, но
+            # в очередь доставки не ложится: отключаем клиента, и после resume
+            # он получит пропущенное через bootstrap, а не потеряет молча
+            count_outbound("disconnected")
+            self.abort()
+        else:
+            self.dropped += 1
+            count_outbound("dropped")
+        return False
+
+    def _take(self):
+        """Забирает накопленные кадры (под блокировкой очереди).
+
+        Возвращает (кадры, пора ли дослать вытесненные сообщения).
+        """
+        frames = list(self._outbox)
+        self._outbox.clear()
+        if frames:
+            return frames, False
+        self._overflowing = False
+        due = self.needs_pending
+        self.needs_pending = False
+        return frames, due
+
+    def _wakeup(self):
+        """Будит писателя после добавления кадра"""
+
+    @abc.abstractmethod
+    def start(self):
+        """Запускает писателя подключения"""
+
+    def abort(self):
+        """Разрывает соединение, не дожидаясь отправки очереди; подклассы
+        дополнительно обрывают своё соединение"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        self._wakeup()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._outbox.clear()
+            self._cond.notify()
+        self._wakeup()
+
+    def offload(self, future, done):
+        """Завершает запрос, когда пул (проверка пароля) выполнит future:
+        done(future) вызывается в контексте запроса. Следующие кадры клиента
+        обрабатываются только после этого. У потока подключения — просто ждём"""
+        futures.wait([future])
+        done(future)
+
+class ThreadedSession(ClientSession):
+    """Подключение, обслуживаемое отдельным потоком чтения и потоком записи"""
+
+    def __init__(self, conn, addr):
+        super().__init__(addr)
+        self.conn = conn
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+
+    def start(self):
+        self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._outbox and not self.needs_pending and not self.closed:
+                    self._cond.wait()
+                if self.closed:
+                    return
+                frames, due = self._take()
+            if due:
+                deliver_pending(self)
+                continue
+            try:
+                # Всё накопленное — одним вызовом
+                data = b"".join(frames)
+                self.conn.sendall(data)
+                count_bytes_out(len(frames), len(data))
+            except OSError:
+                self.abort()
+                return
+
+    def abort(self):
+        super().abort()
+        try:
+            # Поток чтения получит конец потока и закроет подключение
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        super().close()
+        # Будит писателя, если он застрял в sendall к клиенту, который не читает
+        self.abort()
+
+class AsyncSession(ClientSession):
+    """Подключение, обслуживаемое циклом событий asyncio"""
+
+    def __init__(self, writer, addr):
+        super().__init__(addr)
+        self.writer = writer
+        self._ready = asyncio.Event()
+        self._task = None
+        # Запрос, ждущий пула: (future, контекст запроса, done); см. resume
+        self.waiting = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def _wakeup(self):
+        # send вызывается только из потока цикла событий
+        self._ready.set()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                with self._cond:
+                    frames, due = self._take()
+                if self.closed:
+                    return
+                if due:
+                    deliver_pending(self)
+                    continue
+                if not frames:
+                    await self._ready.wait()
+                    self._ready.clear()
+                    continue
+                data = b"".join(frames)
+                self.writer.write(data)
+                count_bytes_out(len(frames), len(data))
+                # Пока клиент не читает, очередь копится и упирается в предел
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.abort()
+
+    def abort(self):
+        super().abort()
+        self.writer.transport.abort()
+
+    def offload(self, future, done):
+        # Цикл событий не блокируем: чтение подключения дождётся в resume
+        self.waiting = (future, contextvars.copy_context(), done)
+
+    async def resume(self):
+        """Дожидается запроса, отданного пулу, и завершает его"""
+        future, context, done = self.waiting
+        self.waiting = None
+        await asyncio.wait([asyncio.wrap_future(future)])
+        context.run(done, future)
+
+def count_bytes_out(frames, size):
+    metrics.count("frames_out", frames)
+    metrics.count("bytes_out", size)
+
+def count_outbound(event):
+    with outbound_stats_lock:
+        outbound_stats[event] += 1
+
+def outbound_metrics():
+    """Глубина очередей исходящих кадров и счётчики переполнений"""
+    sessions = list(user_connections.values())
+    with outbound_stats_lock:
+        stats = dict(outbound_stats)
+    stats.update({
+        "sessions": len(sessions),
+        "queued": sum(session.depth() for session in sessions),
+        "max_depth": max((session.max_depth for session in sessions), default=0),
+    })
+    return stats
+
+def hot_path_logged():
+    """Писать ли в журнал событие горячего пути (кадр, сообщение): только на
+    уровне DEBUG и в среднем одно из log_sample, чтобы журнал не тормозил сервер.
+    Выборка случайная: у счётчика каждое N-е событие было бы всегда одного вида"""
+    return debug_logging and (log_sample == 1 or random.random() * log_sample < 1)
+
+def server_stats():
+    """Снимок метрик процесса: запросы, подключения, очереди, хранилище, шина"""
+    snapshot = metrics.snapshot()
+    cpu = os.times()
+    process = {"pid": os.getpid(), "uptime": round(time.time() - started_at, 1),
+               "cpu_user": round(cpu.user, 2), "cpu_system": round(cpu.system, 2)}
+    if resource is not None:
+        # ru_maxrss: килобайты в Linux, байты в macOS
+        process["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    snapshot.update({
+        "process": process,
+        "users_online": len(user_connections),
+        "outbound": outbound_metrics(),
+        "store": store.stats() if store else {},
+        "auth": authenticator.stats() if authenticator else {},
+    })
+    if router:
+        snapshot["bus"] = router.stats()
+    return snapshot
+
+def serve_admin(admin_socket):
+    """Порт администрирования (только localhost): на любой запрос, например
+    `curl localhost:PORT`, отвечает снимком метрик в JSON"""
+    while True:
+        conn, _ = admin_socket.accept()
+        try:
+            conn.settimeout(1.0)
+            try:
+                conn.recv(4096)
+            except socket.timeout:
+                pass
+            body = json.dumps(server_stats(), ensure_ascii=False, indent=1).encode()
+            conn.sendall(b"HTTP/1.0 200 OK\r\nContent-Type: application/json; charset=utf-8\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        except OSError as e:
+            log.warning(f"[ADMIN] Ошибка: {e}")
+        finally:
+            conn.close()
+
+def start_admin(port):
+    admin_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    admin_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    admin_socket.bind(("127.0.0.1", port))
+    admin_socket.listen(16)
+    threading.Thread(target=serve_admin, args=(admin_socket,), name="admin", daemon=True).start()
+    log.info(f"[ADMIN] Метрики на 127.0.0.1:{port}")
+
+def configure_logging(level=DEFAULT_LOG_LEVEL, sample=1):
+    """Уровень журнала и доля событий горячего пути, которые в него попадают"""
+    global debug_logging, log_sample
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", force=True)
+    log.setLevel(level)
+    debug_logging = log.isEnabledFor(logging.DEBUG)
+    log_sample = max(1, sample)
+
+def push(username, message):
+    """Отправляет push пользователю, к какому бы процессу сервера он ни был
+    подключён; False, если пользователь не в сети"""
+    session = user_connections.get(username)
+    if session:
+        # Даже если это сессия отправителя запроса (сообщение самому себе),
+        # push не ответ: req_id запроса в него не копируется
+        token = current_request.set(None)
+        try:
+            session.send(message)
+        finally:
+            current_request.reset(token)
+        return True
+    return router is not None and router.forward(username, message)
+
+def fan_out(usernames, message, forward=True):
+    """Рассылает одно push-сообщение многим пользователям.
+
+    Кадр кодируется один раз на кодек, и одни и те же байты ставятся в
+    очереди всех подключённых получателей; тем, кто подключён к другим
+    процессам, сообщение уходит одним кадром шины на процесс. Возвращает
+    число получателей, подключённых к этому процессу.
+    """
+    frames = {}
+    remote = []
+    local = 0
+    for username in usernames:
+        session = user_connections.get(username)
+        if session is None:
+            remote.append(username)
+            continue
+        frame = frames.get(session.codec.codec_id)
+        if frame is None:
+            try:
+                frame = frames[session.codec.codec_id] = encode_frame(message, session.codec)
+            except FrameError as e:
+                log.error(f"[ERROR] Рассылка не отправлена: {e}")
+                return local
+        session.send_frame(frame, message)
+        local += 1
+    if forward and remote and router:
+        router.forward_many(remote, message)
+    return local
+
+def handle_bus_message(message):
+    """Обрабатывает сообщение шины от другого процесса сервера"""
+    kind = message.get("type")
+    username = message.get("user")
+    session = user_connections.get(username)
+    if kind == "deliver" and "users" in message:
+        # Рассылка в группу: тем получателям, что подключены здесь
+        fan_out(message["users"], message.get("message") or {}, forward=False)
+    elif kind == "deliver":
+        push_message = message.get("message") or {}
+        if session:
+            session.send(push_message)
+        elif push_message.get("action") == "receive_message":
+            # Пользователь успел отключиться: сообщение ждёт его входа
+            chat_key = tuple(sorted([username, push_message["sender"]]))
+            store.enqueue_pending(username, chat_key, push_message["seq"])
+    elif kind == "pending":
+        if session:
+            deliver_pending(session)
+    elif kind == "presence" and message.get("online"):
+        if session:
+            # Пользователь вошёл через другой процесс: push теперь идут туда
+            del user_connections[username]
+
+def chat_key_for(username, other):
+    """Ключ чата с собеседником или группой (имя вида group:<id>)"""
+    gid = group_id(other)
+    if gid is not None:
+        return group_key(gid)
+    return tuple(sorted([username, other]))
+
+def visible_chat(username, other):
+    """Ключ чата, если он существует и пользователь может его читать, иначе None"""
+    gid = group_id(other)
+    if gid is not None:
+        return group_key(gid) if store.is_group_member(gid, username) else None
+    if not isinstance(other, str) or not store.user_exists(other):
+        return None
+    return tuple(sorted([username, other]))
+
+def offload_auth(session, submit, done):
+    """Отдаёт хеширование пароля пулу authenticator; если пул переполнен,
+    сразу отвечает клиенту, что нужно повторить позже"""
+    start = time.perf_counter()
+    try:
+        future = submit()
+    except AuthBusy:
+        metrics.count("auth.rejected")
+        session.send({"status": "error", "message": "Сервер занят, повторите вход позже",
+                      "retry_after": AUTH_RETRY_AFTER})
+        return
+
+    def finish(future):
+        metrics.observe("auth", time.perf_counter() - start)
+        done(future.result())
+    session.offload(future, finish)
+
+# Регистрация
+def handle_register(session, message):
+    username = message.get("username")
+    password = message.get("password")
+
+    if not isinstance(username, str) or not username or not isinstance(password, str):
+        session.send({"status": "error", "message": "Укажите имя пользователя и пароль"})
+    elif username.startswith(GROUP_PREFIX):
+        # Такие имена заняты группами
+        session.send({"status": "error", "message": "Недопустимое имя пользователя"})
+    elif store.user_exists(username):
+        session.send({"status": "error", "message": "Пользователь уже существует"})
+    else:
+        offload_auth(session, lambda: authenticator.hash(password),
+                     lambda password_hash: finish_register(session, username, password_hash))
+
+def finish_register(session, username, password_hash):
+    if not store.add_user(username, password_hash):
+        session.send({"status": "error", "message": "Пользователь уже существует"})
+        return
+    # Другие процессы сервера (--workers) увидят пользователя только после фиксации
+    store.flush()
+    session.send({"status": "success", "message": "Регистрация успешна"})
+    log.info(f"[REGISTER] Зарегистрирован пользователь {username}")
+
+# Вход
+def handle_login(session, message):
+    username = message.get("username")
+    password = message.get("password")
+
+    stored_password = store.get_password(username)
+    if stored_password is None:
+        session.send({"status": "error", "message": "Пользователь не найден"})
+    else:
+        # Проверка пароля — в пуле; недавний вход с тем же паролем — сразу из кеша
+        offload_auth(session, lambda: authenticator.verify(username, password, stored_password),
+                     lambda result: finish_login(session, message, username, *result))
+
+def finish_login(session, message, username, valid, new_hash):
+    if not valid:
+        session.send({"status": "error", "message": "Неверный пароль"})
+    else:
+        if new_hash:
+            # Пароль из базы до хеширования или с прежними параметрами
+            store.set_password(username, new_hash)
+        # Токен, с которым клиент после обрыва вернётся без пароля (resume)
+        token, digest = new_session_token()
+        expires = time.time() + SESSION_TTL
+        store.add_session(digest, username, expires)
+        if router:
+            # Переподключение может попасть в другой процесс или на другой узел
+            store.flush()
+        start_session(session, message, username,
+                      {"status": "success", "message": "Вход успешен", "session": token,
+                       "session_expires": int(expires)})
+        log.info(f"[LOGIN] Пользователь {username} вошел (кодек {session.codec.name})")
+
+def start_session(session, message, username, reply):
+    """Общее для входа и resume: ответ, кодек, онлайн и офлайн-доставка"""
+    codec = negotiate(message.get("codecs"))
+    # Ответ ещё уходит старым кодеком: каждый кадр помечен своим кодеком
+    session.send(dict(reply, codec=codec.name))
+    session.codec = codec
+    session.username = username
+    user_connections[username] = session
+    if router:
+        router.user_online(username)
+    # Всё, что пришло, пока пользователь был офлайн
+    deliver_pending(session)
+
+# Возврат после обрыва: токен сессии вместо пароля, без scrypt. Пропущенное
+# клиент получает следом (bootstrap/sync с известными ему seq)
+def handle_resume(session, message):
+    token = message.get("session")
+    username = store.session_user(session_digest(token), time.time()) if isinstance(token, str) else None
+    if username is None:
+        metrics.count("resume.rejected")
+        session.send({"action": "resume", "status": "error", "message": "Сессия истекла, войдите снова"})
+        return
+    start_session(session, message, username, {"action": "resume", "status": "success", "username": username})
+    log.info(f"[RESUME] Пользователь {username} вернулся (кодек {session.codec.name})")
+
+def valid_message_id(value):
+    """id сообщения — 32 шестнадцатеричных символа (uuid4().hex)"""
+    if not isinstance(value, str) or len(value) != 32:
+        return False
+    try:
+        int(value, 16)
+    except ValueError:
+        return False
+    return True
+
+def receipt_of(chat_key, username):
+    """Отметки доставки и прочтения собеседника для ответа клиенту"""
+    delivered, read = store.get_receipt(chat_key, username)
+    return {"delivered": delivered, "read": read}
+
+# Отправка сообщения
+def handle_send_message(session, message):
+    sender = session.username
+    recipient = message.get("recipient")
+    text = message.get("text")
+
+    if not isinstance(text, str) or not text:
+        session.send({"action": "message_sent", "status": "error", "message": "Пустое сообщение",
+                      "recipient": recipient, "id": message.get("id")})
+        return
+
+    gid = group_id(recipient)
+    if gid is not None:
+        send_group_message(session, message, gid)
+        return
+
+    if not store.user_exists(recipient):
+        session.send({"action": "message_sent", "status": "error", "message": "Получатель не найден",
+                      "recipient": recipient, "id": message.get("id")})
+        return
+
+    # Создаем уникальный ключ чата (сортируем имена)
+    chat_key = tuple(sorted([sender, recipient]))
+
+    msg_data = {
+        "sender": sender,
+        "text": text,
+        "timestamp": datetime.now().strftime("%H:%M:%S")
+    }
+    # Клиент может сам выбрать id, чтобы сопоставить ответ со своим сообщением
+    if valid_message_id(message.get("id")):
+        msg_data["id"] = message["id"]
+
+    # Сохраняем в историю; отвечая, отправитель прочитал входящие этого чата
+    store.append_message(chat_key, msg_data)
+    store.mark_read(sender, recipient)
+
+    # Если получатель онлайн, отправить напрямую
+    # (кадр только ставится в очередь получателя, отправитель не ждёт)
+    delivered = push(recipient, {
+        "action": "receive_message",
+        "sender": sender,
+        "text": text,
+        "timestamp": msg_data["timestamp"],
+        "seq": msg_data["seq"],
+        "id": msg_data["id"]
+    })
+    if not delivered:
+        # Получатель офлайн: сообщение будет отправлено ему при входе
+        store.enqueue_pending(recipient, chat_key, msg_data["seq"])
+        # Получатель мог войти, пока сообщение ставилось в очередь
+        recipient_session = user_connections.get(recipient)
+        if recipient_session:
+            deliver_pending(recipient_session)
+        elif router and router.location(recipient):
+            # Другой процесс прочитает очередь только после фиксации записи
+            store.flush()
+            router.notify_pending(recipient)
+
+    session.send({
+        "action": "message_sent",
+        "status": "success",
+        "message": "Сообщение отправлено",
+        "recipient": recipient,
+        "id": msg_data["id"],
+        "seq": msg_data["seq"],
+        "timestamp": msg_data["timestamp"]
+    })
+    if hot_path_logged():
+        log.debug(f"[MESSAGE] {sender} -> {recipient}: seq {msg_data['seq']}, {len(text)} символов")
+
+# Сообщение в группу: хранится один раз, участникам в сети рассылается
+# один и тот же кадр; остальные получат его при входе через bootstrap/sync
+def send_group_message(session, message, gid):
+    sender = session.username
+    chat = group_chat(gid)
+    if not store.is_group_member(gid, sender):
+        session.send({"action": "message_sent", "status": "error", "message": "Группа не найдена",
+                      "recipient": chat, "id": message.get("id")})
+        return
+    msg_data = {
+        "sender": sender,
+        "text": message.get("text"),
+        "timestamp": datetime.now().strftime("%H:%M:%S")
+    }
+    if valid_message_id(message.get("id")):
+        msg_data["id"] = message["id"]
+    store.append_message(group_key(gid), msg_data)
+    store.mark_read(sender, chat)
+
+    members = [member for member in store.group_members(gid) if member != sender]
+    fan_out(members, {
+        "action": "receive_message",
+        "group": chat,
+        "sender": sender,
+        "text": msg_data["text"],
+        "timestamp": msg_data["timestamp"],
+        "seq": msg_data["seq"],
+        "id": msg_data["id"]
+    })
+    session.send({
+        "action": "message_sent",
+        "status": "success",
+        "message": "Сообщение отправлено",
+        "recipient": chat,
+        "id": msg_data["id"],
+        "seq": msg_data["seq"],
+        "timestamp": msg_data["timestamp"]
+    })
+    if hot_path_logged():
+        log.debug(f"[GROUP] {sender} -> {chat} ({len(members)} участников)")
+
+def group_reply(session, status, group=None, message=None):
+    reply = {"action": "group", "status": status}
+    if group is not None:
+        reply["group"] = group
+    if message:
+        reply["message"] = message
+    session.send(reply)
+
+def existing_users(names, limit):
+    """Имена существующих пользователей из запроса клиента, без повторов"""
+    if not isinstance(names, list):
+        return []
+    users = [name for name in dict.fromkeys(names)
+             if isinstance(name, str) and store.user_exists(name)]
+    return users[:limit]
+
+def notify_group(group, skip=None):
+    """Рассылает участникам (кроме skip) новое состояние группы"""
+    # Участники могут сразу написать в группу через другой процесс сервера:
+    # новый состав должен быть уже зафиксирован в базе
+    store.flush()
+    fan_out([member for member in group["members"] if member != skip],
+            {"action": "group_updated", "group": group})
+
+# Создание группы: создатель становится владельцем и участником
+def handle_create_group(session, message):
+    name = message.get("name")
+    if not isinstance(name, str) or not name.strip():
+        group_reply(session, "error", message="Укажите название группы")
+        return
+    members = existing_users(message.get("members"), MAX_GROUP_MEMBERS - 1)
+    gid = store.create_group(name.strip()[:MAX_GROUP_NAME], session.username, members)
+    group = store.get_group(gid)
+    group_reply(session, "success", group)
+    notify_group(group, skip=session.username)
+    log.info(f"[GROUP] {session.username} создал группу {group['key']} ({len(group['members'])} участников)")
+
+def group_for_member(session, message):
+    """Группа из запроса, если пользователь в ней состоит; иначе отвечает ошибкой"""
+    gid = group_id(message.get("group"))
+    if gid is None or not store.is_group_member(gid, session.username):
+        group_reply(session, "error", message="Группа не найдена")
+        return None
+    return gid
+
+def handle_get_group(session, message):
+    gid = group_for_member(session, message)
+    if gid is not None:
+        group_reply(session, "success", store.get_group(gid))
+
+# Добавить участников может любой участник группы
+def handle_add_group_members(session, message):
+    gid = group_for_member(session, message)
+    if gid is None:
+        return
+    room = MAX_GROUP_MEMBERS - len(store.group_members(gid))
+    added = store.add_group_members(gid, existing_users(message.get("members"), max(room, 0)))
+    group = store.get_group(gid)
+    group_reply(session, "success", group)
+    if added:
+        notify_group(group, skip=session.username)
+        log.info(f"[GROUP] {session.username} добавил в {group['key']}: {added}")
+
+# Удалить участника может владелец; любой участник может выйти сам
+def handle_remove_group_member(session, message):
+    gid = group_for_member(session, message)
+    if gid is None:
+        return
+    username = message.get("username") or session.username
+    group = store.get_group(gid)
+    if username != session.username and session.username != group["owner"]:
+        group_reply(session, "error", group, "Удалять участников может только владелец")
+        return
+    if username == group["owner"]:
+        # Иначе группа осталась бы без владельца, и удалять участников было бы некому
+        group_reply(session, "error", group, "Владелец не может выйти из группы")
+        return
+    if not store.remove_group_member(gid, username):
+        group_reply(session, "error", group, "Пользователь не состоит в группе")
+        return
+    group = store.get_group(gid)
+    group_reply(session, "success", group)
+    notify_group(group, skip=session.username)
+    if username != session.username:
+        push(username, {"action": "group_removed", "group": group["key"]})
+    log.info(f"[GROUP] {username} больше не в {group['key']}")
+
+# Получение истории чата
+def handle_get_chat_history(session, message):
+    other_user = message.get("other_user")
+    chat_key = visible_chat(session.username, other_user) if other_user else None
+    if chat_key is None:
+        return
+    before = message.get("before")
+    after = message.get("after")
+    limit = message.get("limit")
+    # Курсоры — seq сообщений; всё остальное считаем отсутствующим курсором
+    if not isinstance(before, int):
+        before = None
+    if not isinstance(after, int):
+        after = None
+
+    if before is None and after is None:
+        # Открыт чат (запрошены последние сообщения): он прочитан
+        store.mark_read(session.username, other_user)
+
+    if before is None and after is None and limit is None:
+        # Старый вариант запроса: вся история целиком
+        session.send({
+            "action": "chat_history",
+            "other_user": other_user,
+            "messages": store.get_history(chat_key),
+            "receipt": receipt_of(chat_key, other_user)
+        })
+        if hot_path_logged():
+            log.debug(f"[HISTORY] Отправлена история чата {chat_key}")
+        return
+
+    limit = clamp(limit, HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE)
+    messages, has_more = store.get_page(chat_key, before=before, after=after, limit=limit)
+    # Курсор следующей страницы в направлении листания
+    next_cursor = None
+    if has_more and messages:
+        next_cursor = messages[-1]["seq"] if after is not None else messages[0]["seq"]
+    session.send({
+        "action": "chat_history",
+        "other_user": other_user,
+        "messages": messages,
+        "before": before,
+        "after": after,
+        "has_more": has_more,
+        "next_cursor": next_cursor,
+        "receipt": receipt_of(chat_key, other_user)
+    })
+    if hot_path_logged():
+        log.debug(f"[HISTORY] Отправлена страница чата {chat_key}: {len(messages)} сообщений")
+
+# Поиск по сообщениям: только в чатах пользователя (или в одном из них)
+def handle_search_messages(session, message):
+    query = message.get("query")
+    if not isinstance(query, str) or not query.strip():
+        session.send({"action": "search_results", "status": "error", "message": "Пустой запрос"})
+        return
+    chat = message.get("chat")
+    chat_key = None
+    if chat is not None:
+        chat_key = visible_chat(session.username, chat)
+        if chat_key is None:
+            session.send({"action": "search_results", "status": "error", "message": "Чат не найден"})
+            return
+    before = message.get("before")
+    if not isinstance(before, int):
+        before = None
+    limit = clamp(message.get("limit"), SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE)
+    results, has_more = store.search_messages(session.username, query[:MAX_SEARCH_QUERY],
+                                              chat_key=chat_key, before=before, limit=limit)
+    session.send({
+        "action": "search_results",
+        "status": "success",
+        "query": query,
+        "chat": chat,
+        "results": results,
+        "has_more": has_more,
+        "next_cursor": results[-1]["cursor"] if has_more else None
+    })
+    if hot_path_logged():
+        log.debug(f"[SEARCH] {session.username}: найдено {len(results)}")
+
+# Получение списка пользователей
+def handle_get_users(session, message):
+    session.send({
+        "action": "users_list",
+        "users": store.list_users()
+    })
+    if hot_path_logged():
+        log.debug(f"[USERS] Отправлен список пользователей клиенту {session.addr}")
+
+# Получение списка чатов, где есть переписка с этим пользователем
+def handle_get_my_chats(session, message):
+    username = session.username
+    # Индекс собеседников уже упорядочен по последней активности
+    try:
+        summaries = store.chat_summaries(username)
+    except Exception:
+        summaries = []
+    chats_for_user = [summary["user"] for summary in summaries]
+    session.send({
+        "action": "my_chats",
+        "chats": chats_for_user,
+        "summaries": summaries
+    })
+    if hot_path_logged():
+        log.debug(f"[MY_CHATS] Отправлен список чатов для {username}: {len(chats_for_user)}")
+
+def send_chat_updates(session, summaries, known, limit):
+    """Отправляет по странице chat_history на каждый чат, где есть новое.
+
+    known — {собеседник: последний известный клиенту seq}. Для известных
+    чатов уходят только сообщения новее этого seq, для остальных — последняя
+    страница. Возвращает число отправленных страниц.
+    """
+    username = session.username
+    sent = 0
+    for summary in summaries:
+        other = summary["user"]
+        chat_key = chat_key_for(username, other)
+        after = known.get(other)
+        if after is not None:
+            last = summary["last_message"]
+            if last is None or last["seq"] <= after:
+                continue
+            messages, has_more = store.get_page(chat_key, after=after, limit=limit)
+            next_cursor = messages[-1]["seq"] if has_more and messages else None
+        else:
+            messages, has_more = store.get_page(chat_key, limit=limit)
+            next_cursor = messages[0]["seq"] if has_more and messages else None
+        session.send({
+            "action": "chat_history",
+            "other_user": other,
+            "messages": messages,
+            "before": None,
+            "after": after,
+            "has_more": has_more,
+            "next_cursor": next_cursor,
+            "receipt": summary["receipt"]
+        })
+        sent += 1
+    return sent
+
+def deliver_pending(session):
+    """Досылает очередь офлайн-доставки кадрами pending.
+
+    Не больше PENDING_WINDOW кадров ждут подтверждения ack_pending:
+    следующие уходят по мере подтверждений, так что большая очередь не
+    переполняет очередь отправки подключения.
+    """
+    username = session.username
+    if not username:
+        return
+    # Это push, а не ответ на запрос, во время которого он отправляется
+    token = current_request.set(None)
+    try:
+        _deliver_pending(session, username)
+    finally:
+        current_request.reset(token)
+
+def _deliver_pending(session, username):
+    with session.pending_lock:
+        while len(session.pending_inflight) < PENDING_WINDOW:
+            messages, cursor, has_more = store.pending_page(username, after=session.pending_cursor,
+                                                            limit=PENDING_BATCH)
+            if not messages:
+                break
+            if not session.send({
+                "action": "pending",
+                "messages": messages,
+                "cursor": cursor,
+                "has_more": has_more
+            }):
+                # Кадр не встал в очередь подключения: позицию не двигаем, кадр
+                # повторится, когда очередь разгрузится (см. ClientSession._overflow)
+                break
+            session.pending_cursor = cursor
+            session.pending_inflight.append(cursor)
+            if hot_path_logged():
+                log.debug(f"[PENDING] {username}: отправлено {len(messages)} сообщений")
+            if not has_more:
+                break
+
+# Подтверждение офлайн-доставки: очередь обрезается до cursor
+def handle_ack_pending(session, message):
+    username = session.username
+    cursor = message.get("cursor")
+    if not isinstance(cursor, int):
+        return
+    store.ack_pending(username, cursor)
+    with session.pending_lock:
+        while session.pending_inflight and session.pending_inflight[0] <= cursor:
+            session.pending_inflight.popleft()
+    deliver_pending(session)
+
+# Отметки доставки и прочтения: одна запись на чат покрывает все
+# сообщения до указанного seq
+def handle_ack_receipts(session, message):
+    username = session.username
+    receipts = message.get("receipts")
+    if not isinstance(receipts, list):
+        return
+    for entry in receipts[:MAX_HISTORY_PAGE_SIZE]:
+        if not isinstance(entry, dict):
+            continue
+        partner = entry.get("user")
+        delivered, read = entry.get("delivered") or 0, entry.get("read") or 0
+        if not isinstance(partner, str) or partner == username:
+            continue
+        if not isinstance(delivered, int) or not isinstance(read, int):
+            continue
+        if group_id(partner) is not None:
+            # В группах отметки никому не рассылаются, прочтение лишь
+            # сбрасывает счётчик непрочитанных
+            if read:
+                store.mark_read(username, partner)
+            continue
+        chat_key = tuple(sorted([username, partner]))
+        old_read = store.get_receipt(chat_key, username)[1]
+        updated = store.update_receipt(chat_key, username, delivered, read)
+        if updated is None:
+            continue
+        if updated[1] > old_read:
+            store.mark_read(username, partner)
+        # Отправитель узнаёт об этом сразу, если он в сети, иначе — из сводок чатов
+        push(partner, {
+            "action": "receipts",
+            "receipts": [{"user": username, "delivered": updated[0], "read": updated[1]}]
+        })
+
+def known_seqs(message):
+    """Разбирает {собеседник: seq} из запроса клиента"""
+    known = message.get("known") or {}
+    if not isinstance(known, dict):
+        return {}
+    return {user: seq for user, seq in known.items() if isinstance(seq, int)}
+
+# Начальная загрузка после входа: одним потоком кадров без ожидания ответов
+def handle_bootstrap(session, message):
+    username = session.username
+    chats_limit = clamp(message.get("max_chats"), BOOTSTRAP_CHATS, MAX_HISTORY_PAGE_SIZE)
+    history_limit = clamp(message.get("history_limit"), BOOTSTRAP_HISTORY, MAX_HISTORY_PAGE_SIZE)
+
+    summaries = store.chat_summaries(username)[:chats_limit]
+    users_version = store.users_version()
+    header = {
+        "action": "bootstrap",
+        "status": "success",
+        "username": username,
+        "codec": session.codec.name,
+        "users_version": users_version,
+        "chats": [summary["user"] for summary in summaries],
+        "summaries": summaries
+    }
+    # Список пользователей не отправляем, если у клиента та же версия
+    if message.get("users_version") != users_version:
+        header["users"] = store.list_users()
+    session.send(header)
+
+    send_chat_updates(session, summaries, known_seqs(message), history_limit)
+    session.send({"action": "bootstrap_done"})
+    if hot_path_logged():
+        log.debug(f"[BOOTSTRAP] Начальная загрузка для {username}: {len(summaries)} чатов")
+
+# Досинхронизация: только сообщения новее известных клиенту
+def handle_sync(session, message):
+    username = session.username
+    summaries = store.chat_summaries(username)
+    sent = send_chat_updates(session, summaries, known_seqs(message),
+                             clamp(message.get("limit"), SYNC_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE))
+    session.send({"action": "sync_done", "chats": sent})
+    if hot_path_logged():
+        log.debug(f"[SYNC] {username}: обновлено чатов {sent}")
+
+# До входа доступны только эти действия; остальные отвечают ошибкой в dispatch
+PUBLIC_ACTIONS = ("register", "login", "resume")
+
+ACTIONS = {
+    "register": handle_register,
+    "login": handle_login,
+    "resume": handle_resume,
+    "send_message": handle_send_message,
+    "get_chat_history": handle_get_chat_history,
+    "get_users": handle_get_users,
+    "get_my_chats": handle_get_my_chats,
+    "bootstrap": handle_bootstrap,
+    "sync": handle_sync,
+    "ack_pending": handle_ack_pending,
+    "ack_receipts": handle_ack_receipts,
+    "create_group": handle_create_group,
+    "get_group": handle_get_group,
+    "add_group_members": handle_add_group_members,
+    "remove_group_member": handle_remove_group_member,
+    "search_messages": handle_search_messages,
+}
+
+def dispatch(session, message):
+    """Передаёт запрос клиента обработчику его действия"""
+    action = message.get("action")
+    handler = ACTIONS.get(action)
+    if hot_path_logged():
+        log.debug(f"[RECV] {session.username or session.addr}: {action}")
+    req_id = message.get("req_id")
+    token = current_request.set((session, req_id))
+    start = time.perf_counter()
+    try:
+        if handler and session.username is None and action not in PUBLIC_ACTIONS:
+            session.send({"action": action, "status": "error", "message": "Требуется вход"})
+        elif handler:
+            handler(session, message)
+        elif req_id is not None:
+            session.send({"action": "error", "status": "error", "message": "Неизвестное действие"})
+    except Exception:
+        metrics.count(f"errors.{action}")
+        raise
+    finally:
+        current_request.reset(token)
+        if handler:
+            metrics.observe(f"action.{action}", time.perf_counter() - start)
+        else:
+            metrics.count("unknown_actions")
+
+def close_session(session):
+    """Убирает пользователя из онлайна, если это его текущее подключение"""
+    username = session.username
+    if username and user_connections.get(username) is session:
+        del user_connections[username]
+        if router:
+            router.user_offline(username)
+
+def count_bytes_in(size, frames):
+    metrics.count("bytes_in", size)
+    metrics.count("frames_in", frames)
+
+def connection_opened(addr):
+    log.info(f"[CONNECT] Подключен клиент {addr}")
+    metrics.count("connections")
+    metrics.gauge("connections_open", 1)
+
+def connection_closed(addr):
+    metrics.gauge("connections_open", -1)
+    log.info(f"[DISCONNECT] Отключен клиент {addr}")
 
 def handle_client(conn, addr, port):
-    """Обрабатывает подключение клиента"""
-    print(f"[CONNECT] Подключен клиент {addr}")
-    username = None
-    
+    """Обрабатывает подключение клиента в отдельном потоке"""
+    connection_opened(addr)
+    session = ThreadedSession(conn, addr)
+    session.start()
+    decoder = FrameDecoder()
+
     try:
         while True:
-            data = conn.recv(1024).decode()
-            print(f"[SERVER RECV RAW] From {addr}: {data}")
+            data = conn.recv(RECV_SIZE)
             if not data:
                 break
-            
-            message = json.loads(data)
-            action = message.get("action")
-            
-            # Регистрация
-            if action == "register":
-                username = message.get("username")
-                password = message.get("password")
-
-                if username in users:
-                    conn.sendall(json.dumps({"status": "error", "message": "Пользователь уже существует"}).encode())
-                else:
-                    users[username] = password
-                    conn.sendall(json.dumps({"status": "success", "message": "Регистрация успешна"}).encode())
-                    print(f"[REGISTER] Зарегистрирован пользователь {username}")
-            
-            # Вход
-            elif action == "login":
-                username = message.get("username")
-                password = message.get("password")
-                
-                if username not in users:
-                    conn.send(json.dumps({"status": "error", "message": "Пользователь не найден"}).encode())
-                elif users[username] != password:
-                    conn.send(json.dumps({"status": "error", "message": "Неверный пароль"}).encode())
-                else:
-                    user_connections[username] = (conn, addr)
-                    conn.sendall(json.dumps({"status": "success", "message": "Вход успешен"}).encode())
-                    print(f"[LOGIN] Пользователь {username} вошел")
-            
-            # Отправка сообщения
-            elif action == "send_message":
-                sender = username
-                recipient = message.get("recipient")
-                text = message.get("text")
-                
-                if recipient not in users:
-                    conn.send(json.dumps({"status": "error", "message": "Получатель не найден"}).encode())
-                else:
-                    # Создаем уникальный ключ чата (сортируем имена)
-                    chat_key = tuple(sorted([sender, recipient]))
-                    if chat_key not in chat_history:
-                        chat_history[chat_key] = []
-                    
-                    msg_data = {
-                        "sender": sender,
-                        "text": text,
-                        "timestamp": datetime.now().strftime("%H:%M:%S")
-                    }
-                    
-                    # Сохраняем в историю
-                    chat_history[chat_key].append(msg_data)
-                    
-                    # Если получатель онлайн, отправить напрямую
-                    if recipient in user_connections:
-                        try:
-                            recipient_conn = user_connections[recipient][0]
-                            recipient_conn.sendall(json.dumps({
-                                "action": "receive_message",
-                                "sender": sender,
-                                "text": text,
-                                "timestamp": msg_data["timestamp"]
-                            }).encode())
-                        except:
-                            pass
-                    
-                    conn.sendall(json.dumps({"status": "success", "message": "Сообщение отправлено"}).encode())
-                    print(f"[MESSAGE] {sender} -> {recipient}: {text}")
-            
-            # Получение истории чата
-            elif action == "get_chat_history":
-                other_user = message.get("other_user")
-                if other_user and other_user in users:
-                    chat_key = tuple(sorted([username, other_user]))
-                    history = chat_history.get(chat_key, [])
-                    conn.sendall(json.dumps({
-                        "action": "chat_history",
-                        "other_user": other_user,
-                        "messages": history
-                    }).encode())
-                    print(f"[HISTORY] Отправлена история чата {chat_key}")
-            
-            # Получение списка пользователей
-            elif action == "get_users":
-                user_list = list(users.keys())
-                conn.sendall(json.dumps({
-                    "action": "users_list",
-                    "users": user_list
-                }).encode())
-                print(f"[USERS] Отправлен список пользователей клиенту {addr}")
-            # Получение списка чатов, где есть переписка с этим пользователем
-            elif action == "get_my_chats":
-                # соберём список собеседников, с которыми у username есть история
-                chats_for_user = []
-                try:
-                    for chat_key, msgs in chat_history.items():
-                        if not msgs:
-                            continue
-                        if username in chat_key:
-                            other = chat_key[1] if chat_key[0] == username else chat_key[0]
-                            chats_for_user.append(other)
-                except Exception:
-                    chats_for_user = []
-                conn.sendall(json.dumps({
-                    "action": "my_chats",
-                    "chats": chats_for_user
-                }).encode())
-                print(f"[MY_CHATS] Отправлен список чатов для {username}: {chats_for_user}")
-    
+            messages = decoder.feed(data)
+            count_bytes_in(len(data), len(messages))
+            for message in messages:
+                dispatch(session, message)
+
     except Exception as e:
-        print(f"[ERROR] Ошибка клиента {addr}: {e}")
-    
+        log.warning(f"[ERROR] Ошибка клиента {addr}: {e}")
+
     finally:
-        if username and username in user_connections:
-            del user_connections[username]
+        close_session(session)
+        session.close()
         conn.close()
-        print(f"[DISCONNECT] Отключен клиент {addr}")
+        connection_closed(addr)
 
-def start_server(host='0.0.0.0', port=5555):
-    """Запускает сервер"""
+async def handle_client_async(reader, writer):
+    """Обрабатывает подключение клиента в цикле событий"""
+    addr = writer.get_extra_info("peername")
+    connection_opened(addr)
+    session = AsyncSession(writer, addr)
+    session.start()
+    decoder = FrameDecoder()
+
+    try:
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                break
+            # Несколько запросов могут прийти одним чтением
+            messages = decoder.feed(data)
+            count_bytes_in(len(data), len(messages))
+            for message in messages:
+                dispatch(session, message)
+                if session.waiting:
+                    # Вход ждёт проверки пароля: следующие запросы клиента — после него
+                    await session.resume()
+
+    except Exception as e:
+        log.warning(f"[ERROR] Ошибка клиента {addr}: {e}")
+
+    finally:
+        close_session(session)
+        session.close()
+        writer.close()
+        connection_closed(addr)
+
+def serve_threaded(host, port, backlog, reuse_port=False):
+    """Режим «поток на клиента»"""
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Несколько процессов слушают один порт, ядро распределяет подключения
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind((host, port))
-    server_socket.listen(5)
-    
-    print(f"[SERVER] Запущен на {host}:{port}")
-    
-    # Запуск потока для обработки поиска сервера
-    discovery_thread = threading.Thread(target=broadcast_discovery, args=(port,), daemon=True)
-    discovery_thread.start()
-    
+    server_socket.listen(backlog)
+    if router:
+        router.start(handle_bus_message)
+
+    log.info(f"[SERVER] Запущен на {host}:{port} (threaded, backlog={backlog})")
+
     try:
         while True:
             conn, addr = server_socket.accept()
             client_thread = threading.Thread(target=handle_client, args=(conn, addr, port))
             client_thread.daemon = True
             client_thread.start()
-    
-    except KeyboardInterrupt:
-        print("\n[SERVER] Выключение...")
-    
     finally:
         server_socket.close()
 
+async def serve_async(host, port, backlog, reuse_port=False):
+    """Режим цикла событий: все клиенты обслуживаются одним потоком"""
+    server = await asyncio.start_server(
+        handle_client_async, host, port, backlog=backlog, reuse_address=True,
+        reuse_port=reuse_port or None
+    )
+    if router:
+        # Сессии asyncio трогаем только из потока цикла событий
+        router.start(handle_bus_message, call=asyncio.get_running_loop().call_soon_threadsafe)
+    log.info(f"[SERVER] Запущен на {host}:{port} (asyncio, backlog={backlog})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if router:
+            # Цикл событий закрывается: шина больше не передаёт ему сообщения
+            router.close()
+
+def configure(db_path, queue_size, policy, auth_workers=DEFAULT_AUTH_WORKERS, auth_queue=DEFAULT_MAX_PENDING):
+    """Открывает хранилище и задаёт параметры очередей процесса"""
+    global store, outbound_queue_size, overflow_policy, authenticator
+    store = SqliteStore(db_path)
+    log.info(f"[STORE] База данных: {db_path}")
+    outbound_queue_size = queue_size
+    overflow_policy = policy
+    authenticator = Authenticator(workers=auth_workers, max_pending=auth_queue)
+
+def serve(host, port, mode, backlog, reuse_port=False):
+    if mode == 'asyncio':
+        asyncio.run(serve_async(host, port, backlog, reuse_port))
+    else:
+        serve_threaded(host, port, backlog, reuse_port)
+
+def bus_address(bus_dir, index):
+    return os.path.join(bus_dir, f"worker-{index}.sock")
+
+def make_router(options, index=0):
+    """Шина процесса: Unix-сокеты между процессами одного сервера, TCP в кластере"""
+    workers = options["workers"]
+    if options["cluster_port"]:
+        host = options["advertise"]
+        # Процессы-обработчики узла — отдельные узлы кластера на портах подряд
+        ports = [options["cluster_port"] + other for other in range(workers)]
+        own = ports[index]
+        peers = {f"{host}:{other}": (host, other) for other in ports if other != own}
+        for seed_host, seed_port in options["join"]:
+            peers.setdefault(f"{seed_host}:{seed_port}", (seed_host, seed_port))
+        return Router(f"{host}:{own}", (options["host"], own), peers,
+                      advertise=(host, own), client=(host, options["port"]))
+    peers = {f"w{other}": bus_address(options["bus_dir"], other)
+             for other in range(workers) if other != index}
+    return Router(f"w{index}", bus_address(options["bus_dir"], index), peers)
+
+def start_discovery(port):
+    # Запуск потока для обработки поиска сервера
+    discovery_thread = threading.Thread(target=broadcast_discovery, args=(port,), daemon=True)
+    discovery_thread.start()
+
+def run_worker(index, options):
+    """Точка входа процесса-обработчика в режиме --workers"""
+    global router
+    # Завершение от управляющего процесса — как Ctrl+C: база закрывается штатно
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    configure_logging(options["log_level"], options["log_sample"])
+    configure(options["db_path"], options["queue_size"], options["policy"],
+              options["auth_workers"], options["auth_queue"])
+    router = make_router(options, index)
+    log.info(f"[WORKER] Процесс {index} (pid {os.getpid()})")
+    if index == 0:
+        # Поиск сервера обслуживает один процесс: нагрузку всех узлов он знает из шины
+        start_discovery(options["port"])
+    if options["admin_port"]:
+        # У каждого процесса свои метрики и свой порт, подряд
+        start_admin(options["admin_port"] + index)
+    try:
+        serve(options["host"], options["port"], options["mode"], options["backlog"], reuse_port=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        router.close()
+        store.close()
+        authenticator.close()
+
+def serve_workers(options):
+    """Запускает options["workers"] процессов на одном порту (SO_REUSEPORT).
+
+    Пользователи распределяются по процессам вместе со своими подключениями;
+    push пользователю из другого процесса идёт через шину (routing.py).
+    Процесс, завершившийся с ошибкой, перезапускается.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("[SERVER] --workers требует SO_REUSEPORT (Linux, BSD, macOS)")
+    # kill/terminate тоже останавливает процессы-обработчики
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    # Схема и миграции — один раз, до запуска процессов
+    SqliteStore(options["db_path"]).close()
+    if not options["cluster_port"]:
+        options["bus_dir"] = tempfile.mkdtemp(prefix="neurochat-bus-")
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+
+    def spawn(index):
+        process = context.Process(target=run_worker, args=(index, options), name=f"worker-{index}")
+        process.start()
+        processes[index] = process
+
+    log.info(f"[SERVER] Запуск {options['workers']} процессов на {options['host']}:{options['port']} "
+          f"({options['mode']})")
+    try:
+        for index in range(options["workers"]):
+            spawn(index)
+        while True:
+            time.sleep(1)
+            for index, process in list(processes.items()):
+                if not process.is_alive():
+                    log.warning(f"[WORKER] Процесс {index} завершился (код {process.exitcode}), перезапускаю")
+                    spawn(index)
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+        if options["bus_dir"]:
+            shutil.rmtree(options["bus_dir"], ignore_errors=True)
+
+def start_server(host='0.0.0.0', port=5555, mode='threaded', backlog=DEFAULT_BACKLOG,
+                 db_path=DEFAULT_DB_PATH, queue_size=DEFAULT_OUTBOUND_QUEUE,
+                 policy=DEFAULT_OVERFLOW_POLICY, workers=1, cluster_port=None, join=(),
+                 advertise=DEFAULT_ADVERTISE, admin_port=None, log_level=DEFAULT_LOG_LEVEL,
+                 log_sample=1, auth_workers=DEFAULT_AUTH_WORKERS, auth_queue=DEFAULT_MAX_PENDING):
+    """Запускает сервер"""
+    global router
+    options = {"host": host, "port": port, "mode": mode, "backlog": backlog, "db_path": db_path,
+               "queue_size": queue_size, "policy": policy, "workers": workers,
+               "cluster_port": cluster_port, "join": list(join), "advertise": advertise,
+               "bus_dir": None, "admin_port": admin_port, "log_level": log_level,
+               "log_sample": log_sample, "auth_workers": auth_workers, "auth_queue": auth_queue}
+    configure_logging(log_level, log_sample)
+    if workers > 1:
+        try:
+            serve_workers(options)
+        except KeyboardInterrupt:
+            log.info("[SERVER] Выключение...")
+        return
+
+    configure(db_path, queue_size, policy, auth_workers, auth_queue)
+    if cluster_port:
+        router = make_router(options)
+    start_discovery(port)
+    if admin_port:
+        start_admin(admin_port)
+    try:
+        serve(host, port, mode, backlog)
+
+    except KeyboardInterrupt:
+        log.info("[SERVER] Выключение...")
+
+    finally:
+        if router:
+            router.close()
+        store.close()
+        authenticator.close()
+
+def resolve_host(value):
+    """Имя узла → IP: один и тот же узел должен называться одинаково на всех узлах"""
+    try:
+        return socket.gethostbyname(value)
+    except OSError:
+        raise argparse.ArgumentTypeError(f"неизвестный хост {value!r}") from None
+
+def parse_peer(value):
+    host, _, port = value.rpartition(":")
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"ожидается хост:порт, получено {value!r}")
+    return resolve_host(host), int(port)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сервер NeuroChat")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded",
+                        help="поток на клиента или один цикл событий asyncio")
+    parser.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG,
+                        help="размер очереди входящих подключений")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH,
+                        help="файл базы данных (':memory:' — без сохранения на диск)")
+    parser.add_argument("--outbound-queue", type=int, default=DEFAULT_OUTBOUND_QUEUE,
+                        help="сколько кадров может ждать отправки одному клиенту")
+    parser.add_argument("--slow-consumer", choices=OVERFLOW_POLICIES, default=DEFAULT_OVERFLOW_POLICY,
+                        help="что делать, когда очередь клиента заполнена")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="число процессов-обработчиков на одном порту")
+    parser.add_argument("--cluster-port", type=int, default=None,
+                        help="порт шины кластера (TCP); процессы --workers занимают порты подряд")
+    parser.add_argument("--join", type=parse_peer, action="append", default=[], metavar="HOST:PORT",
+                        help="порт шины любого узла кластера, к которому присоединиться")
+    parser.add_argument("--advertise", type=resolve_host, default=DEFAULT_ADVERTISE,
+                        help="адрес этого узла для других узлов кластера и клиентов")
+    parser.add_argument("--admin-port", type=int, default=None,
+                        help="порт метрик на 127.0.0.1 (JSON); процессы --workers занимают порты подряд")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default=DEFAULT_LOG_LEVEL,
+                        help="уровень журнала; кадры и сообщения пишутся только на уровне DEBUG")
+    parser.add_argument("--log-sample", type=int, default=1, metavar="N",
+                        help="на уровне DEBUG писать в среднем одно из N событий горячего пути")
+    parser.add_argument("--auth-workers", type=int, default=DEFAULT_AUTH_WORKERS,
+                        help="потоков хеширования паролей (scrypt) в процессе")
+    parser.add_argument("--auth-queue", type=int, default=DEFAULT_MAX_PENDING,
+                        help="сколько входов и регистраций может ждать проверки пароля; "
+                             "сверх этого клиенту отвечают «повторите позже»")
+    args = parser.parse_args(argv)
+    if (args.workers > 1 or args.cluster_port) and args.db == ":memory:":
+        parser.error("--workers и --cluster-port: процессы делят файл базы, ':memory:' не подходит")
+    if args.join and not args.cluster_port:
+        parser.error("--join требует --cluster-port")
+    return args
+
 if __name__ == "__main__":
-    start_server()
+    args = parse_args()
+    start_server(args.host, args.port, mode=args.mode, backlog=args.backlog, db_path=args.db,
+                 queue_size=args.outbound_queue, policy=args.slow_consumer, workers=args.workers,
+                 cluster_port=args.cluster_port, join=args.join, advertise=args.advertise,
+                 admin_port=args.admin_port, log_level=args.log_level, log_sample=args.log_sample,
+                 auth_workers=args.auth_workers, auth_queue=args.auth_queue)
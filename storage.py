@@ -0,0 +1,787 @@
+"""
+Persistent storage for the server: accounts and chat history.
+`MessageStore` is the interface the server talks to; `SqliteStore`
+implements it on SQLite in WAL mode. The database file is the snapshot and
+the WAL is the log tail, so startup only replays the tail instead of
+loading everything into memory.
+
+Writes are group-committed: they run inside an open transaction (visible
+to later reads on the same connection straight away) and a background
+thread commits the whole batch once `commit_interval` has passed or
+`max_batch` writes are pending. At most one batch can be lost on a crash;
+`flush()` forces a commit. A call that writes several rows (a message and
+its index entries) does so inside a savepoint, so if it fails halfway none
+of its rows stay in the batch. Several processes may share one database file
+(`server.py --workers`); their batches then take turns on SQLite's write
+lock.
+
+Messages are indexed for search as they are appended (see search.py for
+tokenization): a query looks up term ranges of the user's own chats only
+and never scans messages.
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from metrics import Histogram
+from search import prefix_range, query_terms, tokenize
+
+DEFAULT_DB_PATH = 'neurochat.db'
+# Characters of the last message kept in the chat index as a preview
+PREVIEW_LENGTH = 100
+# Groups are addressed like users, by the name "group:<id>"
+GROUP_PREFIX = 'group:'
+
+
+def chat_id(chat_key):
+    """Stable text id of a chat key (a sorted tuple of usernames)."""
+    return json.dumps(list(chat_key), ensure_ascii=False)
+
+
+def preview(text):
+    """Start of a message kept with the chat as its last message."""
+    # Rows written before text was validated may hold a number or a blob
+    return text[:PREVIEW_LENGTH] if isinstance(text, str) else ""
+
+
+def group_chat(gid):
+    """Name of a group as it appears in place of a chat partner."""
+    return f"{GROUP_PREFIX}{gid}"
+
+
+def group_key(gid):
+    """Chat key of a group: a one-element tuple with its name."""
+    return (group_chat(gid),)
+
+
+def group_id(name):
+    """Id of the group called `name`, or None if it is not a group name."""
+    if not isinstance(name, str) or not name.startswith(GROUP_PREFIX):
+        return None
+    number = name[len(GROUP_PREFIX):]
+    return int(number) if number.isdigit() else None
+
+
+class MessageStore:
+    """Storage interface used by the server."""
+
+    def add_user(self, username, password):
+        """Create an account; returns False if the name is taken."""
+        raise NotImplementedError
+
+    def get_password(self, username):
+        """Return the stored password hash, or None for an unknown user."""
+        raise NotImplementedError
+
+    def set_password(self, username, password):
+        """Replace the stored password hash (rehash on login)."""
+        raise NotImplementedError
+
+    def add_session(self, digest, username, expires):
+        """Remember a session token (by its digest) until `expires` (epoch)."""
+        raise NotImplementedError
+
+    def session_user(self, digest, now):
+        """Owner of an unexpired session token, or None."""
+        raise NotImplementedError
+
+    def user_exists(self, username):
+        return self.get_password(username) is not None
+
+    def list_users(self):
+        raise NotImplementedError
+
+    def users_version(self):
+        """Opaque tag that changes whenever the user directory changes."""
+        raise NotImplementedError
+
+    def append_message(self, chat_key, message):
+        """Append a message dict (sender/text/timestamp) to a chat.
+
+        Sets `message["seq"]`, its position in the chat (from 1), and
+        `message["id"]`, a globally unique id, unless the caller already
+        chose one; returns the seq.
+        """
+        raise NotImplementedError
+
+    def get_history(self, chat_key):
+        """Return the chat's messages (with `seq` and `id`), oldest first."""
+        raise NotImplementedError
+
+    def get_page(self, chat_key, before=None, after=None, limit=50):
+        """Return (messages, has_more) for one page of a chat, oldest first.
+
+        Messages carry their `seq` and `id`. With `after` the page holds the oldest
+        messages newer than that seq; otherwise the newest messages older
+        than `before` (or the newest overall). `has_more` tells whether
+        further messages exist in the paging direction.
+        """
+        raise NotImplementedError
+
+    def chats_for(self, username):
+        """Return the users that `username` has a non-empty chat with."""
+        return [summary["user"] for summary in self.chat_summaries(username)]
+
+    def chat_summaries(self, username):
+        """Return `username`'s chats, most recently active first.
+
+        Each entry is a dict with `user`, `last_activity` (epoch seconds),
+        `last_message` (a preview with seq/id/sender/text/timestamp),
+        `unread` (messages from the partner not yet read) and `receipt`
+        (the partner's delivered/read seqs, see `get_receipt`). Groups the
+        user belongs to are listed too: their `user` is the group name,
+        `group` holds its id and display name, and `last_message` is None
+        until the first message.
+        """
+        raise NotImplementedError
+
+    def update_receipt(self, chat_key, username, delivered=0, read=0):
+        """Advance `username`'s delivered/read seqs in a chat.
+
+        Both are watermarks: every message up to that seq is delivered
+        (read). They never move back and are capped at the chat's last seq;
+        reading implies delivery. Returns the new (delivered, read), or None
+        if nothing changed.
+        """
+        raise NotImplementedError
+
+    def get_receipt(self, chat_key, username):
+        """Return `username`'s (delivered, read) seqs in a chat, (0, 0) if none."""
+        raise NotImplementedError
+
+    def mark_read(self, username, partner):
+        """Mark every message in the chat with `partner` (a user or a group
+        name) as read by `username`."""
+        raise NotImplementedError
+
+    def create_group(self, name, owner, members):
+        """Create a group owned by `owner`; the owner is always a member.
+        Returns the group id."""
+        raise NotImplementedError
+
+    def get_group(self, gid):
+        """Return the group as a dict (`key`, `id`, `name`, `owner`, `members`),
+        or None if there is no such group."""
+        raise NotImplementedError
+
+    def is_group_member(self, gid, username):
+        raise NotImplementedError
+
+    def group_members(self, gid):
+        raise NotImplementedError
+
+    def add_group_members(self, gid, usernames):
+        """Add users to a group; returns the ones that were not members yet."""
+        raise NotImplementedError
+
+    def remove_group_member(self, gid, username):
+        """Remove a user from a group; returns False if they were not a member."""
+        raise NotImplementedError
+
+    def search_messages(self, username, query, chat_key=None, before=None, limit=20):
+        """Find messages containing every word of `query` (as prefixes) in
+        the chats of `username`, or only in `chat_key`, newest first.
+
+        Returns (results, has_more). Every result is a message dict with
+        `chat` (the partner or group name) and `cursor`; the last cursor
+        is passed as `before` to get the next page.
+        """
+        raise NotImplementedError
+
+    def enqueue_pending(self, username, chat_key, seq):
+        """Queue message `seq` of a chat for delivery to `username` when they log in."""
+        raise NotImplementedError
+
+    def pending_page(self, username, after=0, limit=200):
+        """Return (messages, cursor, has_more) from `username`'s delivery queue.
+
+        Messages come in queue order after the `after` cursor and carry
+        their `seq` and `id`; `cursor` is the position of the last one (or
+        `after` if there are none) and is what `ack_pending` takes.
+        """
+        raise NotImplementedError
+
+    def ack_pending(self, username, cursor):
+        """Drop every queued delivery of `username` up to and including `cursor`."""
+        raise NotImplementedError
+
+    def stats(self):
+        """Latency of writes and commits for the server's metrics."""
+        return {}
+
+    def flush(self):
+        """Make every write so far durable."""
+
+    def close(self):
+        self.flush()
+
+
+class SqliteStore(MessageStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            chat TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            text TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            id TEXT,
+            PRIMARY KEY (chat, seq)
+        ) WITHOUT ROWID;
+        -- One row per (user, partner): updated on every message so that
+        -- get_my_chats never scans other users' chats
+        CREATE TABLE IF NOT EXISTS chat_index (
+            username TEXT NOT NULL,
+            partner TEXT NOT NULL,
+            last_activity REAL NOT NULL,
+            last_seq INTEGER NOT NULL,
+            last_sender TEXT NOT NULL,
+            last_text TEXT NOT NULL,
+            last_timestamp TEXT NOT NULL,
+            unread INTEGER NOT NULL DEFAULT 0,
+            last_id TEXT,
+            PRIMARY KEY (username, partner)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS chat_index_recent ON chat_index (username, last_activity DESC);
+        -- Messages not yet delivered to an offline recipient, pushed at login
+        CREATE TABLE IF NOT EXISTS pending (
+            qid INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            chat TEXT NOT NULL,
+            seq INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS pending_user ON pending (username, qid);
+        -- Delivered/read watermarks of each participant of a chat
+        CREATE TABLE IF NOT EXISTS receipts (
+            chat TEXT NOT NULL,
+            username TEXT NOT NULL,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            read INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat, username)
+        ) WITHOUT ROWID;
+        -- Group chats: messages live in `messages` under the group's chat id
+        -- once; the last message is kept here rather than in a chat_index
+        -- row per member, so a message costs the same for any group size
+        CREATE TABLE IF NOT EXISTS groups (
+            gid INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            last_activity REAL NOT NULL,
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            last_sender TEXT,
+            last_text TEXT,
+            last_timestamp TEXT,
+            last_id TEXT
+        );
+        -- `read` is the last seq the member has read
+        CREATE TABLE IF NOT EXISTS group_members (
+            gid INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            read INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (gid, username)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS group_members_user ON group_members (username);
+        -- Full-text search: `doc` numbers messages in the order they were
+        -- indexed and orders results across chats; the inverted index has a
+        -- row per distinct term of a message, clustered by chat so a search
+        -- only reads the chats of the user who asks
+        CREATE TABLE IF NOT EXISTS search_docs (
+            doc INTEGER PRIMARY KEY,
+            chat TEXT NOT NULL,
+            seq INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS search_index (
+            chat TEXT NOT NULL,
+            term TEXT NOT NULL,
+            doc INTEGER NOT NULL,
+            PRIMARY KEY (chat, term, doc)
+        ) WITHOUT ROWID;
+        -- Resumable sessions: SHA-256 of the token, never the token itself
+        CREATE TABLE IF NOT EXISTS sessions (
+            digest TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            expires REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expires);
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, commit_interval=0.005, max_batch=512):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        # isolation_level=None: transactions are managed explicitly below
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL fsyncs only at checkpoints, not on every commit
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        self._migrate()
+        self._build_chat_index()
+        self._build_search_index()
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        self._in_transaction = False
+        self._pending = 0
+        self._closed = False
+        # Time a write waits for the connection plus runs, and per commit
+        self.write_latency = Histogram()
+        self.commit_latency = Histogram()
+        self.committed_writes = 0
+        self._committer = threading.Thread(target=self._commit_worker, daemon=True)
+        self._committer.start()
+
+    # --- group commit ---
+    def _begin(self):
+        """Open the batch transaction if none is open (under `_lock`)."""
+        if not self._in_transaction:
+            # IMMEDIATE takes the write lock up front: with several server
+            # processes on one file, a deferred transaction that read first
+            # could not upgrade to a write once another process committed
+            self._db.execute("BEGIN IMMEDIATE")
+            self._in_transaction = True
+            self._cond.notify()
+
+    def _write(self, sql, params=()):
+        start = time.perf_counter()
+        with self._lock:
+            self._begin()
+            cursor = self._db.execute(sql, params)
+            self._pending += 1
+            if self._pending >= self.max_batch:
+                self._cond.notify()
+        self.write_latency.observe(time.perf_counter() - start)
+        return cursor
+
+    @contextmanager
+    def _atomic(self):
+        """Group the writes of one call: if any of them fails, the earlier
+        ones are undone too rather than left in the batch for the committer."""
+        with self._lock:
+            self._begin()
+            self._db.execute("SAVEPOINT call")
+            try:
+                yield
+            except BaseException:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK TO call")
+                    self._db.execute("RELEASE call")
+                else:
+                    # SQLite has already rolled back the whole batch
+                    self._in_transaction = False
+                raise
+            self._db.execute("RELEASE call")
+
+    def _commit_locked(self):
+        if self._in_transaction:
+            start = time.perf_counter()
+            self._db.execute("COMMIT")
+            self.commit_latency.observe(time.perf_counter() - start)
+            self.committed_writes += self._pending
+            self._in_transaction = False
+        self._pending = 0
+
+    def _commit_worker(self):
+        with self._cond:
+            while True:
+                while not self._in_transaction and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                # Give concurrent writers a chance to join this batch
+                self._cond.wait_for(lambda: self._pending >= self.max_batch or self._closed,
+                                    timeout=self.commit_interval)
+                self._commit_locked()
+
+    def flush(self):
+        with self._lock:
+            self._commit_locked()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._commit_locked()
+            self._closed = True
+            self._cond.notify_all()
+        self._committer.join()
+        with self._lock:
+            try:
+                # Fold the WAL back into the main file so the next start is instant
+                self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.DatabaseError:
+                pass
+            self._db.close()
+
+    def _migrate(self):
+        """Bring databases created by older versions up to the current schema."""
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(messages)")]
+        if "id" not in columns:
+            self._db.execute("ALTER TABLE messages ADD COLUMN id TEXT")
+        self._db.execute("UPDATE messages SET id = lower(hex(randomblob(16))) WHERE id IS NULL")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(chat_index)")]
+        if "last_id" not in columns:
+            self._db.execute("ALTER TABLE chat_index ADD COLUMN last_id TEXT")
+            rows = self._db.execute("SELECT username, partner, last_seq FROM chat_index").fetchall()
+            for username, partner, seq in rows:
+                self._db.execute(
+                    "UPDATE chat_index SET last_id = (SELECT id FROM messages WHERE chat = ? AND seq = ?)"
+                    " WHERE username = ? AND partner = ?",
+                    (chat_id(tuple(sorted([username, partner]))), seq, username, partner),
+                )
+
+    def stats(self):
+        commits = self.commit_latency.snapshot()
+        return {"write": self.write_latency.snapshot(), "commit": commits,
+                "writes_per_commit": round(self.committed_writes / commits["count"], 1) if commits["count"] else 0}
+
+    def _build_chat_index(self):
+        """Fill chat_index for databases created before it existed."""
+        if self._db.execute("SELECT 1 FROM chat_index LIMIT 1").fetchone():
+            return
+        rows = self._db.execute(
+            "SELECT chat, seq, sender, text, timestamp, id FROM messages"
+            " WHERE (chat, seq) IN (SELECT chat, MAX(seq) FROM messages GROUP BY chat)"
+        ).fetchall()
+        self._db.execute("BEGIN")
+        for cid, seq, sender, text, ts, mid in rows:
+            key = json.loads(cid)
+            if len(key) != 2:
+                # A group chat: its last message is kept in `groups`
+                continue
+            a, b = key
+            for owner, partner in {(a, b), (b, a)}:
+                self._db.execute(
+                    "INSERT INTO chat_index VALUES (?, ?, 0, ?, ?, ?, ?, 0, ?)",
+                    (owner, partner, seq, sender, preview(text), ts, mid),
+                )
+        self._db.execute("COMMIT")
+
+    def _build_search_index(self):
+        """Index messages of databases created before search existed."""
+        if self._db.execute("SELECT 1 FROM search_docs LIMIT 1").fetchone():
+            return
+        cursor = self._db.execute("SELECT chat, seq, text FROM messages")
+        self._db.execute("BEGIN")
+        for cid, seq, text in cursor.fetchall():
+            # Rows written before text was validated may hold a number or a blob
+            self._index_terms(cid, seq, text if isinstance(text, str) else "")
+        self._db.execute("COMMIT")
+
+    def _index_terms(self, cid, seq, text):
+        doc = self._db.execute("INSERT INTO search_docs (chat, seq) VALUES (?, ?)", (cid, seq)).lastrowid
+        self._db.executemany("INSERT OR IGNORE INTO search_index (chat, term, doc) VALUES (?, ?, ?)",
+                             [(cid, term, doc) for term in tokenize(text)])
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    # --- users ---
+    def add_user(self, username, password):
+        with self._lock:
+            try:
+                self._write("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
+            except sqlite3.IntegrityError:
+                return False
+            return True
+
+    def get_password(self, username):
+        rows = self._query("SELECT password FROM users WHERE username = ?", (username,))
+        return rows[0][0] if rows else None
+
+    def set_password(self, username, password):
+        self._write("UPDATE users SET password = ? WHERE username = ?", (password, username))
+
+    def add_session(self, digest, username, expires):
+        with self._atomic():
+            # Expired sessions go as new ones come, so the table stays small
+            self._write("DELETE FROM sessions WHERE expires < ?", (time.time(),))
+            self._write("INSERT OR REPLACE INTO sessions (digest, username, expires) VALUES (?, ?, ?)",
+                        (digest, username, expires))
+
+    def session_user(self, digest, now):
+        rows = self._query("SELECT username FROM sessions WHERE digest = ? AND expires >= ?", (digest, now))
+        return rows[0][0] if rows else None
+
+    def list_users(self):
+        return [row[0] for row in self._query("SELECT username FROM users ORDER BY rowid")]
+
+    def users_version(self):
+        # Accounts are never deleted, so the newest rowid identifies the directory
+        (version,) = self._query("SELECT COALESCE(MAX(rowid), 0) FROM users")[0]
+        return version
+
+    # --- messages ---
+    def append_message(self, chat_key, message):
+        cid = chat_id(chat_key)
+        # Read the last seq inside the write transaction so that no other
+        # process can take the same seq in between
+        with self._atomic():
+            (last,) = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM messages WHERE chat = ?", (cid,)).fetchone()
+            message["seq"] = last + 1
+            if not message.get("id"):
+                message["id"] = uuid.uuid4().hex
+            self._write(
+                "INSERT INTO messages (chat, seq, sender, text, timestamp, id) VALUES (?, ?, ?, ?, ?, ?)",
+                (cid, message["seq"], message["sender"], message["text"], message["timestamp"], message["id"]),
+            )
+            self._index_message(chat_key, message)
+            self._index_terms(cid, message["seq"], message["text"])
+        return message["seq"]
+
+    def _index_message(self, chat_key, message):
+        now = time.time()
+        gid = group_id(chat_key[0])
+        if gid is not None:
+            self._write(
+                "UPDATE groups SET last_activity = ?, last_seq = ?, last_sender = ?, last_text = ?,"
+                " last_timestamp = ?, last_id = ? WHERE gid = ?",
+                (now, message["seq"], message["sender"], preview(message["text"]),
+                 message["timestamp"], message["id"], gid),
+            )
+            return
+        a, b = chat_key
+        for owner, partner in {(a, b), (b, a)}:
+            self._write(
+                "INSERT INTO chat_index VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (username, partner) DO UPDATE SET"
+                " last_activity = excluded.last_activity, last_seq = excluded.last_seq,"
+                " last_sender = excluded.last_sender, last_text = excluded.last_text,"
+                " last_timestamp = excluded.last_timestamp, unread = unread + excluded.unread,"
+                " last_id = excluded.last_id",
+                (owner, partner, now, message["seq"], message["sender"],
+                 preview(message["text"]), message["timestamp"],
+                 0 if message["sender"] == owner else 1, message["id"]),
+            )
+
+    def get_history(self, chat_key):
+        rows = self._query(
+            "SELECT seq, id, sender, text, timestamp FROM messages WHERE chat = ? ORDER BY seq",
+            (chat_id(chat_key),),
+        )
+        return [self._message_row(row) for row in rows]
+
+    @staticmethod
+    def _message_row(row):
+        seq, mid, sender, text, ts = row
+        return {"seq": seq, "id": mid, "sender": sender, "text": text, "timestamp": ts}
+
+    def get_page(self, chat_key, before=None, after=None, limit=50):
+        cid = chat_id(chat_key)
+        if after is not None:
+            rows = self._query(
+                "SELECT seq, id, sender, text, timestamp FROM messages"
+                " WHERE chat = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (cid, after, limit + 1),
+            )
+        else:
+            rows = self._query(
+                "SELECT seq, id, sender, text, timestamp FROM messages"
+                " WHERE chat = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (cid, before if before is not None else 2 ** 62, limit + 1),
+            )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after is None:
+            rows.reverse()
+        return [self._message_row(row) for row in rows], has_more
+
+    def chat_summaries(self, username):
+        rows = self._query(
+            "SELECT partner, last_activity, last_seq, last_id, last_sender, last_text, last_timestamp, unread"
+            " FROM chat_index WHERE username = ? ORDER BY last_activity DESC",
+            (username,),
+        )
+        # Partners' watermarks, one lookup for all chats
+        receipts = {}
+        if rows:
+            chats = {chat_id(tuple(sorted([username, row[0]]))): row[0] for row in rows}
+            marks = ",".join("?" * len(chats))
+            for cid, partner, delivered, read in self._query(
+                    f"SELECT chat, username, delivered, read FROM receipts WHERE chat IN ({marks})",
+                    tuple(chats)):
+                if chats[cid] == partner:
+                    receipts[partner] = {"delivered": delivered, "read": read}
+        summaries = [{
+            "user": partner,
+            "last_activity": activity,
+            "last_message": {"seq": seq, "id": mid, "sender": sender, "text": text, "timestamp": ts},
+            "unread": unread,
+            "receipt": receipts.get(partner, {"delivered": 0, "read": 0}),
+        } for partner, activity, seq, mid, sender, text, ts, unread in rows]
+        groups = self._query(
+            "SELECT g.gid, g.name, g.last_activity, g.last_seq, g.last_id, g.last_sender, g.last_text,"
+            " g.last_timestamp, m.read FROM group_members m JOIN groups g ON g.gid = m.gid"
+            " WHERE m.username = ?",
+            (username,),
+        )
+        for gid, name, activity, seq, mid, sender, text, ts, read in groups:
+            summaries.append({
+                "user": group_chat(gid),
+                "group": {"id": gid, "name": name},
+                "last_activity": activity,
+                "last_message": ({"seq": seq, "id": mid, "sender": sender, "text": text, "timestamp": ts}
+                                 if seq else None),
+                "unread": max(seq - read, 0),
+                "receipt": {"delivered": 0, "read": 0},
+            })
+        if groups:
+            summaries.sort(key=lambda summary: summary["last_activity"], reverse=True)
+        return summaries
+
+    def mark_read(self, username, partner):
+        gid = group_id(partner)
+        if gid is not None:
+            self._write(
+                "UPDATE group_members SET read = (SELECT last_seq FROM groups WHERE gid = ?)"
+                " WHERE gid = ? AND username = ?",
+                (gid, gid, username),
+            )
+            return
+        self._write(
+            "UPDATE chat_index SET unread = 0 WHERE username = ? AND partner = ? AND unread > 0",
+            (username, partner),
+        )
+
+    # --- search ---
+    def _user_chats(self, username):
+        """{chat id: partner or group name} of every chat the user can read."""
+        chats = {chat_id(tuple(sorted([username, partner]))): partner
+                 for (partner,) in self._query("SELECT partner FROM chat_index WHERE username = ?", (username,))}
+        for (gid,) in self._query("SELECT gid FROM group_members WHERE username = ?", (username,)):
+            chats[chat_id(group_key(gid))] = group_chat(gid)
+        return chats
+
+    def search_messages(self, username, query, chat_key=None, before=None, limit=20):
+        terms = query_terms(query)
+        if not terms:
+            return [], False
+        if chat_key is None:
+            chats = self._user_chats(username)
+        else:
+            partner = chat_key[0] if len(chat_key) == 1 else next(
+                (name for name in chat_key if name != username), username)
+            chats = {chat_id(chat_key): partner}
+        if not chats:
+            return [], False
+        before = before if before is not None else 2 ** 62
+        chat_list = json.dumps(list(chats), ensure_ascii=False)
+        # One query for the page: the docs of each term (as a prefix) in the
+        # user's chats below the cursor, intersected, newest first
+        match = ("SELECT DISTINCT doc FROM search_index WHERE chat IN (SELECT value FROM json_each(?))"
+                 " AND term >= ? AND term < ? AND doc < ?")
+        params = []
+        for term in terms:
+            params += [chat_list, *prefix_range(term), before]
+        rows = self._query(
+            f"SELECT d.doc, d.chat, m.seq, m.id, m.sender, m.text, m.timestamp FROM"
+            f" ({' INTERSECT '.join([match] * len(terms))} ORDER BY doc DESC LIMIT ?) hit"
+            " JOIN search_docs d ON d.doc = hit.doc JOIN messages m ON m.chat = d.chat AND m.seq = d.seq"
+            " ORDER BY d.doc DESC",
+            (*params, limit + 1),
+        )
+        has_more = len(rows) > limit
+        results = []
+        for doc, cid, *message in rows[:limit]:
+            result = self._message_row(message)
+            result["chat"] = chats[cid]
+            result["cursor"] = doc
+            results.append(result)
+        return results, has_more
+
+    # --- groups ---
+    def create_group(self, name, owner, members):
+        with self._atomic():
+            gid = self._write("INSERT INTO groups (name, owner, last_activity) VALUES (?, ?, ?)",
+                              (name, owner, time.time())).lastrowid
+            self._add_members(gid, [owner] + list(members))
+        return gid
+
+    def _add_members(self, gid, usernames):
+        added = []
+        for username in dict.fromkeys(usernames):
+            # New members start with the history already read
+            cursor = self._write(
+                "INSERT OR IGNORE INTO group_members (gid, username, read)"
+                " SELECT ?, ?, last_seq FROM groups WHERE gid = ?",
+                (gid, username, gid),
+            )
+            if cursor.rowcount:
+                added.append(username)
+        return added
+
+    def get_group(self, gid):
+        rows = self._query("SELECT name, owner FROM groups WHERE gid = ?", (gid,))
+        if not rows:
+            return None
+        name, owner = rows[0]
+        return {"key": group_chat(gid), "id": gid, "name": name, "owner": owner,
+                "members": self.group_members(gid)}
+
+    def is_group_member(self, gid, username):
+        return bool(self._query("SELECT 1 FROM group_members WHERE gid = ? AND username = ?",
+                                (gid, username)))
+
+    def group_members(self, gid):
+        return [row[0] for row in self._query(
+            "SELECT username FROM group_members WHERE gid = ? ORDER BY username", (gid,))]
+
+    def add_group_members(self, gid, usernames):
+        with self._atomic():
+            return self._add_members(gid, usernames)
+
+    def remove_group_member(self, gid, username):
+        return self._write("DELETE FROM group_members WHERE gid = ? AND username = ?",
+                           (gid, username)).rowcount > 0
+
+    def update_receipt(self, chat_key, username, delivered=0, read=0):
+        cid = chat_id(chat_key)
+        with self._lock:
+            self._begin()
+            (last,) = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM messages WHERE chat = ?", (cid,)).fetchone()
+            if not last:
+                return None
+            row = self._db.execute("SELECT delivered, read FROM receipts WHERE chat = ? AND username = ?",
+                                   (cid, username)).fetchone()
+            old = row or (0, 0)
+            read = max(old[1], min(read, last))
+            delivered = max(old[0], min(max(delivered, read), last))
+            if (delivered, read) == old:
+                return None
+            self._write(
+                "INSERT INTO receipts VALUES (?, ?, ?, ?) ON CONFLICT (chat, username)"
+                " DO UPDATE SET delivered = excluded.delivered, read = excluded.read",
+                (cid, username, delivered, read),
+            )
+            return delivered, read
+
+    def get_receipt(self, chat_key, username):
+        rows = self._query("SELECT delivered, read FROM receipts WHERE chat = ? AND username = ?",
+                           (chat_id(chat_key), username))
+        return rows[0] if rows else (0, 0)
+
+    # --- offline delivery ---
+    def enqueue_pending(self, username, chat_key, seq):
+        self._write("INSERT INTO pending (username, chat, seq) VALUES (?, ?, ?)",
+                    (username, chat_id(chat_key), seq))
+
+    def pending_page(self, username, after=0, limit=200):
+        rows = self._query(
+            "SELECT p.qid, m.seq, m.id, m.sender, m.text, m.timestamp FROM pending p"
+            " JOIN messages m ON m.chat = p.chat AND m.seq = p.seq"
+            " WHERE p.username = ? AND p.qid > ? ORDER BY p.qid LIMIT ?",
+            (username, after, limit + 1),
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        cursor = rows[-1][0] if rows else after
+        return [self._message_row(row[1:]) for row in rows], cursor, has_more
+
+    def ack_pending(self, username, cursor):
+        self._write("DELETE FROM pending WHERE username = ? AND qid <= ?", (username, cursor))
@@ -0,0 +1,99 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+# The modules live at the top of the repository, not in a package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import server  # noqa: E402
+from storage import SqliteStore  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "neurochat.db")
+
+
+@pytest.fixture
+def store(db_path):
+    store = SqliteStore(db_path)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def server_port(tmp_path):
+    """Run server.py in its own process; its files go to tmp_path."""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "server.py"), "--host", "127.0.0.1", "--port", str(port),
+         "--mode", "asyncio"],
+        cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError("server did not start")
+                time.sleep(0.05)
+        yield port
+    finally:
+        process.kill()
+        process.wait()
+
+
+class RecordingSession(server.ClientSession):
+    """A connection that keeps the frames it would write."""
+
+    def __init__(self, username=None):
+        super().__init__(("test", 0))
+        self.username = username
+        self.sent = []
+
+    def start(self):
+        pass
+
+    def send_frame(self, frame, message):
+        self.sent.append(message)
+        return True
+
+
+@pytest.fixture
+def chat_server(db_path, monkeypatch):
+    monkeypatch.setattr(server, "user_connections", {})
+    monkeypatch.setattr(server, "router", None)
+    server.configure(db_path, server.DEFAULT_OUTBOUND_QUEUE, server.DEFAULT_OVERFLOW_POLICY)
+    yield server
+    server.authenticator.close()
+    server.store.close()
+
+
+@pytest.fixture
+def new_session():
+    """Make a connection; with a name it is already logged in."""
+    def connect(username=None):
+        session = RecordingSession(username)
+        if username:
+            server.user_connections[username] = session
+        return session
+    return connect
+
+
+@pytest.fixture
+def register(chat_server, new_session):
+    """Create an account through the server, with a hashed password."""
+    def register(username, password="secret"):
+        session = new_session()
+        chat_server.dispatch(session, {"action": "register", "username": username, "password": password})
+        assert session.sent[-1]["status"] == "success"
+    return register
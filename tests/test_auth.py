@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from auth import (AuthBusy, Authenticator, check_password, hash_password, needs_rehash,
+                  new_session_token, session_digest)
+
+
+@pytest.fixture
+def authenticator():
+    authenticator = Authenticator(workers=1, max_pending=4)
+    yield authenticator
+    authenticator.close()
+
+
+def test_hash_and_check():
+    stored = hash_password("secret")
+    assert check_password("secret", stored)
+    assert not check_password("wrong", stored)
+    assert not needs_rehash(stored)
+
+
+def test_plain_password_verifies_and_is_rehashed(authenticator):
+    valid, new_hash = authenticator.verify("alice", "secret", "secret").result()
+    assert valid
+    assert new_hash and check_password("secret", new_hash)
+
+
+def test_cached_login_skips_the_kdf(authenticator):
+    stored = hash_password("secret")
+    assert authenticator.verify("alice", "secret", stored).result() == (True, None)
+    assert authenticator.verify("alice", "secret", stored).result() == (True, None)
+    stats = authenticator.stats()
+    assert stats["jobs"] == 1 and stats["cache_hits"] == 1
+
+
+def test_changed_hash_misses_the_cache(authenticator):
+    old = hash_password("secret")
+    authenticator.verify("alice", "secret", old).result()
+    new = hash_password("changed")
+    assert authenticator.verify("alice", "secret", new).result() == (False, None)
+    assert authenticator.stats()["cache_hits"] == 0
+
+
+def test_wrong_password_and_non_string(authenticator):
+    stored = hash_password("secret")
+    assert authenticator.verify("alice", "nope", stored).result() == (False, None)
+    assert authenticator.verify("alice", None, stored).result() == (False, None)
+
+
+def test_full_pool_rejects(authenticator):
+    release = threading.Event()
+    futures = [authenticator.submit(release.wait) for _ in range(authenticator.max_pending)]
+    with pytest.raises(AuthBusy):
+        authenticator.submit(release.wait)
+    release.set()
+    for future in futures:
+        future.result()
+    assert authenticator.stats()["rejected"] == 1
+
+
+def test_session_token_digest():
+    token, digest = new_session_token()
+    assert digest == session_digest(token)
+    assert token not in digest
@@ -0,0 +1,90 @@
+import socket
+
+import pytest
+
+import codec
+from codec import JSON, CodecError, available_codecs, codec_by_id, get_codec, negotiate
+from protocol import HEADER, FrameDecoder, encode_frame, send_message
+
+needs_msgpack = pytest.mark.skipif(codec.msgpack is None, reason="msgpack is not installed")
+
+
+def test_json_is_always_available_and_last():
+    assert available_codecs()[-1] == "json"
+    assert get_codec("json") is JSON
+    assert codec_by_id(JSON.codec_id) is JSON
+
+
+def test_unknown_codec():
+    with pytest.raises(CodecError):
+        get_codec("xml")
+    with pytest.raises(CodecError):
+        codec_by_id(99)
+
+
+def test_negotiate_picks_the_peers_first_supported_choice():
+    assert negotiate(["xml", "json"]) is JSON
+    assert negotiate(None) is JSON
+    assert negotiate(["xml"]) is JSON
+    assert negotiate(available_codecs()).name == available_codecs()[0]
+
+
+@needs_msgpack
+def test_msgpack_is_preferred_and_round_trips():
+    assert available_codecs()[0] == "msgpack"
+    msgpack_codec = get_codec("msgpack")
+    message = {"action": "receive_message", "text": "привет", "seq": 7}
+    frame = encode_frame(message, msgpack_codec)
+    assert FrameDecoder().feed(frame + encode_frame(message)) == [message, message]
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk, "server closed the connection"
+        data += chunk
+    return data
+
+
+def read_frame(sock):
+    """Return the codec the frame was written with and its message."""
+    length, codec_id = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    frame_codec = codec_by_id(codec_id)
+    return frame_codec, frame_codec.decode(recv_exactly(sock, length))
+
+
+def login(port, codecs):
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    send_message(sock, {"action": "register", "username": "alice", "password": "secret"})
+    read_frame(sock)
+    send_message(sock, {"action": "login", "username": "alice", "password": "secret", "codecs": codecs})
+    return sock, read_frame(sock)
+
+
+def test_login_negotiates_the_codec(server_port):
+    sock, (reply_codec, reply) = login(server_port, ["xml", "json"])
+    with sock:
+        assert reply["status"] == "success" and reply["codec"] == "json"
+        assert reply_codec is JSON
+
+
+def test_login_without_codecs_stays_on_json(server_port):
+    sock, (_, reply) = login(server_port, None)
+    with sock:
+        assert reply["status"] == "success" and reply["codec"] == "json"
+
+
+@needs_msgpack
+def test_login_switches_to_msgpack_after_the_reply(server_port):
+    sock, (reply_codec, reply) = login(server_port, ["msgpack", "json"])
+    with sock:
+        # the reply itself still goes out in the codec the client used
+        assert reply["codec"] == "msgpack" and reply_codec is JSON
+        send_message(sock, {"action": "get_users"})
+        while True:
+            frame_codec, frame = read_frame(sock)
+            assert frame_codec is get_codec("msgpack")
+            if frame.get("action") == "users_list":
+                break
+        assert frame["users"] == ["alice"]
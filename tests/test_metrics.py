@@ -0,0 +1,53 @@
+import json
+import socket
+import urllib.request
+
+from metrics import Histogram, Metrics
+
+
+def test_histogram_reports_bucket_bounds_capped_at_the_max():
+    histogram = Histogram()
+    for _ in range(90):
+        histogram.observe(0.001)
+    for _ in range(10):
+        histogram.observe(0.1)
+    # 1 ms falls in the bucket up to 1.28 ms
+    assert histogram.snapshot() == {"count": 100, "mean_ms": 10.9, "max_ms": 100.0,
+                                    "p50_ms": 1.28, "p90_ms": 1.28, "p99_ms": 100.0}
+    assert Histogram().snapshot()["p99_ms"] == 0.0
+
+
+def test_metrics_snapshot():
+    metrics = Metrics()
+    metrics.count("frames_in")
+    metrics.count("bytes_in", 300)
+    metrics.gauge("connections", 2)
+    metrics.gauge("connections", -1)
+    metrics.observe("action.login", 0.002)
+    assert metrics.snapshot() == {
+        "counters": {"frames_in": 1, "bytes_in": 300},
+        "gauges": {"connections": 1},
+        "latency": {"action.login": {"count": 1, "mean_ms": 2.0, "max_ms": 2.0,
+                                     "p50_ms": 2.0, "p90_ms": 2.0, "p99_ms": 2.0}},
+    }
+
+
+def test_admin_port_serves_the_snapshot(chat_server, new_session, monkeypatch):
+    monkeypatch.setattr(chat_server, "metrics", Metrics())
+    alice = new_session("alice")
+    chat_server.dispatch(alice, {"action": "get_users"})
+    chat_server.dispatch(alice, {"action": "get_users"})
+    chat_server.dispatch(alice, {"action": "no_such_action"})
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    chat_server.start_admin(port)
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=5) as response:
+        snapshot = json.loads(response.read())
+    assert snapshot["latency"]["action.get_users"]["count"] == 2
+    assert snapshot["counters"]["unknown_actions"] == 1
+    assert snapshot["users_online"] == 1
+    assert snapshot["outbound"]["sessions"] == 1
+    assert {"write", "commit"} <= set(snapshot["store"])
+    assert snapshot["process"]["pid"] > 0
@@ -0,0 +1,93 @@
+import socket
+
+import pytest
+
+from protocol import (HEADER, FrameDecoder, FrameError, FramedReader, PendingRequests, encode_frame,
+                      read_response, send_message)
+
+
+def test_round_trip():
+    message = {"action": "send_message", "text": "привет", "seq": 3, "nested": {"a": [1, 2]}}
+    assert FrameDecoder().feed(encode_frame(message)) == [message]
+
+
+def test_frames_split_and_joined_across_reads():
+    messages = [{"n": n, "text": "x" * n} for n in range(50)]
+    data = b"".join(encode_frame(m) for m in messages)
+    decoder = FrameDecoder()
+    received = []
+    for start in range(0, len(data), 7):
+        received += decoder.feed(data[start:start + 7])
+    assert received == messages
+    assert decoder.pending_bytes() == 0
+
+
+def test_partial_frame_waits_for_the_rest():
+    frame = encode_frame({"action": "ping"})
+    decoder = FrameDecoder()
+    assert decoder.feed(frame[:-1]) == []
+    assert decoder.pending_bytes() == len(frame) - 1
+    assert decoder.feed(frame[-1:]) == [{"action": "ping"}]
+
+
+def test_oversized_length_prefix_is_rejected():
+    with pytest.raises(FrameError):
+        FrameDecoder(max_frame_size=10).feed(HEADER.pack(11, 0) + b"x" * 11)
+
+
+def test_unknown_codec_id_is_rejected():
+    with pytest.raises(FrameError):
+        FrameDecoder().feed(HEADER.pack(2, 200) + b"{}")
+
+
+def test_framed_reader_keeps_frames_read_ahead():
+    left, right = socket.socketpair()
+    with left, right:
+        for n in range(3):
+            send_message(left, {"n": n, "req_id": n})
+        left.close()
+        reader = FramedReader(right)
+        stash = []
+        assert read_response(reader, 2, stash) == {"n": 2, "req_id": 2}
+        assert stash == [{"n": 0, "req_id": 0}, {"n": 1, "req_id": 1}]
+        assert reader.read_message() is None
+
+
+def test_pending_requests_match_by_req_id():
+    requests = PendingRequests()
+    first = requests.add({"action": "a"})
+    second = requests.add({"action": "b"}, final=lambda frame: frame.get("done"))
+    assert not requests.resolve({"action": "push"})
+    assert requests.resolve({"req_id": 2, "part": 1})
+    assert not second.done()
+    assert requests.resolve({"req_id": 1})
+    assert requests.resolve({"req_id": 2, "done": True})
+    assert first.result() == {"req_id": 1}
+    assert second.result() == {"req_id": 2, "done": True}
+    assert len(requests) == 0
+
+
+def test_pending_requests_fail_on_timeout_and_close():
+    requests = PendingRequests(timeout=-1)
+    expired = requests.add({"action": "a"})
+    assert requests.expire() == 1
+    with pytest.raises(TimeoutError):
+        expired.result()
+    requests = PendingRequests()
+    lost = requests.add({"action": "a"})
+    requests.fail_all(ConnectionError("closed"))
+    with pytest.raises(ConnectionError):
+        lost.result()
+
+
+def test_pending_requests_keep_given_ids_and_expire_only_overdue():
+    requests = PendingRequests()
+    assert requests.tag({"req_id": "mine"}) == "mine"
+    overdue = requests.add({"action": "a"}, timeout=-1)
+    waiting = requests.add({"action": "b", "req_id": "b"})
+    assert requests.expire() == 1
+    assert isinstance(overdue.exception(), TimeoutError)
+    assert not waiting.done()
+    requests.discard("b")
+    assert not requests.resolve({"req_id": "b"})
+    assert len(requests) == 0
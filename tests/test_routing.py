@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+from routing import Router
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def bus(tmp_path):
+    """Two started nodes linked to each other; messages each one got."""
+    paths = {"n1": str(tmp_path / "n1.sock"), "n2": str(tmp_path / "n2.sock")}
+    routers, received = {}, {}
+    for node in paths:
+        routers[node] = Router(node, paths[node], {peer: path for peer, path in paths.items() if peer != node})
+        received[node] = []
+    routers["n1"].user_online("early")
+    for node, router in routers.items():
+        router.start(received[node].append)
+    yield routers, received
+    for router in routers.values():
+        router.close()
+
+
+def test_presence_is_replicated(bus):
+    routers, _ = bus
+    n1, n2 = routers["n1"], routers["n2"]
+    # users that were online before the link came up arrive with hello
+    wait_for(lambda: n2.location("early") == "n1")
+    n1.user_online("alice")
+    wait_for(lambda: n2.location("alice") == "n1")
+    assert n1.location("alice") is None
+    # the newest login wins
+    n2.user_online("alice")
+    wait_for(lambda: n1.location("alice") == "n2")
+    assert n2.location("alice") is None
+    n2.user_offline("alice")
+    wait_for(lambda: n1.location("alice") is None)
+
+
+def test_forward_and_forward_many(bus):
+    routers, received = bus
+    n1, n2 = routers["n1"], routers["n2"]
+    n1.user_online("alice")
+    n1.user_online("bob")
+    wait_for(lambda: n2.location("bob") == "n1")
+    message = {"action": "receive_message", "text": "hi"}
+    assert n2.forward("alice", message)
+    assert not n2.forward("carol", message)
+    assert n2.forward_many(["alice", "carol", "bob"], message) == ["carol"]
+    wait_for(lambda: len([m for m in received["n1"] if m["type"] == "deliver"]) == 2)
+    single, many = [m for m in received["n1"] if m["type"] == "deliver"]
+    assert single == {"type": "deliver", "user": "alice", "message": message}
+    assert many == {"type": "deliver", "users": ["alice", "bob"], "message": message}
+
+
+def test_forward_many_reports_users_whose_frame_was_dropped(tmp_path):
+    router = Router("n2", str(tmp_path / "n2.sock"), {"n1": str(tmp_path / "n1.sock")})
+    router.peers["n1"].max_queue = 0
+    router.locations.update({"alice": "n1", "bob": "n1"})
+    assert router.forward_many(["alice", "bob", "carol"], {"text": "hi"}) == ["carol", "alice", "bob"]
+    assert not router.forward("alice", {"text": "hi"})
+    assert router.peers["n1"].dropped == 2
+
+
+def test_peer_down_forgets_its_users_once_every_link_is_gone(tmp_path):
+    router = Router("n0", str(tmp_path / "n0.sock"), {})
+    hello = {"client": ["127.0.0.1", 5556], "users": ["alice", "bob"]}
+    router._peer_up("n1", hello)
+    # the node reconnected before its old link was noticed to be closed
+    router._peer_up("n1", hello)
+    router._peer_down("n1")
+    assert router.location("alice") == "n1" and "n1" in router.clients
+    router._peer_down("n1")
+    assert router.locations == {} and router.clients == {}
+
+
+def test_least_loaded(tmp_path):
+    router = Router("n0", str(tmp_path / "n0.sock"), {}, client=("127.0.0.1", 5555))
+    router.user_online("x")
+    router._peer_up("n1", {"client": ["127.0.0.1", 5556], "users": ["a", "b"]})
+    assert router.least_loaded() == ("127.0.0.1", 5555)
+    # workers of one server share its client address and add up
+    router._peer_up("n2", {"client": ["127.0.0.1", 5555], "users": ["c", "d"]})
+    assert router.loads() == {("127.0.0.1", 5555): 3, ("127.0.0.1", 5556): 2}
+    assert router.least_loaded() == ("127.0.0.1", 5556)
+    # ties go to the lowest address
+    router.user_offline("x")
+    assert router.least_loaded() == ("127.0.0.1", 5555)
+    assert Router("n9", str(tmp_path / "n9.sock"), {}).least_loaded() is None
@@ -0,0 +1,329 @@
+import pytest
+
+import server
+from protocol import FrameDecoder
+
+
+@pytest.mark.parametrize("action", sorted(set(server.ACTIONS) - set(server.PUBLIC_ACTIONS)))
+def test_actions_before_login_are_rejected(chat_server, new_session, action):
+    chat_server.store.add_user("alice", "x")
+    session = new_session()
+    chat_server.dispatch(session, {"action": action, "req_id": "r1", "other_user": "alice",
+                                   "recipient": "alice", "text": "hi", "query": "hi", "name": "team"})
+    assert session.sent == [{"action": action, "status": "error", "message": "Требуется вход",
+                             "req_id": "r1"}]
+
+
+@pytest.mark.parametrize("text", [None, 5, "", ["hi"]])
+def test_send_message_needs_text(chat_server, new_session, text):
+    chat_server.store.add_user("bob", "x")
+    gid = chat_server.store.create_group("team", "alice", ["bob"])
+    alice = new_session("alice")
+    for recipient in ("bob", f"group:{gid}"):
+        chat_server.dispatch(alice, {"action": "send_message", "recipient": recipient, "text": text})
+        reply = alice.sent.pop()
+        assert reply["action"] == "message_sent" and reply["status"] == "error"
+        assert reply["recipient"] == recipient
+    assert chat_server.store.get_history(("alice", "bob")) == []
+    assert chat_server.store.chat_summaries("bob")[0]["last_message"] is None
+
+
+def test_send_message_delivers_and_stores(chat_server, new_session):
+    chat_server.store.add_user("bob", "x")
+    alice, bob = new_session("alice"), new_session("bob")
+    chat_server.dispatch(alice, {"action": "send_message", "recipient": "bob", "text": "hi", "req_id": 1})
+    assert alice.sent[-1]["status"] == "success" and alice.sent[-1]["seq"] == 1
+    assert bob.sent[-1]["action"] == "receive_message" and bob.sent[-1]["text"] == "hi"
+    assert "req_id" not in bob.sent[-1]
+    assert [m["text"] for m in chat_server.store.get_history(("alice", "bob"))] == ["hi"]
+
+
+class QueuedSession(server.ClientSession):
+    """A connection with the real outbound queue and no writer draining it."""
+
+    def __init__(self, username, max_queue, policy):
+        super().__init__(("test", 0), max_queue, policy)
+        self.username = username
+        server.user_connections[username] = self
+
+    def start(self):
+        pass
+
+    def queued(self):
+        with self._cond:
+            frames, due = self._take()
+        return FrameDecoder().feed(b"".join(frames)), due
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    stats = {"dropped": 0, "spilled": 0, "disconnected": 0}
+    monkeypatch.setattr(server, "outbound_stats", stats)
+    return stats
+
+
+def send(chat_server, sender, recipient, text):
+    chat_server.dispatch(sender, {"action": "send_message", "recipient": recipient, "text": text})
+    assert sender.sent[-1]["status"] == "success"
+
+
+def fill_queue(chat_server, new_session, policy):
+    chat_server.store.add_user("alice", "x")
+    chat_server.store.add_user("bob", "x")
+    alice, bob = new_session("alice"), QueuedSession("bob", 2, policy)
+    for n in range(3):
+        send(chat_server, alice, "bob", f"m{n}")
+    return alice, bob
+
+
+def test_drop_policy_drops_pushes_over_the_limit(chat_server, new_session, stats):
+    _, bob = fill_queue(chat_server, new_session, "drop")
+    assert bob.dropped == 1 and stats["dropped"] == 1
+    assert not bob.closed
+    frames, due = bob.queued()
+    assert [frame["text"] for frame in frames] == ["m0", "m1"] and not due
+
+
+def test_disconnect_policy_closes_the_connection(chat_server, new_session, stats):
+    _, bob = fill_queue(chat_server, new_session, "disconnect")
+    assert bob.closed and stats["disconnected"] == 1
+    assert not bob.send({"action": "users_list", "users": []})
+
+
+def test_spill_policy_moves_direct_messages_to_the_pending_queue(chat_server, new_session, stats):
+    _, bob = fill_queue(chat_server, new_session, "spill")
+    assert bob.spilled == 1 and stats["spilled"] == 1 and not bob.closed
+    frames, due = bob.queued()
+    assert [frame["text"] for frame in frames] == ["m0", "m1"] and not due
+    # the spilled message goes out as pending once the queue is empty
+    frames, due = bob.queued()
+    assert frames == [] and due
+    chat_server.deliver_pending(bob)
+    [pending], _ = bob.queued()
+    assert pending["action"] == "pending" and [m["text"] for m in pending["messages"]] == ["m2"]
+
+
+def test_spill_policy_disconnects_for_what_it_cannot_spill(chat_server, new_session, stats):
+    chat_server.store.add_user("bob", "x")
+    gid = chat_server.store.create_group("team", "alice", ["bob"])
+    alice, bob = new_session("alice"), QueuedSession("bob", 1, "spill")
+    send(chat_server, alice, f"group:{gid}", "g0")
+    send(chat_server, alice, f"group:{gid}", "g1")
+    assert bob.closed and stats == {"dropped": 0, "spilled": 0, "disconnected": 1}
+
+
+@pytest.mark.parametrize("policy", server.OVERFLOW_POLICIES)
+def test_replies_are_never_dropped(chat_server, new_session, stats, policy):
+    _, bob = fill_queue(chat_server, new_session, "drop")
+    bob.policy = policy
+    chat_server.dispatch(bob, {"action": "get_users", "req_id": 1})
+    chat_server.dispatch(bob, {"action": "get_users"})
+    assert bob.depth() == 4 and not bob.closed
+    # a client that still does not read its replies is cut off
+    chat_server.dispatch(bob, {"action": "get_users"})
+    assert bob.closed and stats["disconnected"] == 1
+
+
+def test_outbound_metrics(chat_server, new_session, stats):
+    _, bob = fill_queue(chat_server, new_session, "drop")
+    snapshot = chat_server.outbound_metrics()
+    assert snapshot == {"dropped": 1, "spilled": 0, "disconnected": 0,
+                        "sessions": 2, "queued": 2, "max_depth": 2}
+    bob.queued()
+    assert chat_server.outbound_metrics()["queued"] == 0
+    assert chat_server.outbound_metrics()["max_depth"] == 2
+
+
+def pending_texts(frame):
+    return [m["text"] for m in frame["messages"]]
+
+
+def test_pending_goes_out_in_a_window_of_batches(chat_server, new_session, monkeypatch):
+    monkeypatch.setattr(server, "PENDING_BATCH", 2)
+    monkeypatch.setattr(server, "PENDING_WINDOW", 2)
+    chat_server.store.add_user("bob", "x")
+    alice = new_session("alice")
+    for n in range(7):
+        send(chat_server, alice, "bob", f"m{n}")
+    bob = new_session("bob")
+    chat_server.deliver_pending(bob)
+    first, second = bob.sent
+    assert pending_texts(first) == ["m0", "m1"] and pending_texts(second) == ["m2", "m3"]
+    assert list(bob.pending_inflight) == [first["cursor"], second["cursor"]]
+
+    # a partial ack frees one slot of the window
+    chat_server.dispatch(bob, {"action": "ack_pending", "cursor": first["cursor"]})
+    third = bob.sent[-1]
+    assert pending_texts(third) == ["m4", "m5"] and third["has_more"]
+    assert [m["text"] for m in chat_server.store.pending_page("bob")[0]] == ["m2", "m3", "m4", "m5", "m6"]
+
+    # the newest cursor covers the frames before it
+    chat_server.dispatch(bob, {"action": "ack_pending", "cursor": third["cursor"]})
+    last = bob.sent[-1]
+    assert pending_texts(last) == ["m6"] and not last["has_more"]
+    assert list(bob.pending_inflight) == [last["cursor"]]
+
+    # a stale ack changes nothing
+    count = len(bob.sent)
+    chat_server.dispatch(bob, {"action": "ack_pending", "cursor": first["cursor"]})
+    chat_server.dispatch(bob, {"action": "ack_pending", "cursor": "x"})
+    assert len(bob.sent) == count
+    assert [m["text"] for m in chat_server.store.pending_page("bob")[0]] == ["m6"]
+    chat_server.dispatch(bob, {"action": "ack_pending", "cursor": last["cursor"]})
+    assert chat_server.store.pending_page("bob")[0] == [] and not bob.pending_inflight
+
+
+def test_pending_waits_for_a_full_queue(chat_server, new_session):
+    chat_server.store.add_user("bob", "x")
+    alice = new_session("alice")
+    for n in range(3):
+        send(chat_server, alice, "bob", f"m{n}")
+    bob = QueuedSession("bob", 1, "drop")
+    assert bob.send({"action": "users_list", "users": []})
+    chat_server.deliver_pending(bob)
+    assert bob.pending_cursor == 0 and not bob.pending_inflight and bob.dropped == 0
+
+    frames, due = bob.queued()
+    assert [frame["action"] for frame in frames] == ["users_list"]
+    frames, due = bob.queued()
+    assert frames == [] and due
+    chat_server.deliver_pending(bob)
+    [pending], _ = bob.queued()
+    assert pending_texts(pending) == ["m0", "m1", "m2"]
+    chat_server.dispatch(bob, {"action": "ack_pending", "cursor": pending["cursor"]})
+    assert chat_server.store.pending_page("bob")[0] == []
+
+
+def test_receipts_reach_the_sender(chat_server, new_session):
+    chat_server.store.add_user("bob", "x")
+    alice, bob = new_session("alice"), new_session("bob")
+    send(chat_server, alice, "bob", "m0")
+    send(chat_server, alice, "bob", "m1")
+    chat_server.dispatch(bob, {"action": "ack_receipts", "req_id": 5,
+                               "receipts": [{"user": "alice", "delivered": 2, "read": 1}]})
+    assert alice.sent[-1] == {"action": "receipts", "receipts": [{"user": "bob", "delivered": 2, "read": 1}]}
+
+    # a watermark behind the stored one is not sent again
+    count = len(alice.sent)
+    chat_server.dispatch(bob, {"action": "ack_receipts", "receipts": [{"user": "alice", "delivered": 1}]})
+    assert len(alice.sent) == count
+    assert chat_server.store.get_receipt(("alice", "bob"), "bob") == (2, 1)
+
+    # the sender that was offline finds them in its chat summaries
+    del chat_server.user_connections["alice"]
+    chat_server.dispatch(bob, {"action": "ack_receipts", "receipts": [{"user": "alice", "read": 2}]})
+    assert len(alice.sent) == count
+    [summary] = chat_server.store.chat_summaries("alice")
+    assert summary["receipt"] == {"delivered": 2, "read": 2}
+
+
+def test_replies_carry_the_req_id(chat_server, new_session):
+    chat_server.store.add_user("bob", "x")
+    bob = new_session("bob")
+    chat_server.dispatch(bob, {"action": "get_users", "req_id": 7})
+    assert bob.sent[-1]["action"] == "users_list" and bob.sent[-1]["req_id"] == 7
+    chat_server.dispatch(bob, {"action": "bootstrap", "req_id": "b"})
+    assert bob.sent[-1]["action"] == "bootstrap_done"
+    assert {frame["req_id"] for frame in bob.sent[1:]} == {"b"}
+    chat_server.dispatch(bob, {"action": "no_such_action", "req_id": 9})
+    assert bob.sent[-1] == {"action": "error", "status": "error", "message": "Неизвестное действие", "req_id": 9}
+    chat_server.dispatch(bob, {"action": "get_users"})
+    assert "req_id" not in bob.sent[-1]
+
+
+def test_push_to_self_has_no_req_id(chat_server, new_session):
+    chat_server.store.add_user("alice", "x")
+    alice = new_session("alice")
+    chat_server.dispatch(alice, {"action": "send_message", "recipient": "alice", "text": "note", "req_id": 3})
+    push, reply = alice.sent
+    assert push["action"] == "receive_message" and "req_id" not in push
+    assert reply["action"] == "message_sent" and reply["req_id"] == 3
+
+
+def test_owner_cannot_leave_the_group(chat_server, new_session):
+    for name in ("bob", "carol"):
+        chat_server.store.add_user(name, "x")
+    gid = chat_server.store.create_group("team", "alice", ["bob", "carol"])
+    alice, bob, carol = new_session("alice"), new_session("bob"), new_session("carol")
+    for username in (None, "alice"):
+        chat_server.dispatch(alice, {"action": "remove_group_member", "group": f"group:{gid}", "username": username})
+        assert alice.sent[-1]["status"] == "error"
+    chat_server.dispatch(bob, {"action": "remove_group_member", "group": f"group:{gid}", "username": "alice"})
+    assert bob.sent[-1]["status"] == "error"
+    assert chat_server.store.get_group(gid)["owner"] == "alice"
+
+    chat_server.dispatch(alice, {"action": "remove_group_member", "group": f"group:{gid}", "username": "carol"})
+    assert alice.sent[-1]["status"] == "success"
+    assert carol.sent[-1] == {"action": "group_removed", "group": f"group:{gid}"}
+    chat_server.dispatch(bob, {"action": "remove_group_member", "group": f"group:{gid}"})
+    assert bob.sent[-1]["status"] == "success"
+    assert chat_server.store.get_group(gid)["members"] == ["alice"]
+
+
+def history(chat_server, session, **request):
+    chat_server.dispatch(session, dict(request, action="get_chat_history", other_user="bob"))
+    reply = session.sent[-1]
+    return [m["seq"] for m in reply["messages"]], reply["has_more"], reply["next_cursor"]
+
+
+def test_history_pages_by_cursor(chat_server, new_session, monkeypatch):
+    chat_server.store.add_user("bob", "x")
+    alice = new_session("alice")
+    for n in range(5):
+        send(chat_server, alice, "bob", f"m{n}")
+
+    assert history(chat_server, alice, limit=2) == ([4, 5], True, 4)
+    assert history(chat_server, alice, limit=2, before=4) == ([2, 3], True, 2)
+    assert history(chat_server, alice, limit=2, before=2) == ([1], False, None)
+    assert history(chat_server, alice, limit=1, after=3) == ([4], True, 4)
+    assert history(chat_server, alice, limit=2, after=5) == ([], False, None)
+    assert history(chat_server, alice, limit=2, after=50) == ([], False, None)
+    # limits out of range fall back to the default or the maximum
+    assert history(chat_server, alice, limit=0) == ([1, 2, 3, 4, 5], False, None)
+    assert history(chat_server, alice, limit="x") == ([1, 2, 3, 4, 5], False, None)
+    assert history(chat_server, alice, limit=-5) == ([5], True, 5)
+    monkeypatch.setattr(server, "MAX_HISTORY_PAGE_SIZE", 3)
+    assert history(chat_server, alice, limit=10 ** 9) == ([3, 4, 5], True, 3)
+    # a cursor that is not a seq is ignored
+    for cursor in ("x", [1], {"seq": 1}):
+        assert history(chat_server, alice, limit=2, before=cursor) == ([4, 5], True, 4)
+        assert history(chat_server, alice, limit=2, after=cursor) == ([4, 5], True, 4)
+
+    # without a page request the whole history is sent
+    chat_server.dispatch(alice, {"action": "get_chat_history", "other_user": "bob"})
+    assert [m["text"] for m in alice.sent[-1]["messages"]] == ["m0", "m1", "m2", "m3", "m4"]
+
+
+def sync(chat_server, session, **request):
+    start = len(session.sent)
+    chat_server.dispatch(session, dict(request, action="sync"))
+    *pages, done = session.sent[start:]
+    assert done["action"] == "sync_done" and done["chats"] == len(pages)
+    return {page["other_user"]: [m["seq"] for m in page["messages"]] for page in pages}, pages
+
+
+def test_sync_sends_only_what_is_new(chat_server, new_session, monkeypatch):
+    for name in ("bob", "carol"):
+        chat_server.store.add_user(name, "x")
+    gid = chat_server.store.create_group("empty", "alice", ["bob"])
+    alice = new_session("alice")
+    for n in range(3):
+        send(chat_server, alice, "bob", f"b{n}")
+    send(chat_server, alice, "carol", "c0")
+    group = f"group:{gid}"
+
+    # nothing known: the last page of every chat, empty ones included
+    assert sync(chat_server, alice)[0] == {"bob": [1, 2, 3], "carol": [1], group: []}
+    # up to date, a cursor past the end and an empty chat send nothing
+    assert sync(chat_server, alice, known={"bob": 3, "carol": 99, group: 0})[0] == {}
+    chats, [page] = sync(chat_server, alice, known={"bob": 1, "carol": 1, group: 0}, limit=1)
+    assert chats == {"bob": [2]} and page["has_more"] and page["next_cursor"] == 2
+    # seqs that are not integers and a malformed known are ignored
+    assert sync(chat_server, alice, known={"bob": "1", "carol": 1, group: 0})[0] == {"bob": [1, 2, 3]}
+    assert set(sync(chat_server, alice, known=["bob"])[0]) == {"bob", "carol", group}
+
+    # limits out of range fall back to the default or the maximum
+    assert sync(chat_server, alice, known={"bob": 0, "carol": 1, group: 0}, limit="x")[0] == {"bob": [1, 2, 3]}
+    monkeypatch.setattr(server, "MAX_HISTORY_PAGE_SIZE", 2)
+    chats, [page] = sync(chat_server, alice, known={"bob": 0, "carol": 1, group: 0}, limit=10 ** 9)
+    assert chats == {"bob": [1, 2]} and page["next_cursor"] == 2
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import pytest
+
+import client_async
+import server
+from client_async import AsyncChatClient
+
+
+def login(chat_server, session, username, password="secret"):
+    chat_server.dispatch(session, {"action": "login", "username": username, "password": password})
+    return session.sent[-1]
+
+
+def resume(chat_server, session, token):
+    chat_server.dispatch(session, {"action": "resume", "session": token, "req_id": "r"})
+    return session.sent[0]
+
+
+def test_login_gives_a_token_that_resumes(chat_server, register, new_session):
+    register("alice")
+    reply = login(chat_server, new_session(), "alice")
+    assert reply["status"] == "success" and reply["session"]
+    assert reply["session_expires"] > time.time()
+
+    session = new_session()
+    reply = resume(chat_server, session, reply["session"])
+    assert reply == {"action": "resume", "status": "success", "username": "alice", "codec": "json",
+                     "req_id": "r"}
+    assert session.username == "alice"
+    assert chat_server.user_connections["alice"] is session
+
+
+def test_resume_delivers_what_was_missed(chat_server, register, new_session):
+    register("alice")
+    register("bob")
+    token = login(chat_server, new_session(), "alice")["session"]
+    chat_server.user_connections.clear()
+    chat_server.dispatch(new_session("bob"), {"action": "send_message", "recipient": "alice", "text": "missed"})
+
+    session = new_session()
+    resume(chat_server, session, token)
+    [pending] = [frame for frame in session.sent if frame.get("action") == "pending"]
+    assert [m["text"] for m in pending["messages"]] == ["missed"]
+
+
+def test_expired_session_is_rejected(chat_server, register, new_session, monkeypatch):
+    register("alice")
+    monkeypatch.setattr(server, "SESSION_TTL", -1)
+    token = login(chat_server, new_session(), "alice")["session"]
+    session = new_session()
+    reply = resume(chat_server, session, token)
+    assert reply["action"] == "resume" and reply["status"] == "error"
+    assert session.username is None
+
+
+@pytest.mark.parametrize("token", [None, 5, "", "not-a-token"])
+def test_bad_token_is_rejected(chat_server, new_session, token):
+    session = new_session()
+    assert resume(chat_server, session, token)["status"] == "error"
+    assert session.username is None
+
+
+def test_store_sessions_expire_and_are_purged(store):
+    now = time.time()
+    store.add_session("old", "alice", now - 1)
+    store.add_session("new", "alice", now + 60)
+    assert store.session_user("new", now) == "alice"
+    assert store.session_user("old", now) is None
+    assert store.session_user("new", now + 61) is None
+    # adding a session drops the expired ones
+    store.add_session("newer", "bob", now + 60)
+    assert store._query("SELECT digest FROM sessions ORDER BY digest") == [("new",), ("newer",)]
+
+
+def test_async_client_reconnects_and_gets_missed_messages(server_port, monkeypatch):
+    monkeypatch.setattr(client_async, "RECONNECT_DELAY", 0.05)
+
+    async def scenario():
+        alice = await AsyncChatClient("127.0.0.1", server_port).connect()
+        bob = await AsyncChatClient("127.0.0.1", server_port).connect()
+        for client, name in ((alice, "alice"), (bob, "bob")):
+            assert (await client.register(name, "secret"))["status"] == "success"
+            assert (await client.login(name, "secret"))["status"] == "success"
+        assert alice.session
+
+        # the connection drops without a goodbye
+        alice._writer.transport.abort()
+        await alice.wait_closed()
+        sent = await bob.send("alice", "while you were away")
+        assert sent["status"] == "success"
+
+        reply = await alice.reconnect(max_attempts=5)
+        assert reply["status"] == "success" and reply["username"] == "alice"
+        while True:
+            # None marks the end of the first connection
+            event = await asyncio.wait_for(alice.events.get(), 5)
+            if event is not None and event.get("action") == "pending":
+                break
+        assert [m["text"] for m in event["messages"]] == ["while you were away"]
+        await alice.close()
+        await bob.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,206 @@
+import sqlite3
+
+import pytest
+
+from storage import SqliteStore, group_chat, group_key
+
+
+def message(sender, text):
+    return {"sender": sender, "text": text, "timestamp": "12:00:00"}
+
+
+def reopen(store):
+    store.close()
+    return SqliteStore(store.path)
+
+
+def drop_chat_index(path):
+    """Make the database look like one from before chat_index existed."""
+    db = sqlite3.connect(path)
+    db.execute("DELETE FROM chat_index")
+    db.commit()
+    db.close()
+
+
+def test_reopen_keeps_history(store):
+    store.add_user("alice", "x")
+    store.append_message(("alice", "bob"), message("alice", "hello"))
+    store = reopen(store)
+    try:
+        assert [m["text"] for m in store.get_history(("alice", "bob"))] == ["hello"]
+        assert store.user_exists("alice")
+    finally:
+        store.close()
+
+
+def test_reopen_with_only_group_messages(store):
+    gid = store.create_group("team", "alice", ["bob"])
+    store.append_message(group_key(gid), message("alice", "hi all"))
+    store.close()
+    drop_chat_index(store.path)
+
+    store = SqliteStore(store.path)
+    try:
+        [summary] = store.chat_summaries("bob")
+        assert summary["user"] == group_chat(gid)
+        assert summary["last_message"]["text"] == "hi all"
+    finally:
+        store.close()
+
+
+def test_rebuild_chat_index_for_direct_and_group_chats(store):
+    gid = store.create_group("team", "alice", ["bob"])
+    store.append_message(group_key(gid), message("alice", "hi all"))
+    store.append_message(("alice", "bob"), message("bob", "first"))
+    store.append_message(("alice", "bob"), message("alice", "second"))
+    store.close()
+    drop_chat_index(store.path)
+
+    store = SqliteStore(store.path)
+    try:
+        chats = {summary["user"]: summary for summary in store.chat_summaries("alice")}
+        assert set(chats) == {"bob", group_chat(gid)}
+        assert chats["bob"]["last_message"]["text"] == "second"
+        assert chats["bob"]["last_message"]["seq"] == 2
+    finally:
+        store.close()
+
+
+def test_search_pages_newest_first(store):
+    for n in range(5):
+        store.append_message(("alice", "bob"), message("alice", f"релиз номер {n}"))
+    store.append_message(("alice", "bob"), message("bob", "обед"))
+
+    page, has_more = store.search_messages("alice", "рел", limit=3)
+    assert [m["text"] for m in page] == ["релиз номер 4", "релиз номер 3", "релиз номер 2"]
+    assert has_more
+    assert all(m["chat"] == "bob" for m in page)
+
+    page, has_more = store.search_messages("alice", "рел", before=page[-1]["cursor"], limit=3)
+    assert [m["text"] for m in page] == ["релиз номер 1", "релиз номер 0"]
+    assert not has_more
+
+
+def test_search_needs_every_word(store):
+    store.append_message(("alice", "bob"), message("alice", "сервер упал"))
+    store.append_message(("alice", "bob"), message("alice", "сервер поднят, логи в чате"))
+    page, _ = store.search_messages("alice", "логи серв")
+    assert [m["text"] for m in page] == ["сервер поднят, логи в чате"]
+
+
+def test_search_only_in_own_chats(store):
+    store.append_message(("alice", "bob"), message("alice", "секрет alice"))
+    store.append_message(("carol", "dave"), message("carol", "секрет carol"))
+    gid = store.create_group("team", "carol", ["alice"])
+    store.append_message(group_key(gid), message("carol", "секрет группы"))
+
+    page, _ = store.search_messages("alice", "секрет")
+    assert {m["chat"] for m in page} == {"bob", group_chat(gid)}
+    page, _ = store.search_messages("alice", "секрет", chat_key=group_key(gid))
+    assert [m["text"] for m in page] == ["секрет группы"]
+    assert store.search_messages("bob", "секрет группы") == ([], False)
+
+
+def test_failed_append_leaves_no_rows(store, monkeypatch):
+    store.append_message(("alice", "bob"), message("alice", "kept"))
+
+    def broken_index(*args):
+        raise RuntimeError("index write failed")
+    monkeypatch.setattr(store, "_index_terms", broken_index)
+    with pytest.raises(RuntimeError):
+        store.append_message(("alice", "bob"), message("bob", "lost"))
+    monkeypatch.undo()
+
+    store = reopen(store)
+    try:
+        assert [m["text"] for m in store.get_history(("alice", "bob"))] == ["kept"]
+        [summary] = store.chat_summaries("alice")
+        assert summary["last_message"]["text"] == "kept" and summary["unread"] == 0
+        assert store.append_message(("alice", "bob"), message("bob", "next")) == 2
+    finally:
+        store.close()
+
+
+def test_failed_append_keeps_other_writes_in_the_batch(store, monkeypatch):
+    store.add_user("alice", "x")
+    monkeypatch.setattr(store, "_index_message", lambda *args: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        store.append_message(("alice", "bob"), message("alice", "lost"))
+    monkeypatch.undo()
+    store.add_user("bob", "x")
+
+    store = reopen(store)
+    try:
+        assert store.list_users() == ["alice", "bob"]
+        assert store.get_history(("alice", "bob")) == []
+    finally:
+        store.close()
+
+
+def test_failed_create_group_leaves_no_group(store, monkeypatch):
+    monkeypatch.setattr(store, "_add_members", lambda *args: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        store.create_group("team", "alice", ["bob"])
+    monkeypatch.undo()
+    gid = store.create_group("team", "alice", ["bob"])
+    assert store.get_group(gid - 1) is None
+    assert store.get_group(gid)["members"] == ["alice", "bob"]
+    assert [summary["user"] for summary in store.chat_summaries("alice")] == [group_chat(gid)]
+
+
+def test_rebuild_survives_rows_that_are_not_text(store):
+    store.append_message(("alice", "bob"), message("alice", "hello"))
+    store.close()
+    db = sqlite3.connect(store.path)
+    db.execute("INSERT INTO messages VALUES ('[\"alice\", \"carol\"]', 1, 'carol', x'ff00', '12:00:00', 'b1')")
+    db.execute("DELETE FROM chat_index")
+    db.execute("DELETE FROM search_index")
+    db.execute("DELETE FROM search_docs")
+    db.commit()
+    db.close()
+
+    store = SqliteStore(store.path)
+    try:
+        chats = {summary["user"]: summary for summary in store.chat_summaries("alice")}
+        assert chats["bob"]["last_message"]["text"] == "hello"
+        assert chats["carol"]["last_message"]["text"] == ""
+        assert [m["text"] for m in store.search_messages("alice", "hello")[0]] == ["hello"]
+    finally:
+        store.close()
+
+
+def test_receipts_only_move_forward(store):
+    chat = ("alice", "bob")
+    assert store.update_receipt(chat, "bob", delivered=1) is None
+    for n in range(3):
+        store.append_message(chat, message("alice", f"m{n}"))
+    assert store.update_receipt(chat, "bob", delivered=2) == (2, 0)
+    assert store.update_receipt(chat, "bob", read=1) == (2, 1)
+    assert store.update_receipt(chat, "bob", delivered=1, read=1) is None
+    # read implies delivered, and neither goes past the last message
+    assert store.update_receipt(chat, "bob", read=5) == (3, 3)
+    assert store.get_receipt(chat, "bob") == (3, 3)
+    assert store.get_receipt(chat, "alice") == (0, 0)
+    [summary] = store.chat_summaries("alice")
+    assert summary["receipt"] == {"delivered": 3, "read": 3}
+
+
+def test_history_pages_with_before_and_after(store):
+    chat = ("alice", "bob")
+    assert store.get_page(chat) == ([], False)
+    for n in range(1, 8):
+        store.append_message(chat, message("alice", f"m{n}"))
+
+    def seqs(**cursor):
+        page, has_more = store.get_page(chat, limit=3, **cursor)
+        return [m["seq"] for m in page], has_more
+
+    assert seqs() == ([5, 6, 7], True)
+    assert seqs(before=5) == ([2, 3, 4], True)
+    assert seqs(before=2) == ([1], False)
+    assert seqs(before=1) == ([], False)
+    assert seqs(after=0) == ([1, 2, 3], True)
+    assert seqs(after=4) == ([5, 6, 7], False)
+    assert seqs(after=7) == ([], False)
+    assert seqs(after=100) == ([], False)
+    assert [m["text"] for m in store.get_page(chat, before=3, limit=1)[0]] == ["m2"]